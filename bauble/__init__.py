@@ -95,6 +95,12 @@ def quit():
         error('bauble.quit(): %s' % utils.utf8(e))
     else:
         task.kill()
+    try:
+        # write any queued history before quitting
+        import bauble.db as db
+        db.set_history_queue(None)
+    except Exception, e:
+        error('bauble.quit(): %s' % utils.utf8(e))
     try:
         save_state()
         gtk.main_quit()
@@ -186,7 +192,7 @@ def main(uri=None):
         sys.exit(1)
 
     import bauble.pluginmgr as pluginmgr
-    from bauble.prefs import prefs
+    from bauble.prefs import prefs, history_queue_pref
     import bauble.utils as utils
     from bauble.utils.log import debug, warning, error
 
@@ -255,6 +261,10 @@ def main(uri=None):
     else:
         db.open(uri, True, True)
 
+    # write the history from a background thread if the user asked for it
+    if prefs.get(history_queue_pref, False) and db.engine is not None \
+            and db.engine.name != 'sqlite':
+        db.set_history_queue(db.HistoryQueue(db.engine))
 
     # make session available as a convenience to other modules
     #Session = db.Session
@@ -3,7 +3,10 @@
 
 import datetime
 import os
+import Queue
+import threading
 import traceback
+import weakref
 import bauble.error as error
 
 SQLALCHEMY_DEBUG = False
@@ -24,8 +27,14 @@ except ImportError:
     raise
 
 
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
 import gtk
 import sqlalchemy.orm as orm
+from sqlalchemy.interfaces import PoolListener
 from sqlalchemy.ext.declarative import declarative_base, DeclarativeMeta
 
 import bauble.btypes as types
@@ -41,6 +50,390 @@ if SQLALCHEMY_DEBUG:
     logging.getLogger('sqlalchemy.orm.unitofwork').setLevel(logging.DEBUG)
 
 
+def _current_user(connection):
+    """
+    Return the name of the user to record in the history table for
+    changes made on connection.
+
+    The name is cached in the info dictionary of the DBAPI connection
+    so the database is only asked once per connection instead of once
+    per change.
+    """
+    info = connection.info
+    if 'bauble.user' not in info:
+        user = None
+        try:
+            if connection.engine.name in ('postgres', 'postgresql'):
+                user = connection.execute('select current_user;').scalar()
+        except Exception, e:
+            debug('could not get the current user: %s' % utils.utf8(e))
+        if not user:
+            if 'USER' in os.environ and os.environ['USER']:
+                user = os.environ['USER']
+            elif 'USERNAME' in os.environ and os.environ['USERNAME']:
+                user = os.environ['USERNAME']
+        info['bauble.user'] = user
+    return info['bauble.user']
+
+
+def history_values(operation, mapper, instance):
+    """
+    Return a dict of the column values to record in the history table
+    for a change to instance.
+
+    An insert records all the loaded columns, an update only records
+    the columns that changed and a delete doesn't record anything
+    since the values can be rebuilt from the earlier history, see
+    :func:`get_history_state`.
+    """
+    values = {}
+    if operation == 'delete':
+        return values
+    state_dict = orm.attributes.instance_dict(instance)
+    for c in mapper.local_table.c:
+        if operation == 'insert':
+            # columns that aren't loaded, e.g. server defaults, are skipped
+            # so that we don't issue a select for every row
+            if c.name in state_dict:
+                values[c.name] = state_dict[c.name]
+            continue
+        history = orm.attributes.get_history(instance, c.name,
+                                passive=orm.attributes.PASSIVE_NO_INITIALIZE)
+        if history.added:
+            values[c.name] = history.added[0]
+        elif history.deleted:
+            values[c.name] = None
+    return values
+
+
+def _json_default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    return utils.utf8(obj)
+
+
+def encode_history_values(values):
+    """
+    Return values encoded for the values column of the history table.
+    """
+    return json.dumps(values, separators=(',', ':'), default=_json_default)
+
+
+def decode_history_values(values):
+    """
+    Return the dict of values from the values column of the history
+    table.
+
+    History items written by older versions of Bauble are a Python
+    dict repr of all the columns.
+    """
+    try:
+        return json.loads(values)
+    except ValueError:
+        import ast
+        return ast.literal_eval(values)
+
+
+def _replay_history(state, operation, values):
+    """
+    Apply a history item to state and return the new state.
+    """
+    if operation == 'delete':
+        return None
+    values = decode_history_values(values)
+    if operation == 'update' and state is not None:
+        state.update(values)
+        return state
+    return values
+
+
+def get_history_state(session, table_name, table_id, when=None):
+    """
+    Return a dict of the column values of a row at a point in time by
+    replaying its history, or None if the row didn't exist at that
+    time.
+
+    :param session: the session to use for the query
+    :param table_name: the name of the table of the row
+    :param table_id: the id of the row
+    :param when: a datetime, if None then return the latest state
+    """
+    query = session.query(History.operation, History.values).\
+        filter_by(table_name=table_name, table_id=table_id)
+    if when is not None:
+        query = query.filter(History.timestamp <= when)
+    state = None
+    for operation, values in query.order_by(History.timestamp, History.id):
+        state = _replay_history(state, operation, values)
+    return state
+
+
+def compact_history(before):
+    """
+    Fold the history items older than before into one snapshot item
+    per row so the history table doesn't grow forever.
+
+    The snapshot items have the operation 'snapshot' and the state of
+    the row at the time of the last item that was folded into it.
+    Rows that were deleted before the cutoff don't get a snapshot.
+
+    :param before: a datetime
+    :returns: the number of history items that were removed
+    """
+    t = History.__table__
+    old = t.c.timestamp < before
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        stmt = sa.select([t], old).order_by(t.c.table_name, t.c.table_id,
+                                            t.c.timestamp, t.c.id)
+        result = connection.execute(stmt.execution_options(\
+                stream_results=True))
+        snapshots = []
+        nitems = 0
+        key = state = last = None
+        for row in result:
+            if key != (row.table_name, row.table_id):
+                if state is not None:
+                    snapshots.append(_snapshot_row(last, state))
+                key = (row.table_name, row.table_id)
+                state = None
+            state = _replay_history(state, row.operation, row['values'])
+            last = row
+            nitems += 1
+        if state is not None:
+            snapshots.append(_snapshot_row(last, state))
+        result.close()
+
+        connection.execute(t.delete(old))
+        if snapshots:
+            connection.execute(t.insert(), snapshots)
+    except Exception, e:
+        warning('compact_history(): %s' % utils.utf8(e))
+        transaction.rollback()
+        raise
+    else:
+        transaction.commit()
+    finally:
+        connection.close()
+    return nitems - len(snapshots)
+
+
+def _snapshot_row(row, state):
+    return dict(table_name=row.table_name, table_id=row.table_id,
+                values=encode_history_values(state), operation='snapshot',
+                user=row.user, timestamp=row.timestamp)
+
+
+class HistoryQueue(object):
+    """
+    Write history rows to the history table from a background thread
+    so that commits don't have to wait for them.
+
+    The queue holds at most max_size batches of rows, once it is full
+    put() waits up to put_timeout seconds for the thread to catch up
+    before writing the rows itself.  The rows are also written by
+    put() if the thread has stopped.  The thread uses its own
+    connection so this shouldn't be used with SQLite.
+    """
+
+    # the maximum number of rows to insert at one time
+    batch_size = 500
+
+    # the number of seconds put() waits for room in the queue
+    put_timeout = 5
+
+    def __init__(self, engine, max_size=100):
+        self.engine = engine
+        self.queue = Queue.Queue(max_size)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+
+    def put(self, rows):
+        """
+        Queue rows to be written to the history table.
+        """
+        if self.thread.isAlive():
+            try:
+                self.queue.put(rows, timeout=self.put_timeout)
+                return
+            except Queue.Full:
+                warning('the history queue is full, writing %s history '\
+                        'rows now' % len(rows))
+        else:
+            # the thread stopped, e.g. it couldn't connect, so also
+            # write the rows it left in the queue
+            rows = list(rows)
+            while True:
+                try:
+                    more = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if more is not None:
+                    rows.extend(more)
+        self._write(rows)
+
+
+    def stop(self):
+        """
+        Write any queued rows and stop the thread.
+        """
+        while self.thread.isAlive():
+            try:
+                self.queue.put(None, timeout=self.put_timeout)
+                break
+            except Queue.Full:
+                pass
+        self.thread.join()
+
+
+    def _write(self, rows):
+        """
+        Write rows to the history table on a new connection.
+        """
+        try:
+            connection = self.engine.connect()
+            try:
+                connection.execute(History.__table__.insert(), rows)
+            finally:
+                connection.close()
+        except Exception, e:
+            warning('could not write %s history rows: %s' \
+                        % (len(rows), utils.utf8(e)))
+
+
+    def _run(self):
+        table = History.__table__
+        try:
+            connection = self.engine.connect()
+        except Exception, e:
+            warning('could not start the history thread: %s' % utils.utf8(e))
+            return
+        try:
+            done = False
+            while not done:
+                rows = self.queue.get()
+                if rows is None:
+                    break
+                rows = list(rows)
+                # drain whatever else is waiting, up to batch_size rows
+                while len(rows) < self.batch_size:
+                    try:
+                        more = self.queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                    if more is None:
+                        done = True
+                        break
+                    rows.extend(more)
+                try:
+                    connection.execute(table.insert(), rows)
+                except Exception, e:
+                    warning('could not write %s history rows: %s' \
+                                % (len(rows), utils.utf8(e)))
+        finally:
+            connection.close()
+
+
+class HistoryWriter(orm.SessionExtension):
+    """
+    HistoryWriter is a
+    :class:`~sqlalchemy.orm.interfaces.SessionExtension` that collects
+    the history rows created by :class:`HistoryExtension` during a
+    flush and inserts them all at once at the end of the flush on the
+    flush's connection.
+
+    If a :class:`HistoryQueue` is set the rows are instead queued when
+    the session is committed and written from a background thread.
+    """
+
+    def __init__(self):
+        # session -> (connection, [rows]) for the current flush
+        self._flushing = weakref.WeakKeyDictionary()
+        # session -> [rows] flushed but not committed, only when queued
+        self._flushed = weakref.WeakKeyDictionary()
+        self.queue = None
+
+
+    def add(self, session, connection, row):
+        """
+        Buffer a history row for session.
+
+        Return False if the row couldn't be buffered because session
+        doesn't use this extension.
+        """
+        if session is None or self not in session.extensions:
+            return False
+        if session not in self._flushing:
+            self._flushing[session] = (connection, [])
+        self._flushing[session][1].append(row)
+        return True
+
+
+    def before_flush(self, session, flush_context, instances):
+        # drop anything left over from a flush that failed
+        self._flushing.pop(session, None)
+
+
+    def after_flush(self, session, flush_context):
+        connection, rows = self._flushing.pop(session, (None, []))
+        if not rows:
+            return
+        if self.queue is not None:
+            self._flushed.setdefault(session, []).extend(rows)
+        else:
+            connection.execute(History.__table__.insert(), rows)
+
+
+    def after_commit(self, session):
+        rows = self._flushed.pop(session, None)
+        if rows and self.queue is not None:
+            self.queue.put(rows)
+
+
+    def after_rollback(self, session):
+        self._flushing.pop(session, None)
+        self._flushed.pop(session, None)
+
+
+history_writer = HistoryWriter()
+"""The :class:`HistoryWriter` used by all the sessions created with
+bauble.db.Session
+"""
+
+
+session_extensions = []
+"""The SessionExtensions that plugins added with add_session_extension()
+to the sessions created with bauble.db.Session
+"""
+
+
+def add_session_extension(extension):
+    """
+    Add a :class:`~sqlalchemy.orm.interfaces.SessionExtension` to the
+    sessions created with bauble.db.Session from now on, e.g. for a
+    plugin that needs to know when the sessions are flushed.
+    """
+    if extension not in session_extensions:
+        session_extensions.append(extension)
+    if Session is not None:
+        Session.configure(extension=[history_writer] + session_extensions)
+
+
+def set_history_queue(queue):
+    """
+    Set the :class:`HistoryQueue` used to write the history rows in the
+    background, if queue is None then the history rows are written
+    when the session is flushed.  Any previous queue is stopped.
+    """
+    old = history_writer.queue
+    history_writer.queue = queue
+    if old is not None:
+        old.stop()
+
+
 class HistoryExtension(orm.MapperExtension):
     """
     HistoryExtension is a
@@ -49,41 +442,144 @@ class HistoryExtension(orm.MapperExtension):
     inserts, updates, and deletes made to the mapped objects are
     recorded in the `history` table.
     """
-    def _add(self, operation, mapper, instance):
+    def _add(self, operation, mapper, connection, instance):
         """
         Add a new entry to the history table.
-        """
-        user = None
-        try:
-            if db.engine.name in ('postgres', 'postgresql'):
-                import bauble.plugins.users as users
-                user = users.current_user()
-        except:
-            if 'USER' in os.environ and os.environ['USER']:
-                user = os.environ['USER']
-            elif 'USERNAME' in os.environ and os.environ['USERNAME']:
-                user = os.environ['USERNAME']
 
-        row = {}
-        for c in mapper.local_table.c:
-            row[c.name] = utils.utf8(getattr(instance, c.name))
-        table = History.__table__
-        table.insert(dict(table_name=mapper.local_table.name,
-                          table_id=instance.id, values=str(row),
-                          operation=operation, user=user,
-                          timestamp=datetime.datetime.today())).execute()
+        The entry is buffered by :data:`history_writer` and written at
+        the end of the flush.
+        """
+        values = history_values(operation, mapper, instance)
+        entry = dict(table_name=mapper.local_table.name,
+                     table_id=instance.id,
+                     values=encode_history_values(values),
+                     operation=operation, user=_current_user(connection),
+                     timestamp=datetime.datetime.today())
+        session = orm.object_session(instance)
+        if not history_writer.add(session, connection, entry):
+            connection.execute(History.__table__.insert(), entry)
+
+
+    def _update_textindex(self, operation, mapper, connection, instance):
+        """
+        Keep the search text index in sync with the change, this does
+        nothing if the text index hasn't been built.
+        """
+        import bauble.textindex as textindex
+        textindex.update(connection, operation, mapper, instance)
 
 
     def after_update(self, mapper, connection, instance):
-        self._add('update', mapper, instance)
+        self._add('update', mapper, connection, instance)
+        self._update_textindex('update', mapper, connection, instance)
+        return orm.EXT_CONTINUE
 
 
     def after_insert(self, mapper, connection, instance):
-        self._add('insert', mapper, instance)
+        self._add('insert', mapper, connection, instance)
+        self._update_textindex('insert', mapper, connection, instance)
+        return orm.EXT_CONTINUE
 
 
     def after_delete(self, mapper, connection, instance):
-        self._add('delete', mapper, instance)
+        self._add('delete', mapper, connection, instance)
+        self._update_textindex('delete', mapper, connection, instance)
+        return orm.EXT_CONTINUE
+
+
+
+def reserve_ids(connection, table, count):
+    """
+    Return a list of count new ids for rows in table.
+
+    On PostgreSQL the ids are taken from the table's sequence.  On
+    other databases the ids follow the largest id in the table so
+    connection should already hold a write lock on the database,
+    e.g. on SQLite after the first insert or update in the
+    transaction.
+    """
+    if count <= 0:
+        return []
+    if connection.engine.name == 'postgresql':
+        stmt = "SELECT nextval('%s_id_seq') FROM generate_series(1, %d)" \
+            % (table.name, count)
+        return [row[0] for row in connection.execute(stmt)]
+    last = connection.execute(sa.select([sa.func.max(table.c.id)])).scalar()
+    last = last or 0
+    return range(last+1, last+count+1)
+
+
+def insert_rows(connection, table, rows):
+    """
+    Insert rows into table with one executemany and record the
+    inserts in the history table and the text index the same way
+    :class:`HistoryExtension` does for flushed instances.  The rows
+    don't go through the mappers so any other mapper extensions have
+    to be handled by the caller.
+
+    The id, _created and _last_updated of each row are set in place.
+
+    :param connection: the connection to use, should be in a transaction
+    :param table: the table to insert the rows into
+    :param rows: a list of dicts of column values, all with the same keys
+
+    Return the ids of the new rows.
+    """
+    if not rows:
+        return []
+    import bauble.textindex as textindex
+    # take the write lock with an update that doesn't change anything
+    # so that nobody else can insert into table until we commit
+    if connection.engine.name != 'postgresql':
+        connection.execute(table.update().where(table.c.id == None).\
+                               values(id=None))
+    ids = reserve_ids(connection, table, len(rows))
+    now = connection.execute(sa.select([sa.func.now()])).scalar()
+    for row, row_id in zip(rows, ids):
+        row.update(id=row_id, _created=now, _last_updated=now)
+    connection.execute(table.insert(), rows)
+
+    user = _current_user(connection)
+    timestamp = datetime.datetime.today()
+    history = [dict(table_name=table.name, table_id=row['id'],
+                    values=encode_history_values(row), operation='insert',
+                    user=user, timestamp=timestamp) for row in rows]
+    connection.execute(History.__table__.insert(), history)
+    textindex.insert(connection, table, rows)
+    return ids
+
+
+def delete_rows(connection, table, whereclause):
+    """
+    Delete the rows of table that match whereclause and record the
+    deletes in the history table and the text index the same way
+    :class:`HistoryExtension` does for deleted instances.  Like
+    :func:`insert_rows` the rows don't go through the mappers.
+
+    :param connection: the connection to use, should be in a transaction
+    :param table: the table to delete the rows from
+    :param whereclause: the clause that selects the rows, it shouldn't
+      select more rows than can be passed to an IN clause
+
+    Return the ids of the deleted rows.
+    """
+    import bauble.textindex as textindex
+    ids = [r[0] for r in \
+               connection.execute(sa.select([table.c.id], whereclause))]
+    if not ids:
+        return []
+    connection.execute(table.delete(table.c.id.in_(ids)))
+
+    user = _current_user(connection)
+    timestamp = datetime.datetime.today()
+    # a delete doesn't record any values, see history_values()
+    values = encode_history_values({})
+    history = [dict(table_name=table.name, table_id=row_id, values=values,
+                    operation='delete', user=user, timestamp=timestamp) \
+                   for row_id in ids]
+    connection.execute(History.__table__.insert(), history)
+    textindex.delete(connection, table, ids)
+    return ids
 
 
 
@@ -105,7 +601,17 @@ class MapperBase(DeclarativeMeta):
             cls._last_updated = sa.Column('_last_updated', types.DateTime(True),
                                           default=sa.func.now(),
                                           onupdate=sa.func.now())
-            cls.__mapper_args__ = {'extension': HistoryExtension()}
+            # mapped classes can add their own extensions with
+            # __mapper_args__ = {'extension': [...]}
+            extensions = [HistoryExtension()]
+            args = dict_.get('__mapper_args__', {})
+            if 'extension' in args:
+                ext = args['extension']
+                if isinstance(ext, (list, tuple)):
+                    extensions.extend(ext)
+                else:
+                    extensions.append(ext)
+            cls.__mapper_args__ = {'extension': extensions}
         super(MapperBase, cls).__init__(classname, bases, dict_)
 
 
@@ -162,9 +668,11 @@ class History(history_base):
       table_id: :class:`sqlalchemy.types.Integer`
         The id in the table of the row that was changed.
       values: :class:`sqlalchemy.types.String`
-        The changed values.
+        The changed values encoded as JSON, see
+        :func:`decode_history_values`.
       operation: :class:`sqlalchemy.types.String`
-        The type of change.  This is usually one of insert, update or delete.
+        The type of change.  This is one of insert, update, delete
+        or snapshot, see :func:`compact_history`.
       user: :class:`sqlalchemy.types.String`
         The name of the user who made the change.
       timestamp: :class:`sqlalchemy.types.DateTime`
@@ -179,6 +687,512 @@ class History(history_base):
     user = sa.Column(sa.String)
     timestamp = sa.Column(types.DateTime, nullable=False)
 
+# the history view pages through the history with ORDER BY timestamp,
+# id and the history command filters on the other columns
+history_indexes = [sa.Index('ix_history_timestamp_id',
+                            History.__table__.c.timestamp,
+                            History.__table__.c.id),
+                   sa.Index('ix_history_table_name_id',
+                            History.__table__.c.table_name,
+                            History.__table__.c.table_id),
+                   sa.Index('ix_history_user', History.__table__.c.user)]
+
+
+class SortKey(history_base):
+    """
+    The sort_key table holds a natural sort key for rows in other
+    tables so that they can be sorted by the database with ORDER BY
+    instead of in Python with :func:`bauble.utils.natsort_key`.  The
+    keys are maintained by :class:`SortKeyExtension`.
+
+    :Table name: sort_key
+
+    :Columns:
+      table_name: :class:`sqlalchemy.types.String`
+        The name of the table of the row.
+      table_id: :class:`sqlalchemy.types.Integer`
+        The id of the row in table_name.
+      key: :class:`sqlalchemy.types.Unicode`
+        The sort key created with :func:`bauble.utils.natsort_str`.
+    """
+    __tablename__ = 'sort_key'
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    table_name = sa.Column(sa.String(64), nullable=False)
+    table_id = sa.Column(sa.Integer, nullable=False, autoincrement=False)
+    key = sa.Column(sa.Unicode, nullable=False)
+
+sa.Index('ix_sort_key_table_id', SortKey.__table__.c.table_name,
+         SortKey.__table__.c.table_id, unique=True)
+sa.Index('ix_sort_key_key', SortKey.__table__.c.table_name,
+         SortKey.__table__.c.key)
+
+
+def sort_key_column(cls):
+    """
+    Return a column expression for the sort key of the mapped class
+    cls that can be used in a query, e.g. ::
+
+      session.query(Plant).order_by(db.sort_key_column(Plant))
+    """
+    t = SortKey.__table__
+    return sa.select([t.c.key], sa.and_(t.c.table_name == cls.__tablename__,
+                                        t.c.table_id == cls.id)).\
+                                        limit(1).as_scalar()
+
+
+def set_sort_keys(connection, table_name, values):
+    """
+    Set the sort keys for rows in table_name.
+
+    :param connection: the connection to use
+    :param table_name: the name of the table the rows are in
+    :param values: a list of (id, string) tuples, the strings are
+      converted with utils.natsort_str()
+    """
+    if not values:
+        return
+    t = SortKey.__table__
+    ids = [v[0] for v in values]
+    connection.execute(t.delete().where(sa.and_(t.c.table_name == table_name,
+                                                t.c.table_id.in_(ids))))
+    connection.execute(t.insert(), [dict(table_name=table_name, table_id=i,
+                                         key=utils.natsort_str(v)) \
+                                        for i, v in values])
+
+
+def delete_sort_keys(connection, table_name, ids):
+    """
+    Remove the sort keys for the rows in table_name with ids.
+    """
+    t = SortKey.__table__
+    connection.execute(t.delete().where(sa.and_(t.c.table_name == table_name,
+                                                t.c.table_id.in_(ids))))
+
+
+
+class SortKeyExtension(orm.MapperExtension):
+    """
+    SortKeyExtension is a :class:`~sqlalchemy.orm.interfaces.MapperExtension`
+    that keeps the rows in the sort_key table up to date for a mapped
+    class.
+
+    :param key_func: a function that takes an instance and returns the
+      string that the instance should be sorted by
+    """
+    def __init__(self, key_func):
+        super(SortKeyExtension, self).__init__()
+        self.key_func = key_func
+
+
+    def _set(self, mapper, connection, instance):
+        try:
+            key = self.key_func(instance)
+        except Exception, e:
+            warning('SortKeyExtension: %s' % utils.utf8(e))
+            key = u''
+        set_sort_keys(connection, mapper.local_table.name,
+                      [(instance.id, key)])
+        return orm.EXT_CONTINUE
+
+
+    def after_insert(self, mapper, connection, instance):
+        return self._set(mapper, connection, instance)
+
+
+    def after_update(self, mapper, connection, instance):
+        return self._set(mapper, connection, instance)
+
+
+    def after_delete(self, mapper, connection, instance):
+        delete_sort_keys(connection, mapper.local_table.name, [instance.id])
+        return orm.EXT_CONTINUE
+
+
+    def rebuild(self, cls, session, query=None):
+        """
+        Recreate the sort keys for all the instances of cls.
+
+        :param cls: the mapped class this extension is attached to
+        :param session: the session to use to query cls
+        :param query: an optional query to use instead of session.query(cls)
+        """
+        if query is None:
+            query = session.query(cls)
+        table_name = cls.__tablename__
+        t = SortKey.__table__
+        connection = session.connection()
+        connection.execute(t.delete().where(t.c.table_name == table_name))
+        values = []
+        for instance in query.yield_per(500):
+            values.append((instance.id, self.key_func(instance)))
+            if len(values) >= 500:
+                set_sort_keys(connection, table_name, values)
+                values = []
+        set_sort_keys(connection, table_name, values)
+
+
+    def check(self, cls, session):
+        """
+        Rebuild the sort keys for cls if the number of sort keys
+        doesn't match the number of rows in its table, e.g. for a
+        database created before the sort_key table existed.
+
+        Return True if the sort keys were rebuilt.
+        """
+        t = SortKey.__table__
+        nrows = session.query(sa.func.count(cls.id)).scalar()
+        nkeys = session.query(sa.func.count(t.c.id)).\
+            filter(t.c.table_name == cls.__tablename__).scalar()
+        if nrows == nkeys:
+            return False
+        self.rebuild(cls, session)
+        return True
+
+
+
+def check_sort_keys(extensions):
+    """
+    Create the sort_key table if it doesn't exist and rebuild the sort
+    keys of any classes that are missing them.
+
+    :param extensions: a list of (cls, SortKeyExtension) tuples
+    """
+    session = None
+    try:
+        SortKey.__table__.create(bind=engine, checkfirst=True)
+        session = Session()
+        for cls, ext in extensions:
+            if ext.check(cls, session):
+                debug('rebuilt sort keys for %s' % cls.__tablename__)
+        session.commit()
+    except Exception, e:
+        warning('check_sort_keys(): %s' % utils.utf8(e))
+        if session:
+            session.rollback()
+    finally:
+        if session:
+            session.close()
+
+
+class CodeCounter(history_base):
+    """
+    The code_counter table holds the last value handed out for a
+    sequence of codes, e.g. the accession codes for a year or the
+    plant codes of an accession, so that the next code can be reserved
+    without looking at all the existing codes.
+
+    :Table name: code_counter
+
+    :Columns:
+      name: :class:`sqlalchemy.types.String`
+        The name of the counter.
+      value: :class:`sqlalchemy.types.Integer`
+        The last value that was reserved.
+    """
+    __tablename__ = 'code_counter'
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    name = sa.Column(sa.String(64), nullable=False, unique=True)
+    value = sa.Column(sa.Integer, nullable=False, default=0)
+
+
+# the engine used for the code counters and the engine it was created for
+_counter_engine = None
+_counter_engine_source = None
+
+
+def get_separate_engine():
+    """
+    Return an engine whose connections aren't shared with the
+    sessions, e.g. for the code counters which are committed on their
+    own.
+
+    The SingletonThreadPool used for SQLite would hand out the same
+    DBAPI connection as the caller's session so committing on it
+    would also commit the session's pending changes.  SQLite files
+    get their own engine without a pool instead.  An in memory
+    database can't be opened twice so it has to share the connection.
+    """
+    global _counter_engine, _counter_engine_source
+    if engine.name != 'sqlite' or \
+            engine.url.database in (None, '', ':memory:'):
+        return engine
+    if _counter_engine is None or _counter_engine_source is not engine:
+        import sqlalchemy.pool as pool
+        _counter_engine = sa.create_engine(engine.url, echo=SQLALCHEMY_DEBUG,
+                                           poolclass=pool.NullPool)
+        _counter_engine_source = engine
+    return _counter_engine
+
+
+def _counter_transaction(func):
+    """
+    Call func with a connection to change the code counters.
+
+    The counters are changed in their own transaction so that a
+    reserved value is never handed out twice and the counter row isn't
+    locked until the caller's session is committed.
+    """
+    conn = get_separate_engine().connect()
+    trans = conn.begin()
+    try:
+        try:
+            result = func(conn)
+            trans.commit()
+            return result
+        except:
+            trans.rollback()
+            raise
+    finally:
+        conn.close()
+
+
+def reserve_codes(name, count=1, seed=None):
+    """
+    Reserve count values from the counter name and return the first
+    reserved value.
+
+    :param name: the name of the counter
+    :param count: the number of values to reserve
+    :param seed: a function that takes a connection and returns the
+      last value that was used, it is called to start the counter if
+      it doesn't exist yet
+    """
+    t = CodeCounter.__table__
+    def reserve(conn):
+        stmt = t.update(t.c.name == name, values={t.c.value: t.c.value+count})
+        if conn.execute(stmt).rowcount == 0:
+            last = 0
+            if seed is not None:
+                last = seed(conn) or 0
+            conn.execute(t.insert(), name=name, value=last+count)
+        value = conn.execute(sa.select([t.c.value], t.c.name == name)).scalar()
+        return value - count + 1
+    return _counter_transaction(reserve)
+
+
+def peek_code(name, seed=None, reseed=False):
+    """
+    Return the value that reserve_codes() would return next from the
+    counter name without reserving it, e.g. to show in an editor
+    until the code is committed.
+
+    :param name: the name of the counter
+    :param seed: see reserve_codes()
+    :param reseed: if True then also call seed if the counter exists
+      and return the larger value, e.g. to skip past codes that were
+      entered by hand
+    """
+    t = CodeCounter.__table__
+    conn = get_separate_engine().connect()
+    try:
+        last = conn.execute(sa.select([t.c.value], t.c.name == name)).scalar()
+        if seed is not None and (last is None or reseed):
+            last = max(last or 0, seed(conn) or 0)
+        return (last or 0) + 1
+    finally:
+        conn.close()
+
+
+def advance_code_counter(name, value=None, seed=None):
+    """
+    Make sure that the counter name doesn't reserve value or anything
+    less than value.
+
+    :param name: the name of the counter
+    :param value: the last value that is used, if None then the value
+      returned by seed is used
+    :param seed: see reserve_codes()
+    """
+    t = CodeCounter.__table__
+    def advance(conn):
+        last = value
+        if last is None:
+            last = seed(conn) or 0
+        current = conn.execute(sa.select([t.c.value],
+                                         t.c.name == name)).scalar()
+        if current is None:
+            if value is not None and seed is not None:
+                last = max(last, seed(conn) or 0)
+            conn.execute(t.insert(), name=name, value=last)
+        elif current < last:
+            conn.execute(t.update(sa.and_(t.c.name == name, t.c.value < last),
+                                  values={t.c.value: last}))
+    _counter_transaction(advance)
+
+
+def check_code_counters():
+    """
+    Create the code_counter table if it doesn't exist.
+    """
+    try:
+        CodeCounter.__table__.create(bind=engine, checkfirst=True)
+    except Exception, e:
+        warning('check_code_counters(): %s' % utils.utf8(e))
+
+
+def check_history_indexes():
+    """
+    Create the indexes on the history table that are missing from
+    databases created before the indexes were added.
+    """
+    from sqlalchemy.engine.reflection import Inspector
+    try:
+        inspector = Inspector.from_engine(engine)
+        existing = set([ix['name'] for ix in \
+                            inspector.get_indexes(History.__tablename__)])
+        for index in history_indexes:
+            if index.name not in existing:
+                debug('creating index %s' % index.name)
+                index.create(bind=engine)
+    except Exception, e:
+        warning('check_history_indexes(): %s' % utils.utf8(e))
+
+
+def prefix_like(column, prefix):
+    """
+    Return a case insensitive clause for the values of column that
+    start with prefix.  The clause can use the index created by
+    :func:`check_prefix_indexes` on PostgreSQL and SQLite.
+
+    :param column: a column or mapped attribute
+    :param prefix: the string the values should start with
+    """
+    prefix = utils.utf8(prefix)
+    if engine.name == 'postgresql':
+        return sa.func.lower(column).like(u'%s%%' % prefix.lower())
+    elif engine.name == 'sqlite':
+        # LIKE is case insensitive in SQLite and can use an index
+        # with the NOCASE collation
+        return column.like(u'%s%%' % prefix)
+    return utils.ilike(column, u'%s%%' % prefix)
+
+
+def check_prefix_indexes(columns):
+    """
+    Create the case insensitive indexes for :func:`prefix_like` on
+    columns if they don't exist.  Only PostgreSQL and SQLite are
+    supported, on other databases this does nothing.
+
+    :param columns: a list of table columns
+    """
+    if engine.name == 'postgresql':
+        exists = 'SELECT 1 FROM pg_indexes WHERE indexname = :name'
+        expr = 'lower(%s) text_pattern_ops'
+    elif engine.name == 'sqlite':
+        exists = "SELECT 1 FROM sqlite_master WHERE type = 'index' " \
+            "AND name = :name"
+        expr = '%s COLLATE NOCASE'
+    else:
+        return
+    for column in columns:
+        table_name = column.table.name
+        name = 'ix_%s_%s_prefix' % (table_name, column.name)
+        try:
+            if engine.execute(sa.text(exists), name=name).fetchone():
+                continue
+            debug('creating index %s' % name)
+            engine.execute('CREATE INDEX %s ON %s (%s)' \
+                               % (name, table_name, expr % column.name))
+        except Exception, e:
+            warning('check_prefix_indexes(): %s' % utils.utf8(e))
+
+
+class PingListener(PoolListener):
+    """
+    Test that a connection is still alive when it is checked out of
+    the pool so that connections dropped by the server are replaced
+    instead of raising an error in the middle of a session.
+    """
+
+    def checkout(self, dbapi_con, con_record, con_proxy):
+        cursor = dbapi_con.cursor()
+        try:
+            try:
+                cursor.execute('SELECT 1')
+            except Exception, e:
+                # the pool will try again with a new connection
+                raise sa.exc.DisconnectionError(utils.utf8(e))
+        finally:
+            cursor.close()
+
+
+def _pool_args(uri):
+    """
+    Return the pool keyword arguments to pass to create_engine() for uri.
+
+    PostgreSQL databases are usually shared by several users so they
+    get a QueuePool configured from the prefs, see
+    :data:`bauble.prefs.pool_size_pref`.
+    """
+    import sqlalchemy.pool as pool
+    url = sa.engine.url.make_url(uri)
+    if not url.drivername.startswith('postgres'):
+        # use the SingletonThreadPool so that we always use the same
+        # connection in a thread, not sure how this is different than
+        # the threadlocal strategy but it doesn't cause as many lockups
+        return dict(poolclass=pool.SingletonThreadPool)
+
+    import bauble.prefs as prefs
+    def get(name, default):
+        try:
+            return prefs.prefs.get(name, default)
+        except AttributeError:
+            # the prefs haven't been initialized, e.g. in the tests
+            return default
+    args = dict(poolclass=pool.QueuePool,
+                pool_size=int(get(prefs.pool_size_pref, 5)),
+                max_overflow=int(get(prefs.pool_max_overflow_pref, 10)),
+                pool_recycle=int(get(prefs.pool_recycle_pref, 3600)))
+    if get(prefs.pool_pre_ping_pref, False):
+        args['listeners'] = [PingListener()]
+    return args
+
+
+def pool_status():
+    """
+    Return a list of (name, value) tuples describing the state of the
+    connection pool of the current engine.
+    """
+    import sqlalchemy.pool as pool
+    if engine is None:
+        return []
+    p = engine.pool
+    status = [(_('Pool'), p.__class__.__name__)]
+    if isinstance(p, pool.QueuePool):
+        status.extend([(_('Size'), p.size()),
+                       (_('Checked in'), p.checkedin()),
+                       (_('Checked out'), p.checkedout()),
+                       (_('Overflow'), p.overflow())])
+    else:
+        status.append((_('Status'), p.status()))
+    return status
+
+
+def with_session(func):
+    """
+    A decorator for functions that take a session keyword argument.
+
+    If the caller doesn't pass a session then a new session is created
+    for the call and closed when the function returns so the function
+    can either share the caller's session or manage its own, e.g. ::
+
+      @with_session
+      def count_plants(session=None):
+          return session.query(Plant).count()
+    """
+    def wrapper(*args, **kwargs):
+        if kwargs.get('session', None) is not None:
+            return func(*args, **kwargs)
+        session = Session()
+        kwargs['session'] = session
+        try:
+            return func(*args, **kwargs)
+        finally:
+            session.close()
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
 
 def open(uri, verify=True, show_error_dialogs=False):
     """
@@ -208,20 +1222,21 @@ def open(uri, verify=True, show_error_dialogs=False):
     global engine
     new_engine = None
 
-    # use the SingletonThreadPool so that we always use the same
-    # connection in a thread, not sure how this is different than
-    # the threadlocal strategy but it doesn't cause as many lockups
-    import sqlalchemy.pool as pool
     new_engine = sa.create_engine(uri, echo=SQLALCHEMY_DEBUG,
                                   implicit_returning=False,
-                                  poolclass=pool.SingletonThreadPool)
+                                  **_pool_args(uri))
     new_engine.connect().close() # make sure we can connect
     def _bind():
         """bind metadata to engine and create sessionmaker """
         global Session, engine
         engine = new_engine
         metadata.bind = engine # make engine implicit for metadata
-        Session = sessionmaker(bind=engine, autoflush=False)
+        Session = sessionmaker(bind=engine, autoflush=False,
+                               extension=[history_writer] + \
+                                   session_extensions)
+        # move the history queue to the new engine
+        if history_writer.queue is not None:
+            set_history_queue(HistoryQueue(engine))
 
     if new_engine is not None and not verify:
         _bind()
@@ -231,6 +1246,8 @@ def open(uri, verify=True, show_error_dialogs=False):
 
     verify_connection(new_engine, show_error_dialogs)
     _bind()
+    check_history_indexes()
+    check_code_counters()
     return engine
 
 
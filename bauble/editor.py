@@ -175,6 +175,126 @@ def default_completion_match_func(completion, key_string, treeiter):
 
 
 
+class Completions(list):
+    """
+    A list of completions returned by a get_completions function.  If
+    complete is False then the list was truncated and
+    :meth:`GenericEditorPresenter.assign_completions_handler` asks
+    for the completions again when more text is entered.
+    """
+    complete = True
+
+
+
+# all the PrefixCompletions so their caches can be cleared together
+_prefix_completions = weakref.WeakValueDictionary()
+
+def clear_completions():
+    """
+    Clear the cached results of all the :class:`PrefixCompletions`,
+    e.g. after the database has changed.
+    """
+    for completions in _prefix_completions.values():
+        completions.clear()
+
+
+
+class PrefixCompletions(object):
+    """
+    Return the instances of a mapped class where a column starts with
+    a prefix for the completions on an editor entry.
+
+    Only the ids and column values of at most limit rows are queried
+    for a prefix.  These are cached by the lower cased prefix and
+    shared by all the editors.  If the results for a prefix weren't
+    truncated then the results for a longer prefix are filtered from
+    them instead of querying the database again.
+
+    :param cls: the mapped class to return
+    :param column: the column to match the prefix against
+    :param join: an optional relation to join to get to column
+    """
+
+    limit = 100
+    """The maximum number of rows to return for a prefix."""
+
+    max_prefixes = 200
+    """The maximum number of prefixes to cache."""
+
+    def __init__(self, cls, column, join=None):
+        self.cls = cls
+        self.column = column
+        self.join = join
+        self.cache = utils.LRUCache(self.max_prefixes)
+        self._engine = None
+        _prefix_completions[id(self)] = self
+
+
+    def clear(self):
+        self.cache.clear()
+
+
+    def get_keys(self, prefix):
+        """
+        Return a tuple of (rows, complete) for prefix where rows is
+        a list of (id, value) tuples ordered by value.
+        """
+        if self._engine is not db.engine:
+            self.cache.clear()
+            self._engine = db.engine
+        key = utils.utf8(prefix).lower()
+        if key in self.cache:
+            return self.cache[key]
+        # filter the results of the longest cached prefix if they
+        # weren't truncated
+        for i in xrange(len(key)-1, 0, -1):
+            if key[:i] not in self.cache:
+                continue
+            rows, complete = self.cache[key[:i]]
+            if complete:
+                rows = [r for r in rows \
+                            if utils.utf8(r[1]).lower().startswith(key)]
+                self.cache[key] = rows, True
+                return rows, True
+            break
+        session = db.Session()
+        try:
+            query = session.query(self.cls.id, self.column)
+            if self.join:
+                query = query.join(self.join)
+            query = query.filter(db.prefix_like(self.column, prefix)).\
+                order_by(self.column, self.cls.id).limit(self.limit+1)
+            rows = [tuple(r) for r in query]
+        finally:
+            session.close()
+        complete = len(rows) <= self.limit
+        self.cache[key] = rows[:self.limit], complete
+        return self.cache[key]
+
+
+    def get(self, session, prefix, exclude=None):
+        """
+        Return a :class:`Completions` of the instances that match
+        prefix loaded in session.
+
+        :param session: the session to load the instances in
+        :param prefix: the string the column values should start with
+        :param exclude: a list of ids to leave out of the completions
+        """
+        rows, complete = self.get_keys(prefix)
+        exclude = set(exclude or [])
+        ids = [r[0] for r in rows if r[0] not in exclude]
+        completions = Completions()
+        completions.complete = complete
+        if not ids:
+            return completions
+        objs = dict([(obj.id, obj) for obj in session.query(self.cls).\
+                         filter(self.cls.id.in_(ids))])
+        completions.extend([objs[i] for i in ids if i in objs])
+        return completions
+
+
+
 class GenericEditorView(object):
     """
     An generic object meant to be extended to provide the view for a
@@ -689,7 +809,10 @@ class GenericEditorPresenter(object):
         :param widget: a gtk.Entry instance or widget name
 
         :param get_completions: the method to call when a list of
-          completions is requested, returns a list of completions
+          completions is requested, returns a list of completions, if
+          it returns a :class:`Completions` that isn't complete then
+          it is called again with the full text of the entry when
+          more text is entered
 
         :param on_select: callback for when a value is selected from
           the list of completions
@@ -697,23 +820,32 @@ class GenericEditorPresenter(object):
         if not isinstance(widget, gtk.Entry):
             widget = self.view.widgets[widget]
         PROBLEM = hash(widget.get_name())
+        # the prefix and completeness of the current completions
+        state = dict(prefix=None, complete=True, request=0)
         def add_completions(text):
             if get_completions is None:
                 # get_completions is None usually means that the
                 # completions model already has a static list of
                 # completions
                 return
-            # get the completions using [0:key_length] as the start of
-            # the string
+            state['request'] += 1
+            request = state['request']
             def idle_callback(values):
+                # drop the completions if another request was made or
+                # the text doesn't match them anymore
+                entry_text = utils.utf8(widget.get_text()).lower()
+                if request != state['request'] or \
+                        not entry_text.startswith(text.lower()):
+                    return
                 completion = widget.get_completion()
                 utils.clear_model(completion)
                 completion_model = gtk.ListStore(object)
                 for v in values:
                     completion_model.append([v])
                 completion.set_model(completion_model)
-            key_length = widget.get_completion().props.minimum_key_length
-            values = get_completions(text[:key_length])
+            values = get_completions(text)
+            state['prefix'] = text
+            state['complete'] = getattr(values, 'complete', True)
             gobject.idle_add(idle_callback, values)
 
         def on_changed(entry, *args):
@@ -742,10 +874,19 @@ class GenericEditorPresenter(object):
                 self.add_problem(PROBLEM, widget)
                 on_select(None)
 
+            # get the completions using [0:key_length] as the start
+            # of the string, if those completions were truncated then
+            # get them again for the full text
             key_length = widget.get_completion().props.minimum_key_length
-            if (not comp_model and len(text)>key_length) or \
-                    len(text) == key_length:
-                add_completions(text)
+            prefix = state['prefix']
+            utext = utils.utf8(text)
+            if len(utext) < key_length:
+                pass
+            elif prefix is None or not comp_model or \
+                    not utext.lower().startswith(prefix.lower()):
+                add_completions(utext[:key_length])
+            elif not state['complete'] and len(utext) > len(prefix):
+                add_completions(utext)
 
             # if entry is empty select nothing and remove all problem
             if text == '':
@@ -898,6 +1039,7 @@ class GenericModelViewPresenterEditor(object):
             self.session.rollback()
             self.session.add_all(objs)
             raise
+        clear_completions()
         return True
 
 
@@ -18,7 +18,12 @@ import types
 import os
 import re
 import sys
+import time
 import traceback
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 import gtk
 from sqlalchemy import *
@@ -30,7 +35,7 @@ import bauble.db as db
 from bauble.error import BaubleError
 import bauble.paths as paths
 import bauble.utils as utils
-from bauble.utils.log import debug, warning, error
+from bauble.utils.log import debug, info, warning, error
 
 # TODO: should make plugins and ordered dict that is sorted by
 # dependency, maybe use odict from
@@ -41,6 +46,14 @@ from bauble.utils.log import debug, warning, error
 plugins = {}
 commands = {}
 
+# the number of seconds it took to import each plugin module and to
+# initialize each plugin, keyed by the module and plugin names
+timings = {}
+
+# module name -> list of LazyPlugin for the plugin modules that
+# haven't been imported yet
+_lazy_modules = {}
+
 
 def register_command(handler):
     """
@@ -131,6 +144,55 @@ def load(path=None):
 
 
 
+def _init_plugin(plugin):
+    """
+    Call plugin.init() and record how long it took.
+    """
+    if isinstance(plugin, LazyPlugin):
+        return
+    start = time.time()
+    plugin.init()
+    timings[plugin.__class__.__name__] = time.time() - start
+
+
+def _resolve(plugin):
+    """
+    Return the real plugin for plugin if plugin is a LazyPlugin.
+    """
+    if isinstance(plugin, LazyPlugin):
+        load_module(plugin.module_name)
+        return plugins[plugin.__name__]
+    return plugin
+
+
+def load_module(module_name):
+    """
+    Import the module of a lazy plugin, replace its LazyPlugins in the
+    plugins dict with the real plugins and initialize them.
+
+    This is called the first time one of the tools or commands of a
+    lazy plugin is used.
+
+    :param module_name: the name of the plugin module
+    """
+    if module_name not in _lazy_modules:
+        return
+    start = time.time()
+    mod = __import__(module_name, globals(), locals(), [module_name], -1)
+    timings[module_name] = time.time() - start
+    del _lazy_modules[module_name]
+    loaded = _get_module_plugins(mod)
+    for plugin in loaded:
+        plugins[plugin.__class__.__name__] = plugin
+    for plugin in loaded:
+        _init_plugin(plugin)
+        for cmd in plugin.commands or []:
+            register_command(cmd)
+    debug('loaded %s in %.3fs' % (module_name, time.time() - start))
+    if bauble.gui:
+        bauble.gui.build_tools_menu()
+
+
 def init(force=False):
     """
     Initialize the plugin manager.
@@ -170,10 +232,11 @@ def init(force=False):
                         % ', '.join([p.__class__.__name__ for p in not_installed]))
             if force or utils.yes_no_dialog(msg):
                 install([p for p in not_installed])
+                registered_names = PluginRegistry.names()
 
         # sort plugins in the registry by their dependencies
         not_registered = []
-        for name in PluginRegistry.names():
+        for name in registered_names:
             try:
                 registered.append(plugins[name])
             except KeyError, e:
@@ -200,10 +263,10 @@ def init(force=False):
                                 'indirectly rely on each other'))
 
     # call init() for each ofthe plugins
-    for plugin in ordered:
+    for plugin in ordered[:]:
         #debug('init: %s' % plugin)
         try:
-            plugin.init()
+            _init_plugin(plugin)
         except KeyError, e:
             # don't remove the plugin from the registry because if we
             # find it again the user might decide to reinstall it
@@ -226,6 +289,10 @@ def init(force=False):
                                          gtk.MESSAGE_ERROR)
 
 
+    info('plugins: %s' % ', '.join(['%s %.3fs' % (name, seconds) \
+                                       for name, seconds in \
+                                       sorted(timings.items())]))
+
     # register the plugin commands seperately from the plugin initialization
     for plugin in ordered:
         if plugin.commands in (None, []):
@@ -264,6 +331,8 @@ def install(plugins_to_install, import_defaults=True, force=False):
         to_install = plugins.values()
     else:
         to_install = plugins_to_install
+    # lazy plugins are imported so the real plugins are installed
+    to_install = [_resolve(p) for p in to_install]
 
     if len(to_install) == 0:
         # no plugins to install
@@ -418,12 +487,18 @@ class Plugin(object):
       e.g dict('cmd', lambda x: handler)
     description:
       a short description of the plugin
+    lazy:
+      if True then the plugin module isn't imported at startup but
+      the first time one of its tools or commands is used, a lazy
+      plugin shouldn't define any tables or change anything in init()
+      that other plugins rely on
     """
     commands = []
     tools = []
     depends = []
     description = ''
     version = '0.0'
+    lazy = False
 
     @classmethod
     def __init__(cls):
@@ -492,6 +567,154 @@ class CommandHandler(object):
         raise NotImplementedError
 
 
+class LazyPlugin(object):
+    """
+    A placeholder for a plugin whose module hasn't been imported yet.
+
+    The LazyPlugin is created from the plugin manifest and provides
+    the tools and commands of the plugin.  The module is imported with
+    load_module() the first time one of them is used.
+
+    :param module_name: the name of the plugin module
+    :param info: the dict for the plugin from the manifest
+    """
+
+    def __init__(self, module_name, info):
+        self.module_name = module_name
+        self.__name__ = info['name']
+        self.depends = info['depends']
+        self.version = info['version']
+        self.description = info['description']
+        self.tools = [LazyTool(module_name, tool) for tool in info['tools']]
+        self.commands = [_lazy_command_handler(module_name, cmd) \
+                             for cmd in info['commands']]
+
+
+    def init(self):
+        # the plugin is initialized when its module is imported
+        pass
+
+
+    def install(self, import_defaults=True):
+        _resolve(self).install(import_defaults=import_defaults)
+
+
+
+class LazyTool(object):
+    """
+    A placeholder for a Tool of a LazyPlugin.
+    """
+
+    def __init__(self, module_name, info):
+        self.module_name = module_name
+        self.__name__ = info['name']
+        self.category = info['category']
+        self.label = info['label']
+        self.enabled = info['enabled']
+
+
+    def start(self):
+        load_module(self.module_name)
+        for plugin in plugins.values():
+            for tool in plugin.tools:
+                if tool.__name__ == self.__name__ and tool is not self:
+                    return tool.start()
+        raise BaubleError(_('Could not find the tool %s') % self.label)
+
+
+
+class LazyCommandHandler(CommandHandler):
+    """
+    The base class for the command handlers of a LazyPlugin.  Creating
+    a LazyCommandHandler imports the plugin module and returns the real
+    command handler.
+    """
+    module_name = None
+
+    def __new__(cls, *args, **kwargs):
+        load_module(cls.module_name)
+        handler = commands[cls.command[0]]
+        if issubclass(handler, LazyCommandHandler):
+            raise BaubleError(_('Could not find the command handler for %s') \
+                                  % cls.command[0])
+        return handler(*args, **kwargs)
+
+
+def _lazy_command_handler(module_name, command):
+    """
+    Return a subclass of LazyCommandHandler for the commands in
+    command.
+    """
+    return type('LazyCommandHandler', (LazyCommandHandler,),
+                {'module_name': module_name, 'command': command})
+
+
+def _manifest_path():
+    return os.path.join(paths.user_dir(), 'plugins.manifest')
+
+
+def _read_manifest():
+    """
+    Return the plugin manifest or an empty dict if there isn't a
+    manifest for this version of Bauble.
+    """
+    try:
+        f = open(_manifest_path())
+        try:
+            manifest = json.load(f)
+        finally:
+            f.close()
+    except Exception, e:
+        return {}
+    if manifest.get('version', None) != bauble.version:
+        return {}
+    return manifest.get('modules', {})
+
+
+def _write_manifest(modules):
+    try:
+        f = open(_manifest_path(), 'w')
+        try:
+            json.dump({'version': bauble.version, 'modules': modules}, f)
+        finally:
+            f.close()
+    except Exception, e:
+        warning('could not write the plugin manifest: %s' % utils.utf8(e))
+
+
+def _module_mtime(path, module_name):
+    """
+    Return the time of the newest file in the package module_name.
+    """
+    if path.find('library.zip') != -1:
+        return os.path.getmtime(path)
+    mtime = 0
+    module_dir = os.path.join(path, *module_name.split('.')[2:])
+    for dir, subdir, files in os.walk(module_dir):
+        for f in files:
+            mtime = max(mtime, os.path.getmtime(os.path.join(dir, f)))
+    return mtime
+
+
+def _plugin_info(plugin):
+    """
+    Return the dict that describes plugin in the manifest.
+    """
+    cmds = []
+    for handler in plugin.commands or []:
+        if isinstance(handler.command, str):
+            cmds.append([handler.command])
+        else:
+            cmds.append(list(handler.command))
+    tools = [{'name': tool.__name__, 'category': tool.category,
+              'label': tool.label, 'enabled': tool.enabled} \
+                 for tool in plugin.tools or []]
+    return {'name': plugin.__class__.__name__,
+            'depends': list(plugin.depends), 'version': plugin.version,
+            'description': plugin.description, 'tools': tools,
+            'commands': cmds}
+
+
 def _find_module_names(path):
     '''
     :param path: where to look for modules
@@ -514,9 +737,42 @@ def _find_module_names(path):
     return modules
 
 
+def _get_module_plugins(mod):
+    """
+    Return the plugins provided by the module mod.
+    """
+    plugins = []
+    if not hasattr(mod, "plugin"):
+        return plugins
+
+    # if mod.plugin is a function it should return a plugin or list of
+    # plugins
+    try:
+        mod_plugin = mod.plugin()
+    except:
+        mod_plugin = mod.plugin
+
+    is_plugin = lambda p: isinstance(p, (type, types.ClassType)) and issubclass(p, Plugin)
+    if isinstance(mod_plugin, (list, tuple)):
+        for p in mod_plugin:
+            if is_plugin(p) or True:
+                plugins.append(p)
+    elif is_plugin(mod_plugin) or True:
+        plugins.append(mod_plugin)
+    else:
+        warning(_('%s.plugin is not an instance of pluginmgr.Plugin'\
+                  % mod.__name__))
+    return plugins
+
+
 def _find_plugins(path):
     """
     Return the plugins at path.
+
+    The plugin modules are listed in a manifest in the user directory.
+    The modules whose plugins are all lazy aren't imported if their
+    files haven't changed since the manifest was written, a LazyPlugin
+    is returned for each of their plugins instead.
     """
     plugins = []
     import bauble.plugins
@@ -529,38 +785,47 @@ def _find_plugins(path):
     else:
         plugin_names =['bauble.plugins.%s'%m for m in _find_module_names(path)]
 
+    manifest = _read_manifest()
+    changed = False
     for name in plugin_names:
         mod = None
+        mtime = _module_mtime(path, name)
+        entry = manifest.get(name, None)
         # Fast path: see if the module has already been imported.
 
         if name in sys.modules:
             mod = sys.modules[name]
+        elif entry and entry['mtime'] == mtime and entry['lazy']:
+            lazy = [LazyPlugin(name, p) for p in entry['plugins']]
+            if lazy:
+                _lazy_modules[name] = lazy
+                plugins.extend(lazy)
+            continue
         else:
             try:
+                start = time.time()
                 mod = __import__(name, globals(), locals(), [name], -1)
+                timings[name] = time.time() - start
             except Exception, e:
                 msg = _('Could not import the %(module)s module.\n\n'\
                         '%(error)s' % {'module': name, 'error': e})
                 debug(msg)
                 errors[name] = sys.exc_info()
-        if not hasattr(mod, "plugin"):
-            continue
-
-        # if mod.plugin is a function it should return a plugin or list of
-        # plugins
-        try:
-            mod_plugin = mod.plugin()
-        except:
-            mod_plugin = mod.plugin
-
-        is_plugin = lambda p: isinstance(p, (type, types.ClassType)) and issubclass(p, Plugin)
-        if isinstance(mod_plugin, (list, tuple)):
-            for p in mod_plugin:
-                if is_plugin(p) or True:
-                    plugins.append(p)
-        elif is_plugin(mod_plugin) or True:
-            plugins.append(mod_plugin)
-        else:
-            warning(_('%s.plugin is not an instance of pluginmgr.Plugin'\
-                      % mod.__name__))
+                continue
+
+        mod_plugins = _get_module_plugins(mod)
+        plugins.extend(mod_plugins)
+        # a module without plugins, e.g. bauble.plugins.report.xsl,
+        # is never lazy since no LazyPlugin would ever import it
+        lazy = len(mod_plugins) > 0 and \
+            len([p for p in mod_plugins \
+                     if not getattr(p, 'lazy', False)]) == 0
+        new_entry = {'mtime': mtime, 'lazy': lazy,
+                     'plugins': [_plugin_info(p) for p in mod_plugins]}
+        if new_entry != entry:
+            manifest[name] = new_entry
+            changed = True
+
+    if changed:
+        _write_manifest(manifest)
     return plugins, errors
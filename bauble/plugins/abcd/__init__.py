@@ -154,14 +154,10 @@ class ABCDAdapter(object):
 
 
 
-def create_abcd(decorated_objects, authors=True, validate=True):
+def get_institution():
     """
-    :param objects: a list/tuple of objects that implement the ABCDDecorator
-      interface
-    :param authors: flag to control whether to include the authors in the
-      species name
-    :param validate: whether we should validate the data before returning
-    :returns: a valid ABCD ElementTree
+    Return the institution information and ask the user to fill it in
+    if it isn't complete.
     """
     import bauble.plugins.garden.institution as institution
     inst = institution.Institution()
@@ -172,10 +168,15 @@ def create_abcd(decorated_objects, authors=True, validate=True):
                 'Code fields are filled in.')
         utils.message_dialog(msg)
         institution.InstitutionEditor().start()
-        return create_abcd(decorated_objects, authors, validate)
+        return get_institution()
+    return inst
 
-    datasets = DataSets()
-    ds = ABCDElement(datasets, 'DataSet')
+
+def _add_metadata(ds, inst):
+    """
+    Add the contacts and metadata elements for inst to the DataSet
+    element ds.
+    """
     tech_contacts = ABCDElement(ds, 'TechnicalContacts')
     tech_contact = ABCDElement(tech_contacts, 'TechnicalContact')
 
@@ -196,72 +197,100 @@ def create_abcd(decorated_objects, authors=True, validate=True):
     revision = ABCDElement(metadata, 'RevisionData')
     ABCDElement(revision, 'DateModified', text='2001-03-01T00:00:00')
     title = ABCDElement(representation, 'Title', text='TheTitle')
-    units = ABCDElement(ds, 'Units')
 
-    # build the ABCD unit
-    for obj in decorated_objects:
-        unit = ABCDElement(units, 'Unit')
-        ABCDElement(unit, 'SourceInstitutionID', text=inst.inst_code)
-
-        # TODO: don't really understand the SourceID element
-        ABCDElement(unit, 'SourceID', text='Bauble')
 
-        unit_id = ABCDElement(unit, 'UnitID', text=obj.get_UnitID())
-        ABCDElement(unit, 'DateLastEdited', text=obj.get_DateLastEdited())
-
-        # TODO: add list of verifications to Identifications
+def ABCDUnit(obj, inst, authors=True):
+    """
+    Return a new Unit element for obj.
 
-        # scientific name identification
-        identifications = ABCDElement(unit, 'Identifications')
+    :param obj: an object that implements the ABCDAdapter interface
+    :param inst: the institution
+    :param authors: flag to control whether to include the authors in the
+      species name
+    """
+    unit = Element('{%s}Unit' % namespaces['abcd'], nsmap=namespaces)
+    ABCDElement(unit, 'SourceInstitutionID', text=inst.inst_code)
+
+    # TODO: don't really understand the SourceID element
+    ABCDElement(unit, 'SourceID', text='Bauble')
+
+    unit_id = ABCDElement(unit, 'UnitID', text=obj.get_UnitID())
+    ABCDElement(unit, 'DateLastEdited', text=obj.get_DateLastEdited())
+
+    # TODO: add list of verifications to Identifications
+
+    # scientific name identification
+    identifications = ABCDElement(unit, 'Identifications')
+    identification = ABCDElement(identifications, 'Identification')
+    result = ABCDElement(identification, 'Result')
+    taxon_identified = ABCDElement(result, 'TaxonIdentified')
+    higher_taxa = ABCDElement(taxon_identified, 'HigherTaxa')
+    higher_taxon = ABCDElement(higher_taxa, 'HigherTaxon')
+
+    # TODO: ABCDDecorator should provide an iterator so that we can
+    # have multiple HigherTaxonName's
+    higher_taxon_name = ABCDElement(higher_taxon, 'HigherTaxonName',
+                                    text=obj.get_family())
+    higher_taxon_rank = ABCDElement(higher_taxon, 'HigherTaxonRank',
+                                    text='familia')
+
+    scientific_name = ABCDElement(taxon_identified, 'ScientificName')
+    ABCDElement(scientific_name, 'FullScientificNameString',
+                   text=obj.get_FullScientificNameString(authors))
+
+    name_atomised = ABCDElement(scientific_name, 'NameAtomised')
+    botanical = ABCDElement(name_atomised, 'Botanical')
+    ABCDElement(botanical, 'GenusOrMonomial',
+                   text=obj.get_GenusOrMonomial())
+    ABCDElement(botanical, 'FirstEpithet', text=obj.get_FirstEpithet())
+    author_team = obj.get_AuthorTeam()
+    if author_team is not None:
+        ABCDElement(botanical, 'AuthorTeam', text=author_team)
+    ABCDElement(identification, 'PreferredFlag', text='true')
+
+    # vernacular name identification
+    # TODO: should we include all the vernacular names or only the default
+    # one
+    vernacular_name = obj.get_InformalNameString()
+    if vernacular_name is not None:
         identification = ABCDElement(identifications, 'Identification')
         result = ABCDElement(identification, 'Result')
         taxon_identified = ABCDElement(result, 'TaxonIdentified')
-        higher_taxa = ABCDElement(taxon_identified, 'HigherTaxa')
-        higher_taxon = ABCDElement(higher_taxa, 'HigherTaxon')
-
-        # TODO: ABCDDecorator should provide an iterator so that we can
-        # have multiple HigherTaxonName's
-        higher_taxon_name = ABCDElement(higher_taxon, 'HigherTaxonName',
-                                        text=obj.get_family())
-        higher_taxon_rank = ABCDElement(higher_taxon, 'HigherTaxonRank',
-                                        text='familia')
-
-        scientific_name = ABCDElement(taxon_identified, 'ScientificName')
-        ABCDElement(scientific_name, 'FullScientificNameString',
-                       text=obj.get_FullScientificNameString(authors))
-
-        name_atomised = ABCDElement(scientific_name, 'NameAtomised')
-        botanical = ABCDElement(name_atomised, 'Botanical')
-        ABCDElement(botanical, 'GenusOrMonomial',
-                       text=obj.get_GenusOrMonomial())
-        ABCDElement(botanical, 'FirstEpithet', text=obj.get_FirstEpithet())
-        author_team = obj.get_AuthorTeam()
-        if author_team is not None:
-            ABCDElement(botanical, 'AuthorTeam', text=author_team)
-        ABCDElement(identification, 'PreferredFlag', text='true')
-
-        # vernacular name identification
-        # TODO: should we include all the vernacular names or only the default
-        # one
-        vernacular_name = obj.get_InformalNameString()
-        if vernacular_name is not None:
-            identification = ABCDElement(identifications, 'Identification')
-            result = ABCDElement(identification, 'Result')
-            taxon_identified = ABCDElement(result, 'TaxonIdentified')
-            ABCDElement(taxon_identified, 'InformalNameString',
-                           text=vernacular_name)
-
-        # add all the extra non standard elements
-        obj.extra_elements(unit)
-        # TODO: handle verifiers/identifiers
-        # TODO: RecordBasis
-
-        # notes are last in the schema and extra_elements() shouldn't
-        # add anything that comes past Notes, e.g. RecordURI,
-        # EAnnotations, UnitExtension
-        notes = obj.get_Notes()
-        if notes:
-            ABCDElement(unit, 'Notes', text=notes)
+        ABCDElement(taxon_identified, 'InformalNameString',
+                       text=vernacular_name)
+
+    # add all the extra non standard elements
+    obj.extra_elements(unit)
+    # TODO: handle verifiers/identifiers
+    # TODO: RecordBasis
+
+    # notes are last in the schema and extra_elements() shouldn't
+    # add anything that comes past Notes, e.g. RecordURI,
+    # EAnnotations, UnitExtension
+    notes = obj.get_Notes()
+    if notes:
+        ABCDElement(unit, 'Notes', text=notes)
+    return unit
+
+
+def create_abcd(decorated_objects, authors=True, validate=True):
+    """
+    :param objects: a list/tuple of objects that implement the ABCDDecorator
+      interface
+    :param authors: flag to control whether to include the authors in the
+      species name
+    :param validate: whether we should validate the data before returning
+    :returns: a valid ABCD ElementTree
+    """
+    inst = get_institution()
+    datasets = DataSets()
+    ds = ABCDElement(datasets, 'DataSet')
+    _add_metadata(ds, inst)
+    units = ABCDElement(ds, 'Units')
+
+    # build the ABCD unit
+    for obj in decorated_objects:
+        units.append(ABCDUnit(obj, inst, authors))
 
     if validate:
         check(validate_xml(datasets), 'ABCD data not valid')
@@ -269,6 +298,44 @@ def create_abcd(decorated_objects, authors=True, validate=True):
     return ElementTree(datasets)
 
 
+def write_abcd(decorated_objects, f, authors=True):
+    """
+    Write the ABCD data for decorated_objects to f.
+
+    Each Unit is written to f as soon as it is created so
+    decorated_objects can be a generator and the whole document is
+    never held in memory.
+
+    :param decorated_objects: an iterable of objects that implement
+      the ABCDAdapter interface
+    :param f: a file-like object opened for writing
+    :param authors: flag to control whether to include the authors in the
+      species name
+    :returns: the number of units written
+    """
+    inst = get_institution()
+    datasets = DataSets()
+    ds = ABCDElement(datasets, 'DataSet')
+    _add_metadata(ds, inst)
+    units = ABCDElement(ds, 'Units')
+
+    # serialize the document around a placeholder in the Units
+    # element so the units can be written between its start and end
+    # tags
+    placeholder = '<!--units-->'
+    units.append(etree.Comment('units'))
+    head, tail = etree.tostring(datasets, encoding='utf-8',
+                                xml_declaration=True).split(placeholder)
+    f.write(head)
+    nunits = 0
+    for obj in decorated_objects:
+        f.write(etree.tostring(ABCDUnit(obj, inst, authors),
+                               encoding='utf-8', xml_declaration=False))
+        nunits += 1
+    f.write(tail)
+    return nunits
+
+
 
 class ABCDExporter(object):
     """
@@ -346,6 +413,7 @@ class ABCDExportTool(pluginmgr.Tool):
 class ABCDImexPlugin(pluginmgr.Plugin):
     tools = [ABCDExportTool]
     depends = ["PlantsPlugin"]
+    lazy = True
 
 try:
     import lxml.etree as etree
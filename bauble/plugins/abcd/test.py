@@ -103,6 +103,32 @@ class ABCDTestCase(BaubleTestCase):
         xml = abcd.ABCDExporter().start(filename)
 
 
+    def test_write_abcd(self):
+        """
+        Test that write_abcd() writes the same units as create_abcd()
+        """
+        from bauble.plugins.garden import Institution
+        from bauble.plugins.report.xsl import PlantABCDAdapter
+        inst = Institution()
+        inst.inst_name = inst.inst_code = inst.inst_contact = \
+            inst.inst_technical_contact = inst.inst_email = 'test'
+        inst.write()
+        plants = self.session.query(Plant).all()
+        data = abcd.create_abcd([PlantABCDAdapter(p) for p in plants],
+                                validate=False)
+        dummy, filename = tempfile.mkstemp()
+        f = open(filename, 'w')
+        nunits = abcd.write_abcd((PlantABCDAdapter(p) for p in plants), f)
+        f.close()
+        written = etree.parse(filename)
+        os.remove(filename)
+        path = '//{%s}UnitID' % abcd.namespaces['abcd']
+        expected = [el.text for el in data.iterfind(path)]
+        unit_ids = [el.text for el in written.iterfind(path)]
+        self.assert_(nunits == len(plants), nunits)
+        self.assert_(unit_ids == expected, unit_ids)
+
+
     def test_plants_to_abcd(self):
         plants = self.session.query(Plant)
         assert plants.count() > 0
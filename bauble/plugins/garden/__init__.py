@@ -4,6 +4,7 @@
 
 import os, sys
 import bauble
+import bauble.db as db
 import bauble.utils as utils
 import bauble.pluginmgr as pluginmgr
 from bauble.view import SearchView
@@ -20,8 +21,16 @@ from bauble.utils.log import debug
 # - cultivation table
 # - conservation table
 
-def natsort_kids(kids):
-    return lambda(parent): sorted(getattr(parent, kids),key=utils.natsort_key)
+def plant_kids(column):
+    """
+    Return a function that returns the plants where column is the id
+    of the parent sorted by the plant sort key.
+    """
+    def get_kids(parent):
+        session = object_session(parent)
+        return session.query(Plant).filter(column == parent.id).\
+            order_by(db.sort_key_column(Plant)).all()
+    return get_kids
 
 
 class GardenPlugin(pluginmgr.Plugin):
@@ -37,25 +46,31 @@ class GardenPlugin(pluginmgr.Plugin):
     @classmethod
     def init(cls):
         from bauble.plugins.plants import Species
+        db.add_session_extension(source_detail_session_ext)
         mapper_search = search.get_strategy('MapperSearch')
 
         mapper_search.add_meta(('accession', 'acc'), Accession, ['code'])
-        SearchView.view_meta[Accession].set(children=natsort_kids("plants"),
+        SearchView.view_meta[Accession].set(\
+                                    children=plant_kids(Plant.accession_id),
                                             infobox=AccessionInfoBox,
                                             context_menu=acc_context_menu,
-                                            markup_func=acc_markup_func)
+                                            markup_func=acc_markup_func,
+                            sort_key=lambda: db.sort_key_column(Accession))
 
         mapper_search.add_meta(('location', 'loc'), Location, ['name', 'code'])
-        SearchView.view_meta[Location].set(children=natsort_kids('plants'),
+        SearchView.view_meta[Location].set(\
+                                    children=plant_kids(Plant.location_id),
                                            infobox=LocationInfoBox,
                                            context_menu=loc_context_menu,
-                                           markup_func=loc_markup_func)
+                                           markup_func=loc_markup_func,
+                                           sort_key=Location.code)
 
         mapper_search.add_meta(('plant', 'plants'), Plant, ['code'])
         search.add_strategy(PlantSearch)
         SearchView.view_meta[Plant].set(infobox=PlantInfoBox,
                                         context_menu=plant_context_menu,
-                                        markup_func=plant_markup_func)
+                                        markup_func=plant_markup_func,
+                                    sort_key=lambda: db.sort_key_column(Plant))
 
         mapper_search.add_meta(('contact', 'contacts', 'person', 'org',
                                 'source'), SourceDetail, ['name'])
@@ -69,7 +84,8 @@ class GardenPlugin(pluginmgr.Plugin):
         SearchView.view_meta[SourceDetail].set(children=sd_kids,
                                           infobox=SourceDetailInfoBox,
                                           markup_func=sd_markup_func,
-                                        context_menu=source_detail_context_menu)
+                                        context_menu=source_detail_context_menu,
+                                          sort_key=SourceDetail.name)
 
         mapper_search.add_meta(('collection', 'col', 'coll'),
                                Collection, ['locale'])
@@ -78,7 +94,8 @@ class GardenPlugin(pluginmgr.Plugin):
         SearchView.view_meta[Collection].set(children=coll_kids,
                                              infobox=AccessionInfoBox,
                                              markup_func=coll_markup_func,
-                                           context_menu=collection_context_menu)
+                                           context_menu=collection_context_menu,
+                                             sort_key=Collection.locale)
 
         # done here b/c the Species table is not part of this plugin
         SearchView.view_meta[Species].child = "accessions"
@@ -93,6 +110,9 @@ class GardenPlugin(pluginmgr.Plugin):
         import bauble.meta as meta
         meta.get_default(plant_delimiter_key, default_plant_delimiter)
 
+        db.check_sort_keys([(Accession, accession_sort_key_ext),
+                            (Plant, plant_sort_key_ext)])
+
 
 
 def init_location_comboentry(presenter, combo, on_select, required=True):
@@ -20,6 +20,7 @@ import pango
 from sqlalchemy import *
 from sqlalchemy.orm import *
 from sqlalchemy.orm.session import object_session
+from sqlalchemy.orm.attributes import instance_state
 from sqlalchemy.exc import DBAPIError
 
 import bauble
@@ -36,6 +37,7 @@ from bauble.utils.log import debug, warning
 from bauble.view import InfoBox, InfoExpander, PropertiesExpander, \
      select_in_search_results, Action
 import bauble.view as view
+from bauble.plugins.plants.taxon_stats import TaxonStatsExtension
 
 # TODO: underneath the species entry create a label that shows information
 # about the family of the genus of the species selected as well as more
@@ -98,7 +100,36 @@ def dms_to_decimal(dir, deg, min, sec, precision=6):
     return dec.quantize(nplaces)
 
 
-def get_next_code():
+class _AttrOverride(object):
+    """
+    Wrap an object so that some of its attributes return different
+    values without changing the object.
+    """
+    def __init__(self, obj, **overrides):
+        self.__dict__.update(overrides)
+        self._obj = obj
+
+    def __getattr__(self, name):
+        # only called for attributes that aren't overridden
+        return getattr(self._obj, name)
+
+
+def _max_code(codes, start=''):
+    """
+    Return the largest integer in codes after the prefix start or 0 if
+    none of the codes are integers.
+    """
+    last = 0
+    for code in codes:
+        try:
+            last = max(last, int(code[len(start):]))
+        except ValueError:
+            pass
+    return last
+
+
+@db.with_session
+def get_next_code(session=None, reserve=True):
     """
     Return the next available accession code.  This function should be
     specific to the institution.
@@ -107,27 +138,45 @@ def get_next_code():
     the format: YYYY.CCCC where YYYY is the four digit year and CCCC
     is the four digit code left filled with zeroes
 
+    The code is reserved from the code counter for the current year so
+    the same code is never returned twice.
+
     If there is an error getting the next code the None is returned.
+
+    :param session: the session to use, if None a new session is used
+    :param reserve: if False then the code isn't reserved, e.g. for
+      an editor that reserves it when it is committed
     """
     # auto generate/increment the accession code
-    session = db.Session()
     year = str(datetime.date.today().year)
     start = '%s%s' % (year, Plant.get_delimiter())
-    q = session.query(Accession.code).\
-        filter(Accession.code.startswith(start))
+    counter = 'accession:%s' % year
+    table = Accession.__table__
+    def seed(conn):
+        stmt = select([table.c.code], table.c.code.startswith(start))
+        return _max_code([r[0] for r in conn.execute(stmt)], start)
+    def exists(code):
+        return session.query(Accession.id).filter_by(code=utils.utf8(code)).\
+            first() is not None
     next = None
     try:
-        if q.count() > 0:
-            codes = [int(code[0][len(start):]) for code in q]
-            next = '%s%s' % (start, str(max(codes)+1).zfill(4))
-        else:
-            next = '%s%s0001' % (datetime.date.today().year,
-                                 Plant.get_delimiter())
+        if not reserve:
+            next = '%s%s' % (start, str(db.peek_code(counter, seed=seed)).\
+                                 zfill(4))
+            if exists(next):
+                next = '%s%s' % (start, str(db.peek_code(counter, seed=seed,
+                                                         reseed=True)).zfill(4))
+            return next
+        next = '%s%s' % (start,
+                         str(db.reserve_codes(counter, seed=seed)).zfill(4))
+        if exists(next):
+            # the code was entered by hand, skip past the existing codes
+            db.advance_code_counter(counter, seed=seed)
+            next = '%s%s' % (start,
+                             str(db.reserve_codes(counter)).zfill(4))
     except Exception, e:
-        pass
-        # debug(e)
-    finally:
-        session.close()
+        debug(e)
+        next = None
     return next
 
 def edit_callback(accessions):
@@ -324,6 +373,24 @@ class AccessionMapperExtension(MapperExtension):
         return EXT_CONTINUE
 
 
+
+class AccessionSortKeyExtension(db.SortKeyExtension):
+    """
+    Keep the sort keys for an accession and its plants up to date
+    since the plant sort keys start with the accession code.
+    """
+
+    def after_update(self, mapper, conn, instance):
+        super(AccessionSortKeyExtension, self).after_update(mapper, conn,
+                                                            instance)
+        values = [(p.id, plant_sort_key(p)) for p in instance.plants \
+                      if p.id is not None]
+        db.set_sort_keys(conn, Plant.__tablename__, values)
+        return EXT_CONTINUE
+
+accession_sort_key_ext = AccessionSortKeyExtension(lambda acc: acc.code)
+
+
 prov_type_values = {u'Wild': _('Wild'),
                     u'Cultivated': _('Propagule of cultivated wild plant'),
                     u'NotWild': _("Not of wild source"),
@@ -461,7 +528,11 @@ class Accession(db.Base):
     """
     __tablename__ = 'accession'
     __mapper_args__ = {'order_by': 'accession.code',
-                       'extension': AccessionMapperExtension()}
+                       'extension': [AccessionMapperExtension(),
+                                     accession_sort_key_ext,
+                                     TaxonStatsExtension('species',
+                                                         'species_id',
+                                                         'species')]}
 
     # columns
     #: the accession code
@@ -522,22 +593,8 @@ class Accession(db.Base):
     intended2_location = relation('Location',
                   primaryjoin='Accession.intended2_location_id==Location.id')
 
-    def __init__(self, *args, **kwargs):
-        super(Accession, self).__init__(*args, **kwargs)
-        self.__cached_species_str = {}
-
-
-    @reconstructor
-    def init_on_load(self):
-        """
-        Called instead of __init__() when an Accession is loaded from
-        the database.
-        """
-        self.__cached_species_str = {}
-
-
     def invalidate_str_cache(self):
-        self.__cached_species_str = {}
+        invalidate_species_str(self.species_id)
 
 
     def __str__(self):
@@ -549,24 +606,28 @@ class Accession(db.Base):
         Return the string of the species with the id qualifier(id_qual)
         injected into the proper place.
 
-        If the species isn't part of a session of if the species is dirty,
-        i.e. in object_session(species).dirty, then a new string will be
-        built even if the species hasn't been changeq since the last call
-        to this method.
+        The strings are cached in species_str_cache by species id so
+        that accessions of the same species share them.  If the
+        species has been changed but not saved then a new string is
+        built without using the cache.
         """
-        # WARNING: don't use session.is_modified() here because it
-        # will query lots of dependencies
-        try:
-            cached = self.__cached_species_str[(markup, authors)]
-        except KeyError:
-            self.__cached_species_str[(markup, authors)] = None
-            cached = None
-        session = object_session(self.species)
-        if session:
-            # if not part of a session or if the species is dirty then
-            # build a new string
-            if cached is not None and self.species not in session.dirty:
-                return cached
+        # use the species if it's already loaded instead of
+        # species_id since species_id isn't set until the session is
+        # flushed, this also avoids loading the species to get the
+        # string from the cache
+        species = self.__dict__.get('species', None)
+        if species is not None:
+            species_id = species.id
+            use_cache = species_id is not None and \
+                not instance_state(species).modified
+        else:
+            species_id = self.species_id
+            use_cache = species_id is not None
+        key = (self.id_qual, self.id_qual_rank, authors, markup)
+        if use_cache:
+            names = species_str_cache.get(species_id)
+            if names is not None and key in names:
+                return names[key]
         if not self.species:
             return None
 
@@ -583,18 +644,19 @@ class Accession(db.Base):
             warning(msg)
             self.__warned_about_id_qual = True
 
-        # copy the species so we don't affect the original
-        session = db.Session()
-        species = session.merge(self.species)#, dont_load=True)
-
-        # generate the string
+        # generate the string, the id_qual is injected with an
+        # _AttrOverride so we don't affect the original species and
+        # don't need another session to copy it
+        species = self.species
         if self.id_qual in ('aff.', 'cf.'):
             if self.id_qual_rank=='infrasp':
-                species.sp = '%s %s' % (species.sp, self.id_qual)
+                species = _AttrOverride(species, sp='%s %s' % \
+                                            (species.sp, self.id_qual))
             elif self.id_qual_rank:
-                setattr(species, self.id_qual_rank,
-                        '%s %s' % (self.id_qual,
-                                   getattr(species, self.id_qual_rank)))
+                value = '%s %s' % (self.id_qual,
+                                   getattr(species, self.id_qual_rank))
+                species = _AttrOverride(species,
+                                        **{str(self.id_qual_rank): value})
             sp_str = Species.str(species, authors, markup)
         elif self.id_qual:
             sp_str = '%s(%s)' % (Species.str(species, authors, markup),
@@ -602,10 +664,12 @@ class Accession(db.Base):
         else:
             sp_str = Species.str(species, authors, markup)
 
-        # clean up and return the string
-        del species
-        session.close()
-        self.__cached_species_str[(markup, authors)] = sp_str
+        if use_cache:
+            names = species_str_cache.get(species_id)
+            if names is None:
+                names = {}
+                species_str_cache[species_id] = names
+            names[key] = sp_str
         return sp_str
 
 
@@ -613,7 +677,7 @@ class Accession(db.Base):
         return '%s (%s)' % (self.code, self.species.markup())
 
 
-from bauble.plugins.garden.plant import Plant, PlantEditor
+from bauble.plugins.garden.plant import Plant, PlantEditor, plant_sort_key
 
 
 class AccessionEditorView(editor.GenericEditorView):
@@ -1198,6 +1262,10 @@ class SourcePresenter(editor.GenericEditorPresenter):
 
     garden_prop_str = _('Garden Propagation')
 
+    # the (keys, model) of the source combo model shared by all the
+    # SourcePresenters, see get_source_model()
+    _source_model = None
+
     def __init__(self, parent, model, view, session):
         super(SourcePresenter, self).__init__(model, view)
         self.parent_ref = weakref.ref(parent)
@@ -1215,9 +1283,15 @@ class SourcePresenter(editor.GenericEditorPresenter):
         def on_select(source):
             if not source:
                 self.model.source = None
-            elif isinstance(source, SourceDetail):
+            elif isinstance(source, SourceDetailKey):
+                # only load the SourceDetail once it's selected
+                detail = self.session.query(SourceDetail).get(source.id)
+                if detail is None:
+                    warning('unknown source: %s' % source)
+                    self.model.source = None
+                    return
                 self.model.source = self.source
-                self.model.source.source_detail = source
+                self.model.source.source_detail = detail
             elif source == self.garden_prop_str:
                 self.model.source = self.source
                 self.model.source.source_detail = None
@@ -1396,10 +1470,32 @@ class SourcePresenter(editor.GenericEditorPresenter):
             self.populate_source_combo(new_detail)
 
 
+    def get_source_model(self):
+        """
+        Return a gtk.ListStore of the values for the source combo.  The
+        SourceDetails are only in the model as SourceDetailKeys and the
+        model is only rebuilt when a SourceDetail has been changed.
+        """
+        keys = get_source_detail_keys()
+        cached = SourcePresenter._source_model
+        if cached is not None and cached[0] is keys:
+            return cached[1]
+        model = gtk.ListStore(object)
+        model.append([''])
+        model.append([self.garden_prop_str])
+        for key in keys:
+            model.append([key])
+        SourcePresenter._source_model = (keys, model)
+        return model
+
+
     def populate_source_combo(self, active=None):
         """
         If active=None then set whatever was previously active before
         repopulating the combo.
+
+        :param active: a SourceDetail, a SourceDetailKey or
+          garden_prop_str
         """
         combo = self.view.widgets.acc_source_comboentry
         if not active:
@@ -1407,20 +1503,23 @@ class SourcePresenter(editor.GenericEditorPresenter):
             if treeiter:
                 active = combo.get_model()[treeiter][0]
         combo.set_model(None)
-        model = gtk.ListStore(object)
-        none_iter = model.append([''])
-        model.append([self.garden_prop_str])
-        map(lambda x: model.append([x]), self.session.query(SourceDetail))
+        model = self.get_source_model()
         combo.set_model(model)
         combo.child.get_completion().set_model(model)
 
         combo._populate = True
         if active:
-            results = utils.search_tree_model(model, active)
+            if isinstance(active, (SourceDetail, SourceDetailKey)):
+                def _cmp(row, data):
+                    return isinstance(row[0], SourceDetailKey) and \
+                        row[0].id == data.id
+            else:
+                _cmp = lambda row, data: row[0] == data
+            results = utils.search_tree_model(model, active, _cmp)
             if results:
                 combo.set_active_iter(results[0])
         else:
-            combo.set_active_iter(none_iter)
+            combo.set_active_iter(model.get_iter_first())
         combo._populate = False
 
 
@@ -1453,12 +1552,11 @@ class SourcePresenter(editor.GenericEditorPresenter):
         def match_func(completion, key, treeiter, data=None):
             model = completion.get_model()
             value = model[treeiter][0]
-            # allows completions of source details by their ID
-            if utils.utf8(value).lower().startswith(key.lower()) or \
-                    (isinstance(value, SourceDetail) and \
-                         str(value.id).startswith(key)):
-                return True
-            return False
+            if isinstance(value, SourceDetailKey):
+                # allows completions of source details by their ID
+                return utils.utf8(value.name).lower().\
+                    startswith(key.lower()) or str(value.id).startswith(key)
+            return utils.utf8(value).lower().startswith(key.lower())
         completion.set_match_func(match_func)
 
         entry = combo.child
@@ -1506,7 +1604,7 @@ class SourcePresenter(editor.GenericEditorPresenter):
             def _cmp(row, data):
                 val = row[0]
                 if utils.utf8(val) == data or \
-                    (isinstance(val, SourceDetail) and val.id==data):
+                    (isinstance(val, SourceDetailKey) and val.id==data):
                     return True
                 else:
                     return False
@@ -1571,8 +1669,12 @@ class AccessionEditorPresenter(editor.GenericEditorPresenter):
         self._original_code = self.model.code
         self.current_source_box = None
 
+        # the code is only reserved when the accession is committed so
+        # that cancelling the editor doesn't use up a code
+        self._next_code = None
         if not model.code:
-            model.code = get_next_code()
+            model.code = get_next_code(session=self.session, reserve=False)
+            self._next_code = model.code
             if self.model.species:
                 self.__dirty = True
 
@@ -2168,13 +2270,24 @@ class AccessionEditor(editor.GenericModelViewPresenterEditor):
 
         if self.model.id_qual is None:
             self.model.id_qual_rank = None
+
+        if self.presenter._next_code is not None and \
+                self.model.code == self.presenter._next_code:
+            # reserve the code that was shown in the editor or the
+            # next one if it was taken since the editor was opened
+            code = get_next_code(session=self.session)
+            if code:
+                self.model.code = utils.utf8(code)
+            # don't reserve another code if the commit is retried
+            self.presenter._next_code = None
         return super(AccessionEditor, self).commit_changes()
 
 
 
 # import at the bottom to avoid circular dependencies
 from bauble.plugins.plants.genus import Genus
-from bauble.plugins.plants.species_model import Species, SpeciesSynonym
+from bauble.plugins.plants.species_model import Species, SpeciesSynonym, \
+    species_str_cache, invalidate_species_str
 
 #
 # infobox for searchview
@@ -2209,6 +2322,23 @@ class GeneralAccessionExpander(InfoExpander):
                                    on_nplants_clicked)
 
 
+    def prefetch(self, row):
+        '''
+        Return the living plants by location and the number of plants
+        in the accession.
+        '''
+        session = object_session(row)
+        plant_locations = {}
+        for plant in row.plants:
+            if plant.quantity == 0:
+                continue
+            location = str(plant.location)
+            q = plant_locations.setdefault(location, 0)
+            plant_locations[location] = q + plant.quantity
+        nplants = session.query(Plant).filter_by(accession_id=row.id).count()
+        return plant_locations, nplants
+
+
     def update(self, row):
         '''
         '''
@@ -2231,25 +2361,17 @@ class GeneralAccessionExpander(InfoExpander):
         self.set_widget_value('name_data', row.species_str(markup=True),
                               markup=True)
 
-        session = object_session(row)
-        plant_locations = {}
-        for plant in row.plants:
-            if plant.quantity == 0:
-                continue
-            q = plant_locations.setdefault(plant.location, 0)
-            plant_locations[plant.location] = q + plant.quantity
+        plant_locations, nplants = self.get_prefetched(row)
         if plant_locations:
             strs = []
             for location, quantity in plant_locations.iteritems():
                 strs.append(_('%(quantity)s in %(location)s') \
-                              % dict(location=str(location), quantity=quantity))
+                              % dict(location=location, quantity=quantity))
             s = '\n'.join(strs)
         else:
             s = '0'
         self.set_widget_value('living_plants_data', s)
 
-
-        nplants = session.query(Plant).filter_by(accession_id=row.id).count()
         self.set_widget_value('nplants_data', nplants)
         self.set_widget_value('date_recvd_data', row.date_recvd)
         self.set_widget_value('date_accd_data', row.date_accd)
@@ -2471,6 +2593,12 @@ class AccessionInfoBox(InfoBox):
         #self.show_all()
 
 
+    def prefetch(self, row, expanders=None):
+        if isinstance(row, Collection):
+            row = row.source.accession
+        return super(AccessionInfoBox, self).prefetch(row, expanders)
+
+
     def update(self, row):
         if isinstance(row, Collection):
             row = row.source.accession
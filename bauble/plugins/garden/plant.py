@@ -16,6 +16,8 @@ import gobject
 import pango
 from sqlalchemy import *
 from sqlalchemy.orm import *
+from sqlalchemy.orm.interfaces import MANYTOONE
+from sqlalchemy.orm.properties import RelationshipProperty
 from sqlalchemy.orm.session import object_session
 from sqlalchemy.exc import DBAPIError
 
@@ -28,13 +30,15 @@ from bauble.plugins.garden.location import Location, LocationEditor
 from bauble.plugins.garden.propagation import PlantPropagation
 from bauble.plugins.plants import *
 import bauble.prefs as prefs
-from bauble.search import SearchStrategy
+from bauble.search import SearchStrategy, MapperSearch
 import bauble.btypes as types
 import bauble.utils as utils
 from bauble.utils.log import debug
 from bauble.view import InfoBox, InfoExpander, PropertiesExpander, \
     select_in_search_results, Action
 import bauble.view as view
+from bauble.plugins.plants.taxon_stats import TaxonStatsExtension, \
+    invalidate_taxon_stats
 
 
 # TODO: do a magic attribute on plant_id that checks if a plant id
@@ -115,33 +119,99 @@ def plant_markup_func(plant):
         return utils.xml_safe_utf8(plant), sp_str
 
 
-def get_next_code(acc):
+def _range_code(first, last):
+    """
+    Return a plant code for the range of codes from first to last that
+    can be parsed with utils.range_builder()
+    """
+    if first == last:
+        return utils.utf8(first)
+    return utils.utf8('%s-%s' % (first, last))
+
+
+def _code_counter(acc):
+    """
+    Return the name of the code counter and a seed function for the
+    plant codes of acc, see bauble.db.reserve_codes()
+    """
+    table = Plant.__table__
+    def seed(conn):
+        stmt = select([table.c.code], table.c.accession_id == acc.id)
+        return _max_code([r[0] for r in conn.execute(stmt)])
+    return 'plant:%s' % acc.id, seed
+
+
+@db.with_session
+def get_next_code(acc, count=1, session=None, reserve=True):
     """
     Return the next available plant code for an accession.
 
     This function should be specific to the institution.
 
+    The codes are reserved from the code counter for the accession so
+    the same code is never returned twice.  If count is more than one
+    then a range of codes is reserved and returned as a range string,
+    e.g. 4-6, for the plant editor.
+
     If there is an error getting the next code the None is returned.
+
+    :param acc: the accession
+    :param count: the number of codes to reserve
+    :param session: the session to use, if None a new session is used
+    :param reserve: if False then the codes aren't reserved, e.g. for
+      an editor that reserves them when they are committed
     """
-    # auto generate/increment the accession code
-    session = db.Session()
-    codes = session.query(Plant.code).join(Accession).\
-        filter(Accession.id==acc.id).all()
-    next = 1
-    if codes:
-        try:
-            next = max([int(code[0]) for code in codes])+1
-        except Exception, e:
-            return None
-    return utils.utf8(next)
+    if acc.id is None:
+        # the accession hasn't been saved so it doesn't have any plants
+        return _range_code(1, count)
+    counter, seed = _code_counter(acc)
+    def exists(first):
+        codes = map(utils.utf8, range(first, first+count))
+        return session.query(Plant.id).\
+            filter(and_(Plant.accession_id==acc.id,
+                        Plant.code.in_(codes))).first() is not None
+    try:
+        if not reserve:
+            first = db.peek_code(counter, seed=seed)
+            if exists(first):
+                first = db.peek_code(counter, seed=seed, reseed=True)
+            return _range_code(first, first+count-1)
+        first = db.reserve_codes(counter, count, seed=seed)
+        if exists(first):
+            # the codes were entered by hand, skip past the existing codes
+            db.advance_code_counter(counter, seed=seed)
+            first = db.reserve_codes(counter, count)
+    except Exception, e:
+        debug(e)
+        return None
+    return _range_code(first, first+count-1)
 
 
-def is_code_unique(plant, code):
+def advance_code_counter(acc, codes):
+    """
+    Make sure that get_next_code() doesn't return any of codes for acc,
+    e.g. after a range of plant codes was entered by hand.
+
+    :param acc: the accession
+    :param codes: a list of plant codes
+    """
+    if acc.id is None:
+        return
+    last = _max_code(map(str, codes))
+    if last > 0:
+        counter, seed = _code_counter(acc)
+        db.advance_code_counter(counter, last, seed=seed)
+
+
+@db.with_session
+def is_code_unique(plant, code, session=None):
     """
     Return True/False if the code is a unique Plant code for accession.
 
     This method will also take range values for code that can be passed
     to utils.range_builder()
+
+    :param session: the session to use, if None a new session is used
     """
     # if the range builder only creates one number then we assume the
     # code is not a range and so we test against the string version of
@@ -153,11 +223,9 @@ def is_code_unique(plant, code):
     # reference accesssion.id instead of accession_id since
     # setting the accession on the model doesn't set the
     # accession_id until the session is flushed
-    session = db.Session()
     count = session.query(Plant).join('accession').\
         filter(and_(Accession.id==plant.accession.id,
                     Plant.code.in_(codes))).count()
-    session.close()
     return count == 0
 
 
@@ -345,6 +413,43 @@ acc_type_values = {u'Plant': _('Plant'),
                    None: ''}
 
 
+def plant_sort_key(plant):
+    """
+    Return the string a plant is sorted by, i.e. the accession code,
+    the plant delimiter and the plant code.
+    """
+    return u'%s%s%s' % (plant.accession.code, Plant.get_delimiter(),
+                        plant.code)
+
+plant_sort_key_ext = db.SortKeyExtension(plant_sort_key)
+
+
+def _row_values(obj):
+    """
+    Return a dict of the column values of the mapped object obj
+    without the id, _created and _last_updated columns.
+
+    The foreign keys of objects that haven't been flushed aren't set
+    yet so they are taken from the related objects.
+    """
+    mapper = object_mapper(obj)
+    ignore = ('id', '_created', '_last_updated')
+    values = dict([(c.name, getattr(obj, c.name)) \
+                       for c in mapper.local_table.c if c.name not in ignore])
+    for prop in mapper.iterate_properties:
+        if not isinstance(prop, RelationshipProperty) or \
+                prop.direction is not MANYTOONE:
+            continue
+        related = getattr(obj, prop.key)
+        if related is None:
+            continue
+        for local, remote in prop.local_remote_pairs:
+            value = getattr(related, remote.name)
+            if value is not None:
+                values[local.name] = value
+    return values
+
+
 class Plant(db.Base):
     """
     :Table name: plant
@@ -388,7 +493,11 @@ class Plant(db.Base):
     """
     __tablename__ = 'plant'
     __table_args__ = (UniqueConstraint('code', 'accession_id'), {})
-    __mapper_args__ = {'order_by': ['plant.accession_id', 'plant.code']}
+    __mapper_args__ = {'order_by': ['plant.accession_id', 'plant.code'],
+                       'extension': [plant_sort_key_ext,
+                                     TaxonStatsExtension('accession',
+                                                         'accession_id',
+                                                         'accession')]}
 
     # columns
     code = Column(Unicode(6), nullable=False)
@@ -435,6 +544,8 @@ class Plant(db.Base):
         """
         Return a Plant that is a duplicate of this Plant with attached
         notes, changes and propagations.
+
+        To create lots of duplicates use insert_duplicates() instead.
         """
         plant = Plant()
         if not session:
@@ -476,6 +587,55 @@ class Plant(db.Base):
         return plant
 
 
+    def insert_duplicates(self, codes, connection, changes=True):
+        """
+        Insert a duplicate of this Plant with its notes and changes
+        for each code in codes.
+
+        Unlike duplicate() the rows are built as dicts and inserted
+        with one executemany per table, see
+        :func:`bauble.db.insert_rows`, so creating lots of plants
+        doesn't go through the session.  The propagations aren't
+        duplicated.
+
+        :param codes: a list of plant codes
+        :param connection: the connection to insert the rows on,
+          e.g. session.connection()
+        :param changes: if False then don't duplicate the changes
+
+        Return the ids of the new plants.
+        """
+        values = _row_values(self)
+        rows = []
+        for code in codes:
+            row = dict(values)
+            row['code'] = utils.utf8(code)
+            rows.append(row)
+        ids = db.insert_rows(connection, Plant.__table__, rows)
+
+        children = [(PlantNote, self.notes)]
+        if changes:
+            children.append((PlantChange, self.changes))
+        for cls, objs in children:
+            child_rows = []
+            for obj in objs:
+                values = _row_values(obj)
+                for plant_id in ids:
+                    row = dict(values)
+                    row['plant_id'] = plant_id
+                    child_rows.append(row)
+            db.insert_rows(connection, cls.__table__, child_rows)
+
+        # do what the other mapper extensions would have done
+        accession = self.accession
+        prefix = u'%s%s' % (accession.code, Plant.get_delimiter())
+        db.set_sort_keys(connection, Plant.__tablename__,
+                         [(plant_id, prefix + row['code']) \
+                              for plant_id, row in zip(ids, rows)])
+        invalidate_taxon_stats(connection, 'accession', [accession.id])
+        return ids
+
+
     def markup(self):
         #return "%s.%s" % (self.accession, self.plant_id)
         # FIXME: this makes expanding accessions look ugly with too many
@@ -485,7 +645,7 @@ class Plant(db.Base):
                                 self.accession.species_str(markup=True))
 
 
-from bauble.plugins.garden.accession import Accession
+from bauble.plugins.garden.accession import Accession, _max_code
 
 
 class PlantEditorView(GenericEditorView):
@@ -589,12 +749,17 @@ class PlantEditorPresenter(GenericEditorPresenter):
                                                      self.view, self.session)
 
         # if the PlantEditor has been started with a new plant but
-        # the plant is already associated with an accession
+        # the plant is already associated with an accession, the code
+        # is only reserved when the plant is committed so that
+        # cancelling the editor doesn't use up a code
+        self._next_code = None
         if self.model.accession and not self.model.code:
-            code = get_next_code(self.model.accession)
+            code = get_next_code(self.model.accession, session=self.session,
+                                 reserve=False)
             if code:
                 # if get_next_code() returns None then there was an error
                 self.set_model_attr('code', code)
+                self._next_code = self.model.code
 
         self.refresh_view() # put model values in view
 
@@ -709,7 +874,8 @@ class PlantEditorPresenter(GenericEditorPresenter):
         # same accession and plant code that we started with when the
         # editor was opened
         if self.model.code is not None and not \
-                is_code_unique(self.model, self.model.code) and not \
+                is_code_unique(self.model, self.model.code,
+                               session=self.session) and not \
                 (self._original_accession_id==self.model.accession.id and \
                      self.model.code==self._original_code):
 
@@ -857,7 +1023,19 @@ class PlantEditor(GenericModelViewPresenterEditor):
     def commit_changes(self):
         """
         """
+        if self.presenter._next_code is not None and \
+                self.model.code == self.presenter._next_code:
+            # reserve the code that was shown in the editor or the
+            # next one if it was taken since the editor was opened
+            code = get_next_code(self.model.accession, session=self.session)
+            if code:
+                self.model.code = code
+            # don't reserve another code if the commit is retried
+            self.presenter._next_code = None
         codes = utils.range_builder(self.model.code)
+        accession = None
+        if self.model in self.session.new:
+            accession = self.model.accession
         if len(codes) <= 1 or self.model not in self.session.new \
                 and not self.branched_plant:
             change = self.presenter.change
@@ -893,46 +1071,36 @@ class PlantEditor(GenericModelViewPresenterEditor):
                     change.quantity = -change.quantity
             super(PlantEditor, self).commit_changes()
             self._committed.append(self.model)
+            if accession:
+                advance_code_counter(accession, codes)
             return
 
         # this method will create new plants from self.model even if
         # the plant code is not a range....its a small price to pay
-        plants = []
-        mapper = object_mapper(self.model)
-        # TODO: precompute the _created and _last_updated attributes
-        # incase we have to create lots of plants it won't be too slow
-
-        # we have to set the properties on the new objects
-        # individually since session.merge won't create a new object
-        # since the object is already in the session
-        import sqlalchemy.orm as orm
-        for code in codes:
-            new_plant = Plant()
-            self.session.add(new_plant)
-
-            # TODO: can't we user Plant.duplicate here
-            ignore = ('changes', 'notes', 'propagations')
-            for prop in mapper.iterate_properties:
-                if prop.key not in ignore:
-                    setattr(new_plant, prop.key, getattr(self.model, prop.key))
-            new_plant.code = utils.utf8(code)
-            new_plant.id = None
-            new_plant._created = None
-            new_plant._last_updated = None
-            plants.append(new_plant)
-            for note in self.model.notes:
-                new_note = PlantNote()
-                for prop in object_mapper(note).iterate_properties:
-                    setattr(new_note, prop.key, getattr(note, prop.key))
-                new_note.plant = new_plant
         try:
+            # the model is only used as a template for the new plants
+            # which are inserted without the session
             map(self.session.expunge, self.model.notes)
             self.session.expunge(self.model)
+            self.session.flush()
+            ids = self.model.insert_duplicates(codes,
+                                               self.session.connection(),
+                                               changes=False)
             super(PlantEditor, self).commit_changes()
         except:
             self.session.add(self.model)
             raise
-        self._committed.extend(plants)
+        # load the new plants in chunks to stay below the number of
+        # bind parameters the database allows in one query
+        chunk_size = MapperSearch.in_chunk_size
+        for start in xrange(0, len(ids), chunk_size):
+            chunk = ids[start:start+chunk_size]
+            self._committed.extend(self.session.query(Plant).\
+                                       filter(Plant.id.in_(chunk)).all())
+        # reserve the codes entered in the editor so that
+        # get_next_code() doesn't hand them out again
+        if accession:
+            advance_code_counter(accession, codes)
 
 
     def handle_response(self, response):
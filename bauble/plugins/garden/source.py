@@ -10,6 +10,7 @@ from random import random
 import gtk
 from sqlalchemy import *
 from sqlalchemy.orm import *
+from sqlalchemy.orm import SessionExtension
 from sqlalchemy.orm.session import object_session
 
 import bauble
@@ -143,9 +144,144 @@ source_type_values = {u'Expedition': _('Expedition'),
                       u'Unknown': _('Unknown'),
                      None: ''}
 
+class SourceDetailKey(tuple):
+    """
+    A (id, name) tuple that stands in for a SourceDetail in the source
+    combo until the object is needed.
+    """
+    __slots__ = ()
+
+    def __new__(cls, id_, name):
+        return tuple.__new__(cls, (id_, name))
+
+    id = property(lambda self: self[0])
+    name = property(lambda self: self[1])
+
+    def __str__(self):
+        return utils.utf8(self[1]).encode('utf-8')
+
+    def matches(self, obj):
+        """
+        Return True if this key refers to obj.
+        """
+        return isinstance(obj, SourceDetail) and obj.id == self[0]
+
+
+# the SourceDetail names for the current engine as a dict of id:name
+_source_detail_names = None
+_source_detail_names_engine = None
+
+# the sorted SourceDetailKeys built from _source_detail_names
+_source_detail_keys = None
+
+
+def _get_source_detail_names():
+    global _source_detail_names, _source_detail_names_engine, \
+        _source_detail_keys
+    if _source_detail_names is None or \
+            _source_detail_names_engine is not db.engine:
+        table = SourceDetail.__table__
+        stmt = select([table.c.id, table.c.name])
+        _source_detail_names = dict(db.engine.execute(stmt).fetchall())
+        _source_detail_names_engine = db.engine
+        _source_detail_keys = None
+    return _source_detail_names
+
+
+def get_source_detail_keys():
+    """
+    Return a list of SourceDetailKeys for all the SourceDetails in the
+    database sorted by name.  Only the ids and names are loaded from
+    the database the first time this function is called after a
+    connection is opened or reset_source_detail_names() has been
+    called.
+
+    The same list is returned until a SourceDetail is changed so
+    callers can compare the list by identity to know if anything
+    they built from it is stale.
+    """
+    global _source_detail_keys
+    names = _get_source_detail_names()
+    if _source_detail_keys is None:
+        keys = [SourceDetailKey(id_, name) \
+                    for id_, name in names.iteritems()]
+        keys.sort(key=lambda k: utils.utf8(k.name).lower())
+        _source_detail_keys = keys
+    return _source_detail_keys
+
+
+def reset_source_detail_names():
+    """
+    Forget the cached SourceDetail names so that they are reloaded the
+    next time get_source_detail_keys() is called.
+    """
+    global _source_detail_names, _source_detail_names_engine, \
+        _source_detail_keys
+    _source_detail_names = None
+    _source_detail_names_engine = None
+    _source_detail_keys = None
+
+
+class SourceDetailSessionExtension(SessionExtension):
+    """
+    Forget the cached SourceDetail names again when a session that
+    changed a SourceDetail is committed or rolled back, the names
+    might have been reloaded with the uncommitted changes since the
+    flush.
+    """
+
+    def __init__(self):
+        self._changed = weakref.WeakKeyDictionary()
+
+    def add(self, session):
+        """
+        Remember that session changed a SourceDetail.  Return False
+        if session doesn't use this extension.
+        """
+        if session is None or self not in session.extensions:
+            return False
+        self._changed[session] = True
+        return True
+
+    def after_commit(self, session):
+        if self._changed.pop(session, False):
+            reset_source_detail_names()
+
+    def after_rollback(self, session):
+        if self._changed.pop(session, False):
+            reset_source_detail_names()
+
+
+source_detail_session_ext = SourceDetailSessionExtension()
+
+
+class SourceDetailMapperExtension(MapperExtension):
+    """
+    Forget the cached SourceDetail names when a SourceDetail is
+    changed so that they are reloaded from the database.
+    """
+
+    def _reset(self, instance):
+        reset_source_detail_names()
+        source_detail_session_ext.add(object_session(instance))
+
+    def after_insert(self, mapper, connection, instance):
+        self._reset(instance)
+        return EXT_CONTINUE
+
+    def after_update(self, mapper, connection, instance):
+        self._reset(instance)
+        return EXT_CONTINUE
+
+    def after_delete(self, mapper, connection, instance):
+        self._reset(instance)
+        return EXT_CONTINUE
+
+
 class SourceDetail(db.Base):
     __tablename__ = 'source_detail'
-    __mapper_args__ = {'order_by': 'name'}
+    __mapper_args__ = {'order_by': 'name',
+                       'extension': SourceDetailMapperExtension()}
 
     name = Column(Unicode(75), unique=True)
     description = Column(UnicodeText)
@@ -279,6 +279,42 @@ class PlantTests(GardenTestCase):
         self.session.commit()
 
 
+    def test_insert_duplicates(self):
+        """
+        Test Plant.insert_duplicates()
+        """
+        p = Plant(accession=self.accession, location=self.location, code=u'2',
+                  quantity=52)
+        note = PlantNote(note=u'some note', plant=p)
+        change = PlantChange(from_location=self.location,
+                             to_location=self.location, quantity=1, plant=p)
+        self.session.add(p)
+        self.session.commit()
+        codes = [u'3', u'4', u'5']
+        ids = p.insert_duplicates(codes, self.session.connection())
+        self.session.commit()
+        self.assert_(len(ids) == 3, ids)
+        plants = self.session.query(Plant).filter(Plant.id.in_(ids)).\
+            order_by(Plant.code).all()
+        self.assert_([plant.code for plant in plants] == codes, plants)
+        for plant in plants:
+            self.assert_(plant.quantity == 52)
+            self.assert_(plant.accession == self.accession)
+            self.assert_(plant._created is not None)
+            self.assert_([n.note for n in plant.notes] == [u'some note'])
+            self.assert_(len(plant.changes) == 1)
+
+        # the inserts are in the history and the sort keys
+        history = self.session.query(db.History).\
+            filter_by(table_name=u'plant', operation=u'insert').\
+            filter(db.History.table_id.in_(ids)).count()
+        self.assert_(history == 3, history)
+        order = self.session.query(Plant.code).\
+            filter(Plant.accession_id == self.accession.id).\
+            order_by(db.sort_key_column(Plant)).all()
+        self.assert_([c[0] for c in order][-3:] == codes, order)
+
+
     def test_bulk_plant_editor(self):
         """
         Test creating multiple plants with the plant editor.
@@ -437,6 +473,70 @@ class PlantTests(GardenTestCase):
         self.assertFalse(is_code_unique(self.plant, '01-2'))
 
 
+    def test_get_next_code(self):
+        """
+        Test bauble.plugins.garden.plant.get_next_code()
+        """
+        from bauble.plugins.garden.plant import get_next_code, \
+            advance_code_counter
+        self.assert_(get_next_code(self.accession) == u'2')
+        # the codes are reserved even if they aren't used
+        self.assert_(get_next_code(self.accession) == u'3')
+        self.assert_(get_next_code(self.accession, count=3) == u'4-6')
+
+        # skip the codes that were entered by hand
+        self.create(Plant, accession=self.accession, location=self.location,
+                    code=u'7', quantity=1)
+        self.session.commit()
+        self.assert_(get_next_code(self.accession) == u'8')
+        advance_code_counter(self.accession, [10, 11])
+        self.assert_(get_next_code(self.accession) == u'12')
+
+        # peeking doesn't reserve the code
+        self.assert_(get_next_code(self.accession, reserve=False) == u'13')
+        self.assert_(get_next_code(self.accession, reserve=False) == u'13')
+        self.create(Plant, accession=self.accession, location=self.location,
+                    code=u'13', quantity=1)
+        self.session.commit()
+        self.assert_(get_next_code(self.accession, reserve=False) == u'14')
+        self.assert_(get_next_code(self.accession) == u'14')
+
+
+    def test_sort_key(self):
+        """
+        Test that the plant sort keys are maintained and sort naturally
+        """
+        for code in (u'10', u'2', u'1.1'):
+            self.create(Plant, accession=self.accession,
+                        location=self.location, code=code, quantity=1)
+        self.session.commit()
+        plants = self.session.query(Plant).\
+            order_by(db.sort_key_column(Plant)).all()
+        codes = [p.code for p in plants]
+        self.assert_(codes == [u'1', u'1.1', u'2', u'10'], codes)
+
+        # changing the accession code updates the plant sort keys
+        acc2 = self.create(Accession, species=self.species, code=u'02')
+        self.session.commit()
+        self.accession.code = u'3'
+        self.session.commit()
+        accessions = self.session.query(Accession).\
+            order_by(db.sort_key_column(Accession)).all()
+        self.assert_(accessions == [acc2, self.accession], accessions)
+        t = db.SortKey.__table__
+        key = self.session.query(t.c.key).\
+            filter_by(table_name=u'plant', table_id=self.plant.id).scalar()
+        self.assert_(key == utils.natsort_str(str(self.plant)), key)
+
+        # deleted plants remove their sort key
+        plant_id = self.plant.id
+        self.session.delete(self.plant)
+        self.session.commit()
+        nkeys = self.session.query(t.c.id).\
+            filter_by(table_name=u'plant', table_id=plant_id).count()
+        self.assert_(nkeys == 0)
+
+
 
 
 class PropagationTests(GardenTestCase):
@@ -852,6 +952,53 @@ class SourceTests(GardenTestCase):
         self.assert_(self.session.query(SourceDetail).get(source_detail_id))
 
 
+    def test_source_detail_keys(self):
+        """
+        Test that the cached SourceDetail names follow the changes to
+        the SourceDetails
+        """
+        from bauble.plugins.garden.source import get_source_detail_keys, \
+            reset_source_detail_names, SourceDetailKey
+        reset_source_detail_names()
+        detail = SourceDetail(name=u'b')
+        self.session.add(detail)
+        self.session.commit()
+        keys = get_source_detail_keys()
+        self.assert_(keys == [(detail.id, u'b')], keys)
+        self.assert_(isinstance(keys[0], SourceDetailKey))
+        self.assert_(keys[0].matches(detail))
+        self.assert_(str(keys[0]) == 'b')
+        # the same list is returned until something changes
+        self.assert_(get_source_detail_keys() is keys)
+
+        detail2 = SourceDetail(name=u'a')
+        self.session.add(detail2)
+        self.session.commit()
+        keys = get_source_detail_keys()
+        self.assert_(keys == [(detail2.id, u'a'), (detail.id, u'b')], keys)
+
+        detail.name = u'c'
+        self.session.commit()
+        keys = get_source_detail_keys()
+        self.assert_(keys == [(detail2.id, u'a'), (detail.id, u'c')], keys)
+
+        detail_id = detail.id
+        self.session.delete(detail)
+        self.session.commit()
+        keys = get_source_detail_keys()
+        self.assert_(keys == [(detail2.id, u'a')], keys)
+        self.assert_(not keys[0].matches(detail_id))
+
+        # a change that is rolled back isn't kept
+        detail3 = SourceDetail(name=u'd')
+        self.session.add(detail3)
+        self.session.flush()
+        get_source_detail_keys()
+        self.session.rollback()
+        keys = get_source_detail_keys()
+        self.assert_(keys == [(detail2.id, u'a')], keys)
+
+
     def itest_details_editor(self):
         e = SourceDetailEditor()
         e.start()
@@ -922,10 +1069,29 @@ class AccessionTests(GardenTestCase):
         # have to commit because the cached string won't be returned
         # on dirty species
         self.session.commit()
+        sp_str = acc.species_str()
         s2 = acc.species_str()
         assert id(sp_str) == id(s2), '%s(%s) == %s(%s)' % (sp_str, id(sp_str),
                                                            s2, id(s2))
 
+        # the cache is shared by accessions of the same species
+        acc2 = self.create(Accession, species=self.species, code=u'2',
+                           id_qual=u'cf.', id_qual_rank=u'infrasp')
+        self.session.commit()
+        self.assert_(id(acc2.species_str()) == id(sp_str))
+
+        # changing the species or genus invalidates the cached strings
+        self.species.sp = u'sp2'
+        self.session.commit()
+        s = "gen sp2 cf. 'Cultivar'"
+        sp_str = acc.species_str()
+        self.assert_(s == sp_str, '%s == %s' % (s, sp_str))
+        self.species.genus.genus = u'gen2'
+        self.session.commit()
+        s = "gen2 sp2 cf. 'Cultivar'"
+        sp_str = acc2.species_str()
+        self.assert_(s == sp_str, '%s == %s' % (s, sp_str))
+
         # this used to test that if the id_qual was set but the
         # id_qual_rank wasn't then we would get an error. now we just
         # show an warning and put the id_qual on the end of the string
@@ -952,6 +1118,31 @@ class AccessionTests(GardenTestCase):
         self.assert_(not self.session.query(Plant).get(plant_id))
 
 
+    def test_get_next_code(self):
+        """
+        Test bauble.plugins.garden.accession.get_next_code()
+        """
+        from bauble.plugins.garden.accession import get_next_code
+        start = '%s%s' % (datetime.date.today().year, Plant.get_delimiter())
+        self.create(Accession, species=self.species, code=u'%s0009' % start)
+        self.session.commit()
+        self.assert_(get_next_code() == '%s0010' % start)
+        self.assert_(get_next_code() == '%s0011' % start)
+
+        # skip the codes that were entered by hand
+        self.create(Accession, species=self.species, code=u'%s0012' % start)
+        self.session.commit()
+        self.assert_(get_next_code() == '%s0013' % start)
+
+        # peeking doesn't reserve the code
+        self.assert_(get_next_code(reserve=False) == '%s0014' % start)
+        self.assert_(get_next_code(reserve=False) == '%s0014' % start)
+        self.assert_(get_next_code() == '%s0014' % start)
+        self.create(Accession, species=self.species, code=u'%s0015' % start)
+        self.session.commit()
+        self.assert_(get_next_code(reserve=False) == '%s0016' % start)
+
+
     def test_constraints(self):
         """
         Test the constraints on the accession table.
@@ -32,6 +32,7 @@ from bauble.plugins.imex.xml import XMLExportTool, XMLExportCommandHandler
 # missing columns so that all columns will have some value
 
 class ImexPlugin(pluginmgr.Plugin):
+    lazy = True
     tools = [CSVImportTool, CSVExportTool, XMLExportTool]
     commands = [CSVExportCommandHandler, CSVImportCommandHandler,
                 XMLExportCommandHandler]
@@ -5,9 +5,15 @@
 # with the system csv module
 #
 
+import array
 import os
 import csv
+import itertools
+import Queue
+import threading
+import time
 import traceback
+from collections import deque
 
 import gtk
 import gobject
@@ -19,7 +25,7 @@ from bauble.error import BaubleError
 import bauble.utils as utils
 import bauble.pluginmgr as pluginmgr
 import bauble.task
-from bauble.utils.log import debug, error
+from bauble.utils.log import debug, error, info
 
 from sqlalchemy.sql.util import sort_tables
 # TODO: i've also had a problem with bad insert statements, e.g. importing a
@@ -66,6 +72,12 @@ class UnicodeReader(object):
         self.encoding = encoding
 
 
+    def _get_fieldnames(self):
+        return self.reader.fieldnames
+    fieldnames = property(_get_fieldnames)
+    """The column names in the header of the file."""
+
+
     def next(self):
         row = self.reader.next()
         t = {}
@@ -115,6 +127,44 @@ class UnicodeWriter(object):
             self.writerow(row)
 
 
+def _column_converters(table, column_keys, defaults):
+    """
+    Return a list of (column name, function) tuples for column_keys
+    where each function converts a value read from a CSV file to the
+    value that should be inserted into the column of table.  The
+    list is created once per table so that the column defaults and
+    types aren't looked up again for every row.
+
+    :param table: the table the values are imported into
+    :param column_keys: the names of the columns to insert
+    :param defaults: a dict of column name to precomputed default value
+    """
+    isempty = lambda v: v in ('', None)
+    booleans = {'True': True, 'False': False}
+
+    def make_converter(name):
+        default = defaults.get(name, None)
+        if name in table.c and isinstance(table.c[name].type, Boolean):
+            # need bool value, not 'True' or 'False' string, in SA
+            # 0.5.5 and only on an SQLite database the 'False' will
+            # import as True since bool('False') == True
+            def convert(value):
+                if isempty(value):
+                    return default
+                return booleans.get(value, value)
+        elif name in table.c:
+            def convert(value):
+                if isempty(value):
+                    return default
+                return value
+        else:
+            convert = lambda value: value
+        return convert
+
+    return [(name, make_converter(name)) for name in column_keys]
+
+
+
 class Importer(object):
 
     def start(self, **kwargs):
@@ -144,13 +194,26 @@ class CSVImporter(Importer):
     instead of getting new defaults for each row.  This shouldn't be a
     problem but it also means that your column default should change
     depending on the value of previously inserted rows.
+
+    If fast is True then the rows are inserted in much larger
+    batches.  On PostgreSQL the rows are loaded with COPY ... FROM
+    STDIN and on SQLite the pragmas are tuned for bulk loading while
+    importing.
     """
-    def __init__(self):
+
+    #: the number of rows to insert at a time
+    batch_size = 127
+
+    #: the number of rows to insert at a time when importing with fast=True
+    fast_batch_size = 5000
+
+    def __init__(self, fast=False):
         super(CSVImporter, self).__init__()
         self.__error = False  # flag to indicate error on import
         self.__cancel = False # flag to cancel importing
         self.__pause = False  # flag to pause importing
         self.__error_exc = False
+        self.fast = fast
 
 
     def start(self, filenames=None, metadata=None, force=False):
@@ -169,6 +232,21 @@ class CSVImporter(Importer):
         bauble.task.queue(self.run(filenames, metadata, force))
 
 
+    def _get_insert_func(self, connection, table, column_keys):
+        """
+        Return a function that takes a list of converted rows and
+        inserts them into table.
+        """
+        if self.fast and connection.engine.name in ('postgres', 'postgresql'):
+            from bauble.plugins.imex.postgres import copy_rows
+            def copy(values):
+                rows = [[row[key] for key in column_keys] for row in values]
+                copy_rows(connection, table, column_keys, rows)
+            return copy
+        insert = table.insert(bind=connection).compile(column_keys=column_keys)
+        return lambda values: connection.execute(insert, values)
+
+
     @staticmethod
     def _toposort_file(filename, key_pairs):
         """
@@ -179,49 +257,159 @@ class CSVImporter(Importer):
         any of the line[child].  parent is usually the name of the
         foreign_key column and child is usually the column that the
         foreign key points to, e.g ('parent_id', 'id')
+
+        Only the offset of each line in the file and the index of its
+        parent lines are kept in memory.  The sorted file is written
+        by seeking to each line in the original file so the lines are
+        copied exactly as they are.
+
+        Raises a BaubleError if the lines can't be sorted because
+        of a circular reference.
         """
         f = open(filename, 'rb')
-        reader = UnicodeReader(f, quotechar=QUOTE_CHAR,
-                               quoting=QUOTE_STYLE)
-
-        # create a dictionary of the lines mapped to the child field
-        bychild = {}
-        for line in reader:
-            for parent, child in key_pairs:
-                bychild[line[child]] = line
-        f.close()
-        fields = reader.reader.fieldnames
-        del reader
-
-        # create pairs from the values in the lines where pair[0]
-        # should come before pair[1] when the lines are sorted
-        pairs = []
-        for line in bychild.values():
-            for parent, child in key_pairs:
-                if line[parent] and line[child]:
-                    pairs.append((line[parent], line[child]))
-
-        # sort the keys and flatten the lines back into a list
-        sorted_keys = utils.topological_sort(bychild.keys(), pairs)
-        sorted_lines = []
-        for key in sorted_keys:
-            sorted_lines.append(bychild[key])
+        # read the file a line at a time with readline() instead of
+        # iterating over the file so that f.tell() is always at the
+        # start of the next row that the csv reader will return
+        def readlines():
+            line = f.readline()
+            while line:
+                yield line
+                line = f.readline()
+        reader = csv.reader(readlines(), quotechar=QUOTE_CHAR,
+                            quoting=QUOTE_STYLE)
+        try:
+            fields = reader.next()
+        except StopIteration:
+            f.close()
+            return filename
+        header_end = f.tell()
+        parent_cols = [fields.index(parent) for parent, child in key_pairs]
+        child_cols = [fields.index(child) for parent, child in key_pairs]
+
+        # offsets[i] is where row i starts, the last offset is the end
+        # of the last row
+        offsets = array.array('l', [header_end])
+        # the parent and child values of each row for each key pair
+        parent_values = [[] for p in key_pairs]
+        by_child = [{} for p in key_pairs]
+        nrows = 0
+        for row in reader:
+            offsets.append(f.tell())
+            for i in xrange(len(key_pairs)):
+                child = row[child_cols[i]]
+                if child:
+                    by_child[i][child] = nrows
+                parent_values[i].append(row[parent_cols[i]] or None)
+            nrows += 1
+
+        # resolve the parent values to row indexes, values that don't
+        # refer to a row in this file are ignored
+        parents = array.array('l', [-1]) * (nrows * len(key_pairs))
+        nparents = array.array('l', [0]) * (nrows + 1)
+        for i in xrange(len(key_pairs)):
+            index = by_child[i]
+            values = parent_values[i]
+            for row in xrange(nrows):
+                parent = index.get(values[row], -1)
+                if parent != -1 and parent != row:
+                    parents[row*len(key_pairs) + i] = parent
+                    nparents[parent] += 1
+        del by_child, parent_values
+
+        # create a compact list of the children of each row,
+        # children[first[row]:first[row+1]] are the children of row
+        first = array.array('l', [0]) * (nrows + 1)
+        total = 0
+        for row in xrange(nrows):
+            first[row] = total
+            total += nparents[row]
+        first[nrows] = total
+        children = array.array('l', [0]) * total
+        fill = array.array('l', first)
+        indegree = array.array('l', [0]) * nrows
+        for row in xrange(nrows):
+            for i in xrange(len(key_pairs)):
+                parent = parents[row*len(key_pairs) + i]
+                if parent != -1:
+                    children[fill[parent]] = row
+                    fill[parent] += 1
+                    indegree[row] += 1
+        del fill, nparents
+
+        # emit the rows with no parents first in file order
+        queue = deque([row for row in xrange(nrows) if indegree[row] == 0])
+        order = array.array('l')
+        while queue:
+            row = queue.popleft()
+            order.append(row)
+            for child in children[first[row]:first[row+1]]:
+                indegree[child] -= 1
+                if indegree[child] == 0:
+                    queue.append(child)
+
+        if len(order) < nrows:
+            f.close()
+            cycle = CSVImporter._find_cycle(indegree, parents, len(key_pairs))
+            f = open(filename, 'rb')
+            keys = []
+            for row in cycle:
+                f.seek(offsets[row])
+                line = csv.reader([f.read(offsets[row+1]-offsets[row])],
+                                  quotechar=QUOTE_CHAR,
+                                  quoting=QUOTE_STYLE).next()
+                keys.append(line[child_cols[0]])
+            f.close()
+            msg = _('The rows in %(filename)s can not be imported because '
+                    'they refer to each other in a loop: %(keys)s') % \
+                    dict(filename=filename, keys=' -> '.join(keys))
+            raise BaubleError(msg)
 
         # write a temporary file of the sorted lines
         import tempfile
         tmppath = tempfile.mkdtemp()
         head, tail = os.path.split(filename)
-        filename = os.path.join(tmppath, tail)
-        tmpfile = open(filename, 'wb')
-        tmpfile.write('%s\n' % ','.join(fields))
-        #writer = UnicodeWriter(tmpfile, fields, quotechar=QUOTE_CHAR,
-        writer = csv.DictWriter(tmpfile, fields, quotechar=QUOTE_CHAR,
-                                quoting=QUOTE_STYLE)
-        writer.writerows(sorted_lines)
-        tmpfile.flush()
+        tmpfilename = os.path.join(tmppath, tail)
+        tmpfile = open(tmpfilename, 'wb')
+        f.seek(0)
+        tmpfile.write(f.read(header_end))
+        for row in order:
+            start = offsets[row]
+            f.seek(start)
+            line = f.read(offsets[row+1]-start)
+            if not line.endswith('\n'):
+                # the last line of the file may not end with a newline
+                line += '\n'
+            tmpfile.write(line)
         tmpfile.close()
-        del writer
-        return filename
+        f.close()
+        return tmpfilename
+
+
+    @staticmethod
+    def _find_cycle(indegree, parents, npairs):
+        """
+        Return a list of row indexes that form a loop.
+
+        :param indegree: the number of unsorted parents of each row, the
+          rows left with a parent are either in or below a loop
+        :param parents: the parent of each row for each key pair, -1
+          for no parent
+        :param npairs: the number of key pairs
+        """
+        row = [r for r in xrange(len(indegree)) if indegree[r] > 0][0]
+        seen = {}
+        path = []
+        while row not in seen:
+            seen[row] = len(path)
+            path.append(row)
+            for i in xrange(npairs):
+                parent = parents[row*npairs + i]
+                if parent != -1 and indegree[parent] > 0:
+                    row = parent
+                    break
+        cycle = path[seen[row]:]
+        cycle.reverse()
+        return cycle + [cycle[0]]
 
 
     def run(self, filenames, metadata, force=False):
@@ -238,6 +426,7 @@ class CSVImporter(Importer):
         connection = None
         self.__error_exc = BaubleError(_('Unknown Error.'))
 
+        pragmas = None
         try:
             # user a contextual connect in case whoever called this
             # method called it inside a transaction then we can pick
@@ -283,13 +472,13 @@ class CSVImporter(Importer):
             utils.message_dialog(msg, gtk.MESSAGE_ERROR)
             return
 
-        total_lines = 0
+        # the progress is the number of bytes read from the files
+        # against the total size of the files
         filesizes = {}
         for filename in filenames:
-            #get the total number of lines for all the files
-            nlines = len(open(filename).readlines())
-            filesizes[filename] = nlines
-            total_lines += nlines
+            filesizes[filename] = os.path.getsize(filename)
+        total_bytes = float(max(sum(filesizes.values()), 1))
+        bytes_so_far = 0
 
         created_tables = []
         def create_table(table):
@@ -299,7 +488,6 @@ class CSVImporter(Importer):
 #             created_tables.extend([n for n in names \
 #                                    if n not in created_tables])
 
-        steps_so_far = 0
         cleaned = None
         insert = None
         depends = set() # the type will be changed to a [] later
@@ -332,11 +520,18 @@ class CSVImporter(Importer):
 
             # commit the dependency drops
             transaction.commit()
+            if self.fast and connection.engine.name == 'sqlite':
+                # the pragmas can't be changed inside a transaction
+                from bauble.plugins.imex.sqlite import set_bulk_pragmas
+                pragmas = set_bulk_pragmas(connection)
             transaction = connection.begin()
 
             # update_every determines how many rows we will insert at
             # a time and consequently how often we update the gui
-            update_every = 127
+            if self.fast:
+                update_every = self.fast_batch_size
+            else:
+                update_every = self.batch_size
 
             # import the tables one at a time, breaking every so often
             # so the GUI can update
@@ -349,8 +544,22 @@ class CSVImporter(Importer):
                 bauble.task.set_message(msg)
                 yield # allow progress bar update
 
-                # don't do anything if the file is empty:
-                if filesizes[filename] <= 1:
+                # read the header and the first row from the same
+                # reader that is used to import the rest of the file
+                table_size = filesizes[filename]
+                f = open(filename, "rb")
+                reader = UnicodeReader(f, quotechar=QUOTE_CHAR,
+                                       quoting=QUOTE_STYLE)
+                try:
+                    first = reader.next()
+                except StopIteration:
+                    first = None
+
+                # don't do anything if the file is empty, a file with
+                # only a header still replaces the table with an empty one
+                if first is None and not reader.fieldnames:
+                    f.close()
+                    bytes_so_far += table_size
                     if not table.exists():
                         create_table(table)
                     continue
@@ -383,21 +592,22 @@ class CSVImporter(Importer):
                         create_table(table)
 
                 if self.__cancel or self.__error:
+                    f.close()
                     break
 
                 # commit the drop of the table we're importing
                 transaction.commit()
                 transaction = connection.begin()
 
-                # open a temporary reader to get the column keys so we
-                # can later precompile our insert statement
-                f = open(filename, "rb")
-                tmp = UnicodeReader(f, quotechar=QUOTE_CHAR,
-                                    quoting=QUOTE_STYLE)
-                tmp.next()
-                csv_columns = set(tmp.reader.fieldnames)
-                del tmp
-                f.close()
+                if first is None:
+                    # there aren't any rows after the header
+                    f.close()
+                    bytes_so_far += table_size
+                    continue
+
+                # get the column keys so we can later precompile our
+                # insert statement
+                csv_columns = set(reader.fieldnames)
 
                 # precompute the defaults...this assumes that the
                 # default function doesn't depend on state after each
@@ -419,34 +629,36 @@ class CSVImporter(Importer):
                 if self_keys:
                     key_pairs = map(lambda x: (x.parent.name, x.column.name),
                                     self_keys)
+                    f.close()
                     filename = self._toposort_file(filename, key_pairs)
+                    f = open(filename, "rb")
+                    reader = UnicodeReader(f, quotechar=QUOTE_CHAR,
+                                           quoting=QUOTE_STYLE)
+                    first = reader.next()
+                # the sorted file can be a slightly different size
+                # than the original so scale the file position
+                scale = float(table_size) / max(os.path.getsize(filename), 1)
 
                 # the column keys for the insert are a union of the
                 # columns in the CSV file and the columns with
                 # defaults
                 column_keys = list(csv_columns.union(defaults.keys()))
-                insert = table.insert(bind=connection).\
-                    compile(column_keys=column_keys)
+                converters = _column_converters(table, column_keys, defaults)
+                insert_rows = self._get_insert_func(connection, table,
+                                                    column_keys)
 
                 values = []
                 def do_insert():
                     if values:
-                        connection.execute(insert, *values)
+                        insert_rows(values)
                     del values[:]
-                    percent = float(steps_so_far)/float(total_lines)
+                    percent = (bytes_so_far + f.tell()*scale) / total_bytes
                     if 0 < percent < 1.0: # avoid warning
                         if bauble.gui is not None:
                             pb_set_fraction(percent)
 
-                isempty = lambda v: v in ('', None)
-
-                f = open(filename, "rb")
-                reader = UnicodeReader(f, quotechar=QUOTE_CHAR,
-                                       quoting=QUOTE_STYLE)
-                # NOTE: we shouldn't get this far if the file doesn't
-                # have any rows to import but if so there is a chance
-                # that this loop could cause problems
-                for line in reader:
+                nrows = 0
+                for line in itertools.chain([first], reader):
                     while self.__pause:
                         yield
                     if self.__cancel or self.__error:
@@ -454,37 +666,21 @@ class CSVImporter(Importer):
 
                     # fill in default values and None for "empty"
                     # columns in line
-                    for column in table.c.keys():
-                        if column in defaults \
-                                and (column not in line \
-                                         or isempty(line[column])):
-                            line[column] = defaults[column]
-                        elif column in line and isempty(line[column]):
-                            line[column] = None
-                        elif column in line and line[column] == 'False' and \
-                                isinstance(table.c[column].type, Boolean):
-                            # need bool value, not 'False' string
-                            line[column] = False
-                        elif column in line and line[column] == 'True' and \
-                                isinstance(table.c[column].type, Boolean):
-                            # need bool value, not 'True' string
-                            line[column] = True                        
-                            # in SA 0.5.5 and only on an SQLite
-                            # database the 'False' will import as True
-                            # for some reason whereas True will import
-                            # as True automatically...probably because
-                            # bool('False') == True
-                    values.append(line)
-                    steps_so_far += 1
-                    if steps_so_far % update_every == 0:
+                    values.append(dict([(name, convert(line.get(name))) \
+                                            for name, convert in converters]))
+                    nrows += 1
+                    if nrows % update_every == 0:
                         do_insert()
                         yield
 
                 if self.__error or self.__cancel:
+                    f.close()
                     break
 
                 # insert the remainder that were less than update every
                 do_insert()
+                f.close()
+                bytes_so_far += table_size
 
                 # we have commit after create after each table is imported
                 # or Postgres will complain if two tables that are
@@ -509,6 +705,10 @@ class CSVImporter(Importer):
             raise
         else:
             transaction.commit()
+        finally:
+            if pragmas:
+                from bauble.plugins.imex.sqlite import restore_pragmas
+                restore_pragmas(connection, pragmas)
 
         # unfortunately inserting an explicit value into a column that
         # has a sequence doesn't update the sequence, we shortcut this
@@ -580,6 +780,24 @@ class CSVImporter(Importer):
 # TODO: add support for exporting only specific tables
 
 class CSVExporter(object):
+    """
+    The CSVExporter exports each table in the database to a comma
+    separated value file named <table>.txt.
+
+    The rows are streamed from the database in batches straight into
+    the files so the memory use doesn't depend on the size of the
+    tables.  On PostgreSQL a server side cursor is used and the tables
+    are exported at the same time on a small pool of threads, each
+    with its own connection.  Since each thread exports its tables in
+    its own transaction the tables should not be changed while
+    exporting.
+    """
+
+    #: the number of rows to fetch from the database at a time
+    batch_size = 500
+
+    #: the number of tables to export at the same time on PostgreSQL
+    max_workers = 4
 
     def start(self, path=None):
         if path == None:
@@ -604,15 +822,140 @@ class CSVExporter(object):
             debug(e)
 
 
+    def _export_table(self, connection, table, filename):
+        """
+        Write the rows of table to filename.  This is a generator that
+        yields the number of rows written so far after each batch.
+        """
+        f = open(filename, 'wb')
+        try:
+            writer = UnicodeWriter(f, quotechar=QUOTE_CHAR,
+                                   quoting=QUOTE_STYLE)
+            writer.writerow(table.c.keys()) # the column names
+            # stream_results uses a server side cursor on PostgreSQL
+            # so all the rows aren't fetched at once
+            result = connection.execution_options(stream_results=True).\
+                execute(table.select())
+            nrows = 0
+            rows = result.fetchmany(self.batch_size)
+            while rows:
+                for row in rows:
+                    # the csv module quotes the values with newlines
+                    writer.writerow(row)
+                nrows += len(rows)
+                yield nrows
+                rows = result.fetchmany(self.batch_size)
+            result.close()
+            yield nrows
+        finally:
+            f.close()
+
+
+    def _report(self, table, filename, nrows, seconds):
+        """
+        Log the number of rows and bytes written for table and the
+        rate they were written at.
+        """
+        nbytes = os.path.getsize(filename)
+        seconds = max(seconds, 0.001)
+        info(_('exported %(table)s: %(rows)d rows, %(bytes)d bytes in '
+               '%(seconds).2fs (%(rows_rate)d rows/s, %(kb_rate).1f KB/s)') \
+                 % dict(table=table.name, rows=nrows, bytes=nbytes,
+                        seconds=seconds, rows_rate=nrows/seconds,
+                        kb_rate=nbytes/seconds/1024))
+
+
+    def _export_serial(self, tables, filename_template):
+        """
+        Export the tables one at a time on a single connection.
+        """
+        connection = db.engine.connect()
+        try:
+            steps_so_far = 0
+            for table in tables:
+                filename = filename_template % table.name
+                steps_so_far += 1
+                pb_set_fraction(float(steps_so_far)/len(tables))
+                msg = _('exporting %(table)s table to %(filename)s') \
+                    % {'table': table.name, 'filename': filename}
+                bauble.task.set_message(msg)
+                start = time.time()
+                nrows = 0
+                for nrows in self._export_table(connection, table, filename):
+                    yield
+                self._report(table, filename, nrows, time.time()-start)
+        finally:
+            connection.close()
+
+
+    def _export_parallel(self, tables, filename_template):
+        """
+        Export the tables on a pool of threads where each thread has
+        its own connection.
+        """
+        todo = Queue.Queue()
+        for table in tables:
+            todo.put(table)
+        done = Queue.Queue()
+
+        def worker():
+            connection = None
+            table = filename = None
+            try:
+                try:
+                    connection = db.engine.connect()
+                    while True:
+                        try:
+                            table = todo.get_nowait()
+                        except Queue.Empty:
+                            return
+                        filename = filename_template % table.name
+                        start = time.time()
+                        nrows = 0
+                        for nrows in self._export_table(connection, table,
+                                                        filename):
+                            pass
+                        done.put((table, filename, nrows, time.time()-start,
+                                  None))
+                except Exception, e:
+                    # always report the error, e.g. if the connection
+                    # couldn't be opened, or the export would wait
+                    # for the tables of this worker forever
+                    done.put((table, filename, 0, 0, e))
+            finally:
+                if connection is not None:
+                    connection.close()
+
+        nworkers = min(self.max_workers, len(tables))
+        for i in range(nworkers):
+            thread = threading.Thread(target=worker)
+            thread.setDaemon(True)
+            thread.start()
+
+        # wait for the tables to be exported while letting the GUI update
+        finished = 0
+        while finished < len(tables):
+            try:
+                table, filename, nrows, seconds, exc = done.get(timeout=0.1)
+            except Queue.Empty:
+                yield
+                continue
+            if exc is not None:
+                raise exc
+            finished += 1
+            pb_set_fraction(float(finished)/len(tables))
+            bauble.task.set_message(_('exported %(table)s table to '
+                                      '%(filename)s') \
+                                        % {'table': table.name,
+                                           'filename': filename})
+            self._report(table, filename, nrows, seconds)
+            yield
+
+
     def __export_task(self, path):
-#        if not os.path.exists(path):
-#            raise ValueError("CSVExporter: path does not exist.\n" + path)
         filename_template = os.path.join(path, "%s.txt")
-#        timeout = tasklet.WaitForTimeout(12)
-        steps_so_far = 0
-        ntables = 0
-        for table in db.metadata.sorted_tables:
-            ntables += 1
+        tables = db.metadata.sorted_tables
+        for table in tables:
             filename = filename_template % table.name
             if os.path.exists(filename):
                 msg = _('Export file <b>%(filename)s</b> for '\
@@ -622,53 +965,13 @@ class CSVExporter(object):
                 if utils.yes_no_dialog(msg):
                     return
 
-        def replace(s):
-            if isinstance(s, (str, unicode)):
-                s.replace('\n', '\\n')
-            return s
-
-        def write_csv(filename, rows):
-            f = open(filename, 'wb')
-            #writer = csv.writer(f, quotechar=QUOTE_CHAR, quoting=QUOTE_STYLE)
-            writer = UnicodeWriter(f, quotechar=QUOTE_CHAR,quoting=QUOTE_STYLE)
-            writer.writerows(rows)
-            f.close()
-
-        update_every = 30
-        for table in db.metadata.sorted_tables:
-            filename = filename_template % table.name
-            steps_so_far+=1
-            fraction = float(steps_so_far)/float(ntables)
-            pb_set_fraction(fraction)
-            msg = _('exporting %(table)s table to %(filename)s') \
-                    % {'table': table.name, 'filename': filename}
-            bauble.task.set_message(msg)
-            #log.info("exporting %s" % table.name)
-
-            # get the data
-            results = table.select().execute().fetchall()
-
-            # create empty files with only the column names
-            if len(results) == 0:
-                write_csv(filename, [table.c.keys()])
-                yield
-                #yield timeout
-                #tasklet.get_event()
-                continue
-
-            rows = []
-            rows.append(table.c.keys()) # append col names
-            ctr = 0
-            for row in results:
-                values = map(replace, row.values())
-                rows.append(values)
-                if ctr == update_every:
-                    yield
-                    #yield timeout
-                    #tasklet.get_event()
-                    ctr=0
-                ctr += 1
-            write_csv(filename, rows)
+        if db.engine.name in ('postgres', 'postgresql') \
+                and self.max_workers > 1:
+            export = self._export_parallel
+        else:
+            export = self._export_serial
+        for step in export(tables, filename_template):
+            yield
 
 
 class CSVImportCommandHandler(pluginmgr.CommandHandler):
@@ -676,8 +979,12 @@ class CSVImportCommandHandler(pluginmgr.CommandHandler):
     command = 'imcsv'
 
     def __call__(self, cmd, arg):
-        importer = CSVImporter()
-        importer.start(arg)
+        # e.g. imcsv --fast /path/to/family.txt /path/to/genus.txt
+        args = (arg or '').split()
+        fast = '--fast' in args
+        filenames = [a for a in args if a != '--fast'] or None
+        importer = CSVImporter(fast=fast)
+        importer.start(filenames)
 
 
 class CSVExportCommandHandler(pluginmgr.CommandHandler):
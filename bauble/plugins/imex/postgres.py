@@ -13,3 +13,42 @@
 # delimeters are or if its just a straight dump that needs to be imported
 
 #COPY command. copy zip_codes from '/path/to/csv/ZIP_CODES.txt' DELIMITERS ',' CSV;
+
+import csv
+from StringIO import StringIO
+
+import bauble.utils as utils
+
+
+def copy_rows(connection, table, columns, rows):
+    """
+    Insert rows into table with COPY ... FROM STDIN.  This is much
+    faster than an INSERT for each row.
+
+    :param connection: a connection to a PostgreSQL database, the
+      COPY is done in the current transaction of the connection
+    :param table: the table to insert into
+    :param columns: the names of the columns in each row
+    :param rows: a list of sequences of values in the order of columns,
+      None is copied as NULL
+    """
+    buf = StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        values = []
+        for value in row:
+            if value is None:
+                values.append(None)
+            else:
+                values.append(utils.utf8(value).encode('utf-8'))
+        writer.writerow(values)
+    buf.seek(0)
+    # an unquoted empty value is NULL but an empty string has to be
+    # quoted, csv.writer writes None as an unquoted empty value
+    stmt = 'COPY %s (%s) FROM STDIN WITH CSV' % \
+        (table.name, ', '.join(['"%s"' % c for c in columns]))
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(stmt, buf)
+    finally:
+        cursor.close()
@@ -16,3 +16,29 @@ def import_csv(connection, filename, table, delimiter=','):
     # CRAP: this isn't supported from 3.0 onward
     connection.execute('COPY %s FROM %s USING DELIMITERS %s' % \
                        (table.name, filename, delimiter))
+
+
+# the pragmas to use when bulk loading, these trade the durability of
+# the database file for speed while importing
+bulk_pragmas = {'synchronous': 'OFF',
+                'cache_size': '10000',
+                'temp_store': 'MEMORY'}
+
+def set_bulk_pragmas(connection):
+    """
+    Set the pragmas on connection for bulk loading and return a dict
+    of the previous values that can be passed to restore_pragmas().
+    """
+    previous = {}
+    for name, value in bulk_pragmas.iteritems():
+        previous[name] = connection.execute('PRAGMA %s;' % name).scalar()
+        connection.execute('PRAGMA %s = %s;' % (name, value))
+    return previous
+
+
+def restore_pragmas(connection, pragmas):
+    """
+    Restore the pragmas returned by set_bulk_pragmas().
+    """
+    for name, value in pragmas.iteritems():
+        connection.execute('PRAGMA %s = %s;' % (name, value))
@@ -17,6 +17,7 @@ import bauble.plugins.garden.test as garden_test
 import bauble.plugins.plants.test as plants_test
 from bauble.plugins.imex.csv_ import CSVImporter, CSVExporter, QUOTE_CHAR, \
     QUOTE_STYLE, UnicodeReader, UnicodeWriter
+from bauble.error import BaubleError
 from bauble.test import BaubleTestCase
 from bauble.utils.log import debug
 
@@ -112,6 +113,37 @@ class CSVTests(ImexTestCase):
         importer.start([filename], force=True)
 
 
+    def test_toposort_file(self):
+        """
+        Test that CSVImporter._toposort_file() puts the parents before
+        their children and raises an error on a loop.
+        """
+        filename = os.path.join(self.path, 'geography.txt')
+        f = open(filename, 'wb')
+        f.write('id,name,parent_id\n'
+                '4,"four\nlines",3\n'
+                '3,three,1\n'
+                '1,one,\n'
+                '2,two,1')
+        f.close()
+        sorted_filename = CSVImporter._toposort_file(filename,
+                                                     [('parent_id', 'id')])
+        f = open(sorted_filename, 'rb')
+        reader = UnicodeReader(f, quotechar=QUOTE_CHAR, quoting=QUOTE_STYLE)
+        ids = [line['id'] for line in reader]
+        f.close()
+        self.assert_(ids == ['1', '3', '2', '4'], ids)
+
+        f = open(filename, 'wb')
+        f.write('id,name,parent_id\n'
+                '1,one,\n'
+                '2,two,3\n'
+                '3,three,2\n')
+        f.close()
+        self.assertRaises(BaubleError, CSVImporter._toposort_file, filename,
+                          [('parent_id', 'id')])
+
+
     def test_import_bool_column(self):
         """
         """
@@ -150,6 +182,63 @@ class CSVTests(ImexTestCase):
         table.drop(bind=db.engine)
 
 
+    def test_import_fast(self):
+        """
+        Test that importing with fast=True converts the values the
+        same as a normal import.
+        """
+        filename = os.path.join(self.path, 'family.txt')
+        f = open(filename, 'wb')
+        format = {'delimiter': ',', 'quoting': QUOTE_STYLE,
+                  'quotechar': QUOTE_CHAR}
+        fields = family_data[0].keys()
+        f.write('%s\n' % ','.join(fields))
+        writer = csv.DictWriter(f, fields, **format)
+        writer.writerows(family_data)
+        f.close()
+        importer = TestImporter(fast=True)
+        importer.start([filename], force=True)
+        families = self.session.query(Family).order_by(Family.id).all()
+        self.assert_([f.family for f in families] == [u'family1', u'family2'])
+        # empty and missing values use the column default
+        self.assert_([f.qualifier for f in families] == ['', ''])
+
+
+    def test_import_header_only(self):
+        """
+        Test that importing a file with only a header empties the
+        table, e.g. for a table that was empty when it was exported,
+        but that an empty file leaves the table alone
+        """
+        self.assert_(self.session.query(Species).count() == 1)
+        filename = os.path.join(self.path, 'species.txt')
+        open(filename, 'wb').close()
+        importer = TestImporter()
+        importer.start([filename], force=True)
+        self.session.expunge_all()
+        self.assert_(self.session.query(Species).count() == 1)
+
+        f = open(filename, 'wb')
+        f.write('%s\n' % ','.join(species_data[0].keys()))
+        f.close()
+        importer = TestImporter()
+        importer.start([filename], force=True)
+        self.session.expunge_all()
+        self.assert_(self.session.query(Species).count() == 0)
+
+        # exporting the empty table and importing it keeps it empty
+        temp_path = tempfile.mkdtemp()
+        exporter = CSVExporter()
+        exporter.start(temp_path)
+        exported = os.path.join(temp_path, 'species.txt')
+        self.assert_(len(open(exported).readlines()) == 1)
+        importer = TestImporter()
+        importer.start([exported], force=True)
+        self.session.expunge_all()
+        self.assert_(self.session.query(Species).count() == 0)
+        shutil.rmtree(temp_path)
+
+
     def test_with_open_connection(self):
         """
         Test that the import doesn't stall if we have a connection
@@ -288,6 +377,46 @@ class CSVTests(ImexTestCase):
         self.assert_(row['cv_group'] == '')
 
 
+    def test_export_newlines(self):
+        """
+        Test that values with newlines and backslashes are exported
+        and imported as they are.
+        """
+        family = self.session.query(Family).get(1)
+        family.family = u'line1\nline2\\n'
+        self.session.commit()
+        temp_path = tempfile.mkdtemp()
+        exporter = CSVExporter()
+        exporter.start(temp_path)
+        filename = os.path.join(temp_path, 'family.txt')
+        # the header is the same as the columns of the table
+        header = open(filename).readline().strip()
+        self.assert_(header.split(',') == Family.__table__.c.keys(), header)
+
+        importer = TestImporter()
+        importer.start([filename], force=True)
+        self.session.expunge_all()
+        family = self.session.query(Family).get(1)
+        self.assert_(family.family == u'line1\nline2\\n', family.family)
+        shutil.rmtree(temp_path)
+
+
+    def test_import_unescaped(self):
+        """
+        Test that backslashes, e.g. in files written by older versions
+        of the exporter, are imported as they are.
+        """
+        filename = os.path.join(self.path, 'family.txt')
+        f = open(filename, 'wb')
+        f.write('id,family\n1,C:\\new\\\\dir\n')
+        f.close()
+        importer = TestImporter()
+        importer.start([filename], force=True)
+        self.session.expunge_all()
+        family = self.session.query(Family).get(1)
+        self.assert_(family.family == u'C:\\new\\\\dir', family.family)
+
+
 # class CSVTests(ImexTestCase):
 
 
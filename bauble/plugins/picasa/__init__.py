@@ -621,6 +621,7 @@ class PicasaSettingsTool(pluginmgr.Tool):
 class PicasaPlugin(pluginmgr.Plugin):
     #tools = [PicasaUploadTool, PicasaSettingsTool]
     tools = [PicasaSettingsTool]
+    lazy = True
     #view = PicasaView
     #commands = [PicasaCommandHandler]
 
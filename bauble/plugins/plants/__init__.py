@@ -27,12 +27,16 @@ from bauble.plugins.plants.family import *
 from bauble.plugins.plants.genus import *
 from bauble.plugins.plants.species import *
 from bauble.plugins.plants.geography import *
+from bauble.plugins.plants.taxon_stats import TaxonStatsCommandHandler, \
+    check_taxon_stats, taxon_stats_writer
 import bauble.search as search
 from bauble.view import SearchView
 
 
 class PlantsPlugin(pluginmgr.Plugin):
 
+    commands = [TaxonStatsCommandHandler]
+
     @classmethod
     def init(cls):
         if 'GardenPlugin' in pluginmgr.plugins:
@@ -45,13 +49,15 @@ class PlantsPlugin(pluginmgr.Plugin):
         SearchView.view_meta[Family].set(children="genera",
                                          infobox=FamilyInfoBox,
                                          context_menu=family_context_menu,
-                                         markup_func=family_markup_func)
+                                         markup_func=family_markup_func,
+                                         sort_key=Family.family)
 
         mapper_search.add_meta(('genus', 'gen'), Genus, ['genus'])
         SearchView.view_meta[Genus].set(children="species",
                                         infobox=GenusInfoBox,
                                         context_menu=genus_context_menu,
-                                        markup_func=genus_markup_func)
+                                        markup_func=genus_markup_func,
+                                        sort_key=Genus.genus)
 
         search.add_strategy(SynonymSearch)
         mapper_search.add_meta(('species', 'sp'), Species,
@@ -60,17 +66,28 @@ class PlantsPlugin(pluginmgr.Plugin):
         SearchView.view_meta[Species].set(children=species_get_kids,
                                           infobox=SpeciesInfoBox,
                                           context_menu=species_context_menu,
-                                          markup_func=species_markup_func)
+                                          markup_func=species_markup_func,
+                                  sort_key=lambda: db.sort_key_column(Species))
 
         mapper_search.add_meta(('vernacular', 'vern', 'common'),
                                VernacularName, ['name'])
         SearchView.view_meta[VernacularName].set(children=vernname_get_kids,
                                             infobox=VernacularNameInfoBox,
                                             context_menu=vernname_context_menu,
-                                            markup_func=vernname_markup_func)
+                                            markup_func=vernname_markup_func,
+                                            sort_key=VernacularName.name)
 
         mapper_search.add_meta(('geography', 'geo'), Geography, ['name'])
-        SearchView.view_meta[Geography].set(children=get_species_in_geography)
+        SearchView.view_meta[Geography].set(children=get_species_in_geography,
+                                            sort_key=Geography.name)
+
+        from bauble.plugins.plants.species_model import species_sort_key_ext
+        db.check_sort_keys([(Species, species_sort_key_ext)])
+        check_taxon_stats()
+        db.add_session_extension(taxon_stats_writer)
+        # the case insensitive indexes for the editor completions
+        db.check_prefix_indexes([Family.__table__.c.family,
+                                 Genus.__table__.c.genus])
 
         if bauble.gui is not None:
             bauble.gui.add_to_insert_menu(FamilyEditor, _('Family'))
@@ -101,6 +118,8 @@ class PlantsPlugin(pluginmgr.Plugin):
         import_error = False
         import_exc = None
         csv.start(filenames, metadata=db.metadata, force=True)
+        # the geography table was imported outside of the ORM
+        reset_geography_tree()
 
 
 
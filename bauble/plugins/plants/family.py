@@ -23,6 +23,8 @@ import bauble.utils.web as web
 import bauble.btypes as types
 from bauble.prefs import prefs
 import bauble.view as view
+from bauble.plugins.plants.taxon_stats import TaxonStatsExtension, \
+    get_taxon_stats
 
 
 def edit_callback(families):
@@ -131,7 +133,8 @@ class Family(db.Base):
     """
     __tablename__ = 'family'
     __table_args__ = (UniqueConstraint('family', 'qualifier'), {})
-    __mapper_args__ = {'order_by': ['Family.family', 'Family.qualifier']}
+    __mapper_args__ = {'order_by': ['Family.family', 'Family.qualifier'],
+                       'extension': TaxonStatsExtension()}
 
     # columns
     family = Column(String(45), nullable=False, index=True)
@@ -220,6 +223,10 @@ class FamilySynonym(db.Base):
         return Family.str(self.synonym)
 
 
+# the family completions shared by the editors
+family_completions = editor.PrefixCompletions(Family, Family.family)
+
+
 #
 # late imports
 #
@@ -390,9 +397,8 @@ class SynonymsPresenter(editor.GenericEditorPresenter):
         # seperate SpeciesSynonym models on add
         completions_model = FamilySynonym()
         def fam_get_completions(text):
-            query = self.session.query(Family)
-            return query.filter(and_(Family.family.like('%s%%' % text),
-                                     Family.id != self.model.id))
+            return family_completions.get(self.session, text,
+                                          exclude=[self.model.id])
 
         self._selected = None
         def on_select(value):
@@ -660,6 +666,10 @@ class GeneralFamilyExpander(InfoExpander):
                                    on_nplants_clicked)
 
 
+    def prefetch(self, row):
+        return get_taxon_stats(row)
+
+
     def update(self, row):
         '''
         update the expander
@@ -669,55 +679,36 @@ class GeneralFamilyExpander(InfoExpander):
         self.current_obj = row
         self.set_widget_value('fam_name_data', '<big>%s</big>' % row,
                               markup=True)
-        session = db.Session()
-        # get the number of genera
-        ngen = session.query(Genus).filter_by(family_id=row.id).count()
-        self.set_widget_value('fam_ngen_data', ngen)
+        stats = self.get_prefetched(row)
+        self.set_widget_value('fam_ngen_data', stats['ngenera'])
 
         # get the number of species
-        nsp = session.query(Species).join('genus').\
-              filter_by(family_id=row.id).count()
-        if nsp == 0:
+        if stats['nspecies'] == 0:
             self.set_widget_value('fam_nsp_data', 0)
         else:
-            ngen_in_sp = session.query(Species.genus_id).\
-                join('genus', 'family').\
-                filter_by(id=row.id).distinct().count()
             self.set_widget_value('fam_nsp_data', '%s in %s genera' \
-                                  % (nsp, ngen_in_sp))
+                                  % (stats['nspecies'],
+                                     stats['nspecies_genera']))
 
         # stop here if no GardenPlugin
         if 'GardenPlugin' not in pluginmgr.plugins:
             return
 
         # get the number of accessions in the family
-        from bauble.plugins.garden.accession import Accession
-        from bauble.plugins.garden.plant import Plant
-
-        nacc = session.query(Accession).join('species', 'genus', 'family').\
-               filter_by(id=row.id).count()
-        if nacc == 0:
-            self.set_widget_value('fam_nacc_data', nacc)
+        if stats['naccessions'] == 0:
+            self.set_widget_value('fam_nacc_data', 0)
         else:
-            nsp_in_acc = session.query(Accession.species_id).\
-                join('species', 'genus', 'family').\
-                filter_by(id=row.id).distinct().count()
             self.set_widget_value('fam_nacc_data', '%s in %s species' \
-                                  % (nacc, nsp_in_acc))
+                                  % (stats['naccessions'],
+                                     stats['naccessions_species']))
 
         # get the number of plants in the family
-        nplants = session.query(Plant).\
-                  join('accession', 'species', 'genus', 'family').\
-                  filter_by(id=row.id).count()
-        if nplants == 0:
-            self.set_widget_value('fam_nplants_data', nplants)
+        if stats['nplants'] == 0:
+            self.set_widget_value('fam_nplants_data', 0)
         else:
-            nacc_in_plants = session.query(Plant.accession_id).\
-                join('accession', 'species', 'genus','family').\
-                filter_by(id=row.id).distinct().count()
             self.set_widget_value('fam_nplants_data', '%s in %s accessions' \
-                                  % (nplants, nacc_in_plants))
-        session.close()
+                                  % (stats['nplants'],
+                                     stats['nplants_accessions']))
 
 
 
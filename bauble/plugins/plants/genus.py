@@ -24,6 +24,8 @@ import bauble.btypes as types
 from bauble.utils.log import debug
 import bauble.paths as paths
 from bauble.prefs import prefs
+from bauble.plugins.plants.taxon_stats import TaxonStatsExtension, \
+    get_taxon_stats
 from bauble.view import InfoBox, InfoExpander, PropertiesExpander, \
      select_in_search_results, Action
 import bauble.view as view
@@ -104,6 +106,19 @@ def genus_markup_func(genus):
 
 
 
+# the species sort keys start with the genus name so update them
+# when the genus changes
+class GenusMapperExtension(MapperExtension):
+
+    def after_update(self, mapper, conn, instance):
+        values = [(sp.id, species_sort_key(sp)) for sp in instance.species \
+                      if sp.id is not None]
+        db.set_sort_keys(conn, Species.__tablename__, values)
+        # the genus name is part of every cached species name
+        invalidate_species_str()
+        return EXT_CONTINUE
+
+
 class Genus(db.Base):
     """
     :Table name: genus
@@ -142,7 +157,10 @@ class Genus(db.Base):
     __table_args__ = (UniqueConstraint('genus', 'author',
                                        'qualifier', 'family_id'),
                       {})
-    __mapper_args__ = {'order_by': ['genus', 'author']}
+    __mapper_args__ = {'order_by': ['genus', 'author'],
+                       'extension': [GenusMapperExtension(),
+                                     TaxonStatsExtension('family', 'family_id',
+                                                         'family')]}
 
     # columns
     genus = Column(String(64), nullable=False, index=True)
@@ -232,9 +250,15 @@ class GenusSynonym(db.Base):
         return str(self.synonym)
 
 
+# the genus completions shared by the editors
+genus_completions = editor.PrefixCompletions(Genus, Genus.genus)
+
+
 # late bindings
-from bauble.plugins.plants.family import Family, FamilySynonym
-from bauble.plugins.plants.species_model import Species
+from bauble.plugins.plants.family import Family, FamilySynonym, \
+    family_completions
+from bauble.plugins.plants.species_model import Species, species_sort_key, \
+    invalidate_species_str
 from bauble.plugins.plants.species_editor import SpeciesEditor
 Genus.species = relation('Species', cascade='all, delete-orphan',
                          order_by=[Species.sp],
@@ -354,8 +378,7 @@ class GenusEditorPresenter(editor.GenericEditorPresenter):
 
         # connect signals
         def fam_get_completions(text):
-            query = self.session.query(Family)
-            return query.filter(Family.family.like('%s%%' % text))
+            return family_completions.get(self.session, text)
         def on_select(value):
             #debug('on select: %s' % value)
             for kid in self.view.widgets.message_box_parent.get_children():
@@ -480,9 +503,8 @@ class SynonymsPresenter(editor.GenericEditorPresenter):
         # seperate SpeciesSynonym models on add
         completions_model = GenusSynonym()
         def gen_get_completions(text):
-            query = self.session.query(Genus)
-            return query.filter(and_(Genus.genus.like('%s%%' % text),
-                                     Genus.id != self.model.id))
+            return genus_completions.get(self.session, text,
+                                         exclude=[self.model.id])
 
         self._selected = None
         def on_select(value):
@@ -813,13 +835,16 @@ class GeneralGenusExpander(InfoExpander):
                                    on_nplants_clicked)
 
 
+    def prefetch(self, row):
+        return get_taxon_stats(row)
+
+
     def update(self, row):
         '''
         update the expander
 
         :param row: the row to get the values from
         '''
-        session = db.Session()
         self.current_obj = row
         self.set_widget_value('gen_name_data', '<big>%s</big> %s' % \
                                   (row, utils.xml_safe(unicode(row.author))),
@@ -827,42 +852,29 @@ class GeneralGenusExpander(InfoExpander):
         self.set_widget_value('gen_fam_data',
                               (utils.xml_safe(unicode(row.family))))
 
+        stats = self.get_prefetched(row)
         # get the number of species
-        nsp = session.query(Species).join('genus').filter_by(id=row.id).count()
-        self.set_widget_value('gen_nsp_data', nsp)
+        self.set_widget_value('gen_nsp_data', stats['nspecies'])
 
         # stop here if no GardenPlugin
         if 'GardenPlugin' not in pluginmgr.plugins:
             return
 
-        from bauble.plugins.garden.accession import Accession
-        from bauble.plugins.garden.plant import Plant
-
         # get number of accessions
-        nacc = session.query(Accession).join('species', 'genus').\
-               filter_by(id=row.id).count()
-        if nacc == 0:
-            self.set_widget_value('gen_nacc_data', nacc)
+        if stats['naccessions'] == 0:
+            self.set_widget_value('gen_nacc_data', 0)
         else:
-            nsp_in_acc = session.query(Accession.species_id).\
-                         join('species', 'genus').\
-                         filter_by(id=row.id).distinct().count()
             self.set_widget_value('gen_nacc_data', '%s in %s species' \
-                                  % (nacc, nsp_in_acc))
+                                  % (stats['naccessions'],
+                                     stats['naccessions_species']))
 
         # get the number of plants in the genus
-        nplants = session.query(Plant).\
-                  join('accession', 'species', 'genus').\
-                  filter_by(id=row.id).count()
-        if nplants == 0:
-            self.set_widget_value('gen_nplants_data', nplants)
+        if stats['nplants'] == 0:
+            self.set_widget_value('gen_nplants_data', 0)
         else:
-            nacc_in_plants = session.query(Plant.accession_id).\
-                    join('accession', 'species', 'genus').\
-                    filter_by(id=row.id).distinct().count()
             self.set_widget_value('gen_nplants_data', '%s in %s accessions' \
-                                  % (nplants, nacc_in_plants))
-        session.close()
+                                  % (stats['nplants'],
+                                     stats['nplants_accessions']))
 
 
 
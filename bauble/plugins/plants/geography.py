@@ -1,6 +1,7 @@
 #
 # geography.py
 #
+from array import array
 from operator import itemgetter
 
 import gobject
@@ -13,6 +14,131 @@ import bauble.db as db
 from bauble.utils.log import debug
 
 
+class GeographyTree(object):
+    """
+    An in memory copy of the geography hierarchy.
+
+    The geography ids are stored in a pre-order traversal of the tree
+    so that all the descendants of a geography are in a contiguous
+    range, i.e. geography a is a descendant of geography b if
+    pos[b] <= pos[a] < end[b].
+
+    :param rows: a list of (id, name, parent_id) tuples
+    """
+
+    def __init__(self, rows):
+        self._kids = {}
+        for geo_id, name, parent_id in rows:
+            try:
+                self._kids[parent_id].append((geo_id, name))
+            except KeyError:
+                self._kids[parent_id] = [(geo_id, name)]
+        for kids in self._kids.values():
+            kids.sort(key=itemgetter(1)) # sort by name
+
+        self._ids = array('l')
+        self._end = array('l')
+        self._pos = {}
+        # walk the tree without recursion, (geo_id, True) on the stack
+        # marks the end of the subtree of geo_id
+        stack = [(geo_id, None) for geo_id, name in \
+                     reversed(self._kids.get(None, []))]
+        while stack:
+            geo_id, done = stack.pop()
+            if done:
+                self._end[self._pos[geo_id]] = len(self._ids)
+                continue
+            self._pos[geo_id] = len(self._ids)
+            self._ids.append(geo_id)
+            self._end.append(0)
+            stack.append((geo_id, True))
+            for kid_id, kid_name in reversed(self._kids.get(geo_id, [])):
+                stack.append((kid_id, None))
+
+
+    def __len__(self):
+        return len(self._ids)
+
+
+    def __contains__(self, geo_id):
+        return geo_id in self._pos
+
+
+    def get_kids(self, parent_id):
+        """
+        Return a list of (id, name) tuples of the children of parent_id
+        sorted by name.  If parent_id is None then return the top level
+        geographies.
+        """
+        return self._kids.get(parent_id, [])
+
+
+    def has_kids(self, geo_id):
+        return len(self._kids.get(geo_id, [])) > 0
+
+
+    def is_descendant(self, geo_id, ancestor_id):
+        """
+        Return True if geo_id is ancestor_id or one of its descendants.
+        """
+        try:
+            pos = self._pos[geo_id]
+            start = self._pos[ancestor_id]
+        except KeyError:
+            return False
+        return start <= pos < self._end[start]
+
+
+    def descendants(self, geo_id):
+        """
+        Return a list of geo_id and the ids of all its descendants.
+        """
+        try:
+            start = self._pos[geo_id]
+        except KeyError:
+            return []
+        return self._ids[start:self._end[start]].tolist()
+
+
+# the GeographyTree for the current engine
+_geography_tree = None
+_geography_tree_engine = None
+
+
+def get_geography_tree():
+    """
+    Return the GeographyTree for the current database connection.  The
+    tree is only loaded from the database the first time this function
+    is called after a connection is opened or reset_geography_tree()
+    has been called.
+    """
+    global _geography_tree, _geography_tree_engine
+    if _geography_tree is None or _geography_tree_engine is not db.engine:
+        table = Geography.__table__
+        stmt = select([table.c.id, table.c.name, table.c.parent_id])
+        _geography_tree = GeographyTree(db.engine.execute(stmt).fetchall())
+        _geography_tree_engine = db.engine
+    return _geography_tree
+
+
+def reset_geography_tree():
+    """
+    Forget the cached GeographyTree so that it is reloaded the next
+    time get_geography_tree() is called.
+    """
+    global _geography_tree, _geography_tree_engine
+    _geography_tree = None
+    _geography_tree_engine = None
+
+
+# select the ids of a geography and all of its descendants in one query
+_descendants_sql = """WITH RECURSIVE descendants(id) AS (
+    SELECT id FROM geography WHERE id = :geo_id
+  UNION ALL
+    SELECT g.id FROM geography g JOIN descendants d ON g.parent_id = d.id)
+SELECT id FROM descendants"""
+
+
 def get_species_in_geography(geo):#, session=None):
     """
     Return all the Species that have distribution in geo
@@ -21,59 +147,32 @@ def get_species_in_geography(geo):#, session=None):
     if not session:
         ValueError('get_species_in_geography(): geography is not in a session')
 
-    # get all the geography children under geo
     from bauble.plugins.plants.species_model import SpeciesDistribution, \
         Species
-    # get the children of geo
-    geo_table = geo.__table__
-    master_ids = set([geo.id])
-    # populate master_ids with all the geography ids that represent
-    # the children of particular geography id
-    def get_geography_children(parent_id):
-        stmt = select([geo_table.c.id], geo_table.c.parent_id==parent_id)
-        kids = [r[0] for r in db.engine.execute(stmt).fetchall()]
-        for kid in kids:
-            grand_kids = get_geography_children(kid)
-            master_ids.update(grand_kids)
-        return kids
-    geokids = get_geography_children(geo.id)
-    master_ids.update(geokids)
-    q = session.query(Species).join(SpeciesDistribution).\
-        filter(SpeciesDistribution.geography_id.in_(master_ids))
-    return list(q)
+    dist_table = SpeciesDistribution.__table__
+    q = session.query(Species)
+    if db.engine.name in ('postgres', 'postgresql'):
+        # let the database walk the geography tree
+        q = q.filter('species.id IN (SELECT species_id FROM '
+                     'species_distribution WHERE geography_id IN (%s))' \
+                         % _descendants_sql).params(geo_id=geo.id)
+    else:
+        geo_ids = get_geography_tree().descendants(geo.id)
+        if not geo_ids:
+            geo_ids = [geo.id]
+        stmt = select([dist_table.c.species_id],
+                      dist_table.c.geography_id.in_(geo_ids))
+        q = q.filter(Species.id.in_(stmt))
+    return list(q.order_by(Species.id))
 
 
 class GeographyMenu(gtk.Menu):
 
     def __init__(self, callback):
         super(GeographyMenu, self).__init__()
-        geography_table = Geography.__table__
-        geos = select([geography_table.c.id, geography_table.c.name,
-                       geography_table.c.parent_id]).execute().fetchall()
-        geos_hash = {}
-        # TODO: i think the geo_hash should be calculated in an idle
-        # function so that starting the editor isn't delayed while the
-        # hash is being built
-        for geo_id, name, parent_id in geos:
-            try:
-                geos_hash[parent_id].append((geo_id, name))
-            except KeyError:
-                geos_hash[parent_id] = [(geo_id, name)]
-
-        for kids in geos_hash.values():
-            kids.sort(key=itemgetter(1)) # sort by name
-
-        def get_kids(pid):
-            try:
-                return geos_hash[pid]
-            except KeyError:
-                return []
-
-        def has_kids(pid):
-            try:
-                return len(geos_hash[pid]) > 0
-            except KeyError:
-                return False
+        tree = get_geography_tree()
+        get_kids = tree.get_kids
+        has_kids = tree.has_kids
 
         def build_menu(geo_id, name):
             item = gtk.MenuItem(name)
@@ -110,13 +209,13 @@ class GeographyMenu(gtk.Menu):
             add geography value to the menu, any top level items that don't
             have any kids are appended to the bottom of the menu
             """
-            if not geos_hash:
+            if not len(tree):
                 # we would get here if the Geography menu is populate,
                 # usually during a unit test
                 return
             no_kids = []
-            for geo_id, geo_name in geos_hash[None]:
-                if geo_id not in geos_hash.keys():
+            for geo_id, geo_name in get_kids(None):
+                if not has_kids(geo_id):
                     no_kids.append((geo_id, geo_name))
                 else:
                     self.append(build_menu(geo_id, geo_name))
@@ -129,6 +228,25 @@ class GeographyMenu(gtk.Menu):
 
 
 
+class GeographyMapperExtension(MapperExtension):
+    """
+    Reset the cached GeographyTree when a Geography is changed.
+    """
+
+    def after_insert(self, mapper, connection, instance):
+        reset_geography_tree()
+        return EXT_CONTINUE
+
+    def after_update(self, mapper, connection, instance):
+        reset_geography_tree()
+        return EXT_CONTINUE
+
+    def after_delete(self, mapper, connection, instance):
+        reset_geography_tree()
+        return EXT_CONTINUE
+
+
+
 class Geography(db.Base):
     """
     Represents a geography unit.
@@ -150,6 +268,7 @@ class Geography(db.Base):
     :Constraints:
     """
     __tablename__ = 'geography'
+    __mapper_args__ = {'extension': GeographyMapperExtension()}
 
     # columns
     name = Column(Unicode(255), nullable=False)
@@ -6,6 +6,7 @@ import bauble.pluginmgr as pluginmgr
 from bauble.prefs import prefs
 from bauble.plugins.plants.species_editor import *
 from bauble.plugins.plants.species_model import *
+from bauble.plugins.plants.taxon_stats import get_taxon_stats
 import bauble.search as search
 from bauble.view import SearchView, PropertiesExpander, Action
 import bauble.view as view
@@ -280,6 +281,10 @@ class GeneralSpeciesExpander(InfoExpander):
                                    on_nplants_clicked)
 
 
+    def prefetch(self, row):
+        return get_taxon_stats(row)
+
+
     def update(self, row):
         '''
         update the expander
@@ -291,7 +296,6 @@ class GeneralSpeciesExpander(InfoExpander):
         # can be clickable but still respect the text wrap to wrap
         # around and indent from the genus name instead of from the
         # species name
-        session = db.Session()
         self.set_widget_value('sp_name_data', '<big>%s</big>' % \
                               row.markup(True), markup=True)
 
@@ -324,24 +328,15 @@ class GeneralSpeciesExpander(InfoExpander):
         if 'GardenPlugin' not in pluginmgr.plugins:
             return
 
-        from bauble.plugins.garden.accession import Accession
-        from bauble.plugins.garden.plant import Plant
+        stats = self.get_prefetched(row)
+        self.set_widget_value('sp_nacc_data', stats['naccessions'])
 
-        nacc = session.query(Accession).join('species').\
-               filter_by(id=row.id).count()
-        self.set_widget_value('sp_nacc_data', nacc)
-
-        nplants = session.query(Plant).join('accession', 'species').\
-                    filter_by(id=row.id).count()
-        if nplants == 0:
-            self.set_widget_value('sp_nplants_data', nplants)
+        if stats['nplants'] == 0:
+            self.set_widget_value('sp_nplants_data', 0)
         else:
-            nacc_in_plants = session.query(Plant.accession_id).\
-                    join('accession', 'species').\
-                    filter_by(id=row.id).distinct().count()
             self.set_widget_value('sp_nplants_data', '%s in %s accessions' \
-                                  % (nplants, nacc_in_plants))
-        session.close()
+                                  % (stats['nplants'],
+                                     stats['nplants_accessions']))
 
 
 
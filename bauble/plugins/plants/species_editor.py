@@ -22,10 +22,16 @@ import bauble.editor as editor
 from bauble.utils.log import debug
 from bauble.plugins.plants.geography import GeographyMenu
 from bauble.plugins.plants.family import Family
-from bauble.plugins.plants.genus import Genus, GenusSynonym
+from bauble.plugins.plants.genus import Genus, GenusSynonym, \
+    genus_completions
 from bauble.plugins.plants.species_model import *
 
 
+# the species completions by genus name shared by the editors
+species_completions = editor.PrefixCompletions(Species, Genus.genus,
+                                               join='genus')
+
+
 class SpeciesEditorPresenter(editor.GenericEditorPresenter):
 
     PROBLEM_INVALID_GENUS = 1
@@ -88,8 +94,7 @@ class SpeciesEditorPresenter(editor.GenericEditorPresenter):
 
         # connect signals
         def gen_get_completions(text):
-            clause = utils.ilike(Genus.genus, '%s%%' % unicode(text))
-            return self.session.query(Genus).filter(clause)
+            return genus_completions.get(self.session, text)
 
         # called a genus is selected from the genus completions
         def on_select(value):
@@ -719,10 +724,8 @@ class SynonymsPresenter(editor.GenericEditorPresenter):
         # seperate SpeciesSynonym models on add
         completions_model = SpeciesSynonym()
         def sp_get_completions(text):
-            query = self.session.query(Species).join('genus').\
-                filter(utils.ilike(Genus.genus, '%s%%' % text)).\
-                filter(Species.id != self.model.id)
-            return query
+            return species_completions.get(self.session, text,
+                                           exclude=[self.model.id])
 
         def on_select(value):
             sensitive = True
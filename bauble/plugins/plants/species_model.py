@@ -18,6 +18,7 @@ import bauble.utils as utils
 from bauble.utils.log import debug
 import bauble.btypes as types
 from bauble.plugins.plants.geography import Geography#, geography_table
+from bauble.plugins.plants.taxon_stats import TaxonStatsExtension
 
 from sqlalchemy.orm.collections import collection
 
@@ -58,6 +59,49 @@ infrasp_rank_values = {u'subsp.': _('subsp.'),
 # make sure that at least one of the specific epithet, cultivar name
 # or cultivar group is specificed
 
+def species_sort_key(species):
+    """
+    Return the string used to create the natural sort key of species.
+    """
+    return Species.str(species, authors=True)
+
+species_sort_key_ext = db.SortKeyExtension(species_sort_key)
+
+
+species_str_cache = utils.LRUCache(max_size=5000)
+"""
+A process wide cache of formatted species names used by
+:meth:`bauble.plugins.garden.Accession.species_str`.  The keys are
+species ids and the values are dicts of (id_qual, id_qual_rank,
+authors, markup) -> name.
+"""
+
+def invalidate_species_str(species_id=None):
+    """
+    Remove the cached names of the species with species_id from
+    species_str_cache, if species_id is None then remove all the names.
+    """
+    if species_id is None:
+        species_str_cache.clear()
+    else:
+        species_str_cache.pop(species_id)
+
+
+class SpeciesStrCacheExtension(MapperExtension):
+    """
+    Remove the cached names of a species when it changes.
+    """
+
+    def after_update(self, mapper, conn, instance):
+        invalidate_species_str(instance.id)
+        return EXT_CONTINUE
+
+
+    def after_delete(self, mapper, conn, instance):
+        invalidate_species_str(instance.id)
+        return EXT_CONTINUE
+
+
 class Species(db.Base):
     """
     :Table name: species
@@ -120,7 +164,11 @@ class Species(db.Base):
         cv_group, trade_name, genus_id
     """
     __tablename__ = 'species'
-    __mapper_args__ = {'order_by': ['sp', 'sp_author']}
+    __mapper_args__ = {'order_by': ['sp', 'sp_author'],
+                       'extension': [species_sort_key_ext,
+                                     SpeciesStrCacheExtension(),
+                                     TaxonStatsExtension('genus', 'genus_id',
+                                                         'genus')]}
 
 
     # columns
@@ -0,0 +1,485 @@
+#
+# taxon_stats.py
+#
+"""
+The taxon_stats table holds the number of genera, species, accessions
+and plants for each family, genus and species so that the infoboxes
+can read them from one row instead of counting them each time.
+
+The rows are created the first time the stats of a taxon are requested
+and are marked as stale by :class:`TaxonStatsExtension` when a change
+to a genus, species, accession or plant changes the counts.  Marking a
+row also increments its version so that counts from before the change
+aren't stored over it.  The whole table can be rebuilt with the
+``taxonstats`` command.
+"""
+import weakref
+
+from sqlalchemy import *
+from sqlalchemy.orm import MapperExtension, SessionExtension, EXT_CONTINUE, \
+    object_session
+import sqlalchemy.orm.attributes as attributes
+
+import bauble.db as db
+import bauble.pluginmgr as pluginmgr
+import bauble.utils as utils
+from bauble.utils.log import debug, warning
+
+
+# the names of the counts in the taxon_stats table
+count_names = ['ngenera', 'nspecies', 'nspecies_genera', 'naccessions',
+               'naccessions_species', 'nplants', 'nplants_accessions']
+
+taxon_stats_table = Table('taxon_stats', db.metadata,
+                          Column('id', Integer, primary_key=True),
+                          Column('table_name', String(32), nullable=False),
+                          Column('table_id', Integer, nullable=False,
+                                 autoincrement=False),
+                          Column('version', Integer, nullable=False,
+                                 default=0),
+                          Column('stale', Boolean, nullable=False,
+                                 default=False),
+                          *[Column(name, Integer, nullable=False, default=0) \
+                                for name in count_names])
+Index('ix_taxon_stats_table_id', taxon_stats_table.c.table_name,
+      taxon_stats_table.c.table_id, unique=True)
+
+
+# the maximum number of ids in an IN clause
+_chunk_size = 500
+
+
+def _chunks(ids):
+    """
+    Yield ids in lists of at most _chunk_size items.
+    """
+    ids = list(ids)
+    for i in xrange(0, len(ids), _chunk_size):
+        yield ids[i:i+_chunk_size]
+
+
+# the tables from plant up to family, each table has a foreign key to
+# the next table in the chain
+_chain = [('plant', 'accession_id'), ('accession', 'species_id'),
+          ('species', 'genus_id'), ('genus', 'family_id'), ('family', None)]
+_chain_names = [name for name, key in _chain]
+
+# the counted table -> the counts, the counts are the number of rows
+# and the number of distinct parents of the rows
+_counts = {'genus': ['ngenera'],
+           'species': ['nspecies', 'nspecies_genera'],
+           'accession': ['naccessions', 'naccessions_species'],
+           'plant': ['nplants', 'nplants_accessions']}
+
+
+def _count_selects(table_name):
+    """
+    Return a list of (select, taxon_key, names) for the counts of the
+    taxa in table_name.  Each select returns the id of the taxon,
+    i.e. the taxon_key column, followed by the counts in names.  The
+    counts of the tables that aren't in the metadata, e.g. if the
+    garden plugin isn't loaded, are skipped.
+
+    :param table_name: one of family, genus or species
+    """
+    tables = db.metadata.tables
+    level = _chain_names.index(table_name)
+    selects = []
+    for i, (name, key) in enumerate(_chain[:level]):
+        if name not in tables or name not in _counts:
+            continue
+        table = tables[name]
+        # join the counted table up to the table with the foreign key
+        # to the taxon table
+        from_obj = table
+        for j in range(i+1, level):
+            parent, parent_key = _chain[j]
+            if parent not in tables:
+                from_obj = None
+                break
+            child, child_key = _chain[j-1]
+            from_obj = from_obj.join(tables[parent],
+                                tables[child].c[child_key] == \
+                                    tables[parent].c.id)
+        if from_obj is None:
+            continue
+        taxon_key = tables[_chain[level-1][0]].c[_chain[level-1][1]]
+        stmt = select([taxon_key, func.count(table.c.id),
+                       func.count(distinct(table.c[key]))],
+                      from_obj=[from_obj]).group_by(taxon_key)
+        selects.append((stmt, taxon_key, _counts[name]))
+    return selects
+
+
+def compute_taxon_stats(conn, table_name, ids=None):
+    """
+    Return a dict of taxon id -> dict of counts for the taxa in
+    table_name.
+
+    :param conn: the connection to use
+    :param table_name: one of family, genus or species
+    :param ids: the ids of the taxa, if None then count all the taxa
+    """
+    results = {}
+    if ids is not None:
+        for taxon_id in ids:
+            results[taxon_id] = dict([(name, 0) for name in count_names])
+    for stmt, taxon_key, names in _count_selects(table_name):
+        if ids is not None:
+            stmt = stmt.where(taxon_key.in_(ids))
+        for row in conn.execute(stmt):
+            stats = results.setdefault(row[0], dict([(name, 0) \
+                                                     for name in count_names]))
+            stats[names[0]] = row[1]
+            if len(names) > 1:
+                stats[names[1]] = row[2]
+    return results
+
+
+def get_taxon_stats(obj):
+    """
+    Return a dict of the counts for the Family, Genus or Species obj.
+
+    The counts are read from the taxon_stats table and are only
+    counted if there isn't a row for obj yet or the row is stale.  The
+    new counts are only stored if the row wasn't marked as stale again
+    while they were counted, otherwise they could be from before a
+    change that is committed in the meantime.
+    """
+    t = taxon_stats_table
+    table_name = obj.__tablename__
+    engine = db.get_separate_engine()
+    session = object_session(obj)
+    if engine is db.engine and engine.name == 'sqlite' and \
+            session is not None:
+        # an in memory SQLite database shares the DBAPI connection
+        # with the session so the row is added in the session's
+        # transaction instead of committing the session's changes
+        conn = session.connection()
+        close = False
+    else:
+        conn = engine.connect()
+        close = True
+    try:
+        where = and_(t.c.table_name == table_name, t.c.table_id == obj.id)
+        row = conn.execute(select([t], where)).fetchone()
+        if row is not None and not row['stale']:
+            return dict([(name, row[name]) for name in count_names])
+        stats = compute_taxon_stats(conn, table_name, [obj.id])[obj.id]
+        trans = None
+        if close:
+            trans = conn.begin()
+        try:
+            if row is None:
+                # fails if a change has added a stale row in the meantime
+                values = dict(stats)
+                values.update(table_name=table_name, table_id=obj.id)
+                conn.execute(t.insert(), values)
+            else:
+                # don't wait for a pending change to the row, on
+                # PostgreSQL this fails if the row is locked
+                conn.execute(select([t.c.id], t.c.id == row['id'],
+                                    for_update='nowait'))
+                values = dict(stats)
+                values['stale'] = False
+                conn.execute(t.update(and_(t.c.id == row['id'],
+                                           t.c.version == row['version']),
+                                      values=values))
+            if trans is not None:
+                trans.commit()
+        except Exception, e:
+            # another connection might have added the row first or be
+            # changing it
+            debug('get_taxon_stats(): %s' % utils.utf8(e))
+            if trans is not None:
+                trans.rollback()
+        return stats
+    finally:
+        if close:
+            conn.close()
+
+
+def delete_taxon_stats(conn, table_name, ids):
+    """
+    Remove the taxon_stats rows for the taxa in table_name with ids.
+    """
+    t = taxon_stats_table
+    for chunk in _chunks(ids):
+        conn.execute(t.delete().where(and_(t.c.table_name == table_name,
+                                           t.c.table_id.in_(chunk))))
+
+
+def _mark_stale(conn, table_name, ids):
+    """
+    Mark the taxon_stats rows of the taxa in table_name with ids as
+    stale and increment their versions.  A stale row is added for the
+    taxa that don't have a row yet so that get_taxon_stats() can't
+    add one with counts from before the change.
+    """
+    t = taxon_stats_table
+    missing = set(ids)
+    for chunk in _chunks(sorted(ids)):
+        where = and_(t.c.table_name == table_name, t.c.table_id.in_(chunk))
+        conn.execute(t.update(where, values={t.c.version: t.c.version + 1,
+                                             t.c.stale: True}))
+        missing.difference_update([r[0] for r in \
+                                       conn.execute(select([t.c.table_id],
+                                                           where))])
+    if not missing:
+        return
+    rows = [dict(table_name=table_name, table_id=taxon_id, version=1,
+                 stale=True) for taxon_id in sorted(missing)]
+    if conn.dialect.name == 'sqlite':
+        # SQLite only has one writer at a time so the rows can't have
+        # been added since, and pysqlite would commit on a SAVEPOINT
+        conn.execute(t.insert(), rows)
+        return
+    savepoint = conn.begin_nested()
+    try:
+        conn.execute(t.insert(), rows)
+        savepoint.commit()
+    except Exception, e:
+        # get_taxon_stats() or another change added some of the rows
+        # first, mark them instead
+        debug('taxon_stats: %s' % utils.utf8(e))
+        savepoint.rollback()
+        _mark_stale(conn, table_name, missing)
+
+
+def invalidate_taxon_stats(conn, table_name, ids):
+    """
+    Mark the stats of the rows in table_name with ids and of all the
+    taxa above them as stale.
+
+    :param conn: the connection to use
+    :param table_name: one of plant, accession, species, genus or family
+    :param ids: the ids of the rows
+    """
+    invalidate_all_taxon_stats(conn, {table_name: ids})
+
+
+def invalidate_all_taxon_stats(conn, ids):
+    """
+    Like invalidate_taxon_stats() but for the rows of more than one
+    table, the parents of the rows are only looked up once for each
+    table.
+
+    :param conn: the connection to use
+    :param ids: a dict of table name -> the ids of the rows
+    """
+    tables = db.metadata.tables
+    parent_ids = set()
+    for name, key in _chain:
+        parent_ids.update([i for i in ids.get(name, []) if i is not None])
+        if not parent_ids:
+            continue
+        if name in ('family', 'genus', 'species'):
+            _mark_stale(conn, name, parent_ids)
+        if key is None:
+            break
+        table = tables[name]
+        next_ids = set()
+        for chunk in _chunks(parent_ids):
+            stmt = select([table.c[key]], table.c.id.in_(chunk)).distinct()
+            next_ids.update([r[0] for r in conn.execute(stmt) \
+                                 if r[0] is not None])
+        parent_ids = next_ids
+
+
+def rebuild_taxon_stats():
+    """
+    Recount the stats of all the families, genera and species.
+    """
+    t = taxon_stats_table
+    conn = db.engine.connect()
+    trans = conn.begin()
+    try:
+        try:
+            t.create(bind=conn, checkfirst=True)
+            conn.execute(t.delete())
+            for table_name in ('family', 'genus', 'species'):
+                rows = []
+                for taxon_id, stats in \
+                        compute_taxon_stats(conn, table_name).iteritems():
+                    if taxon_id is None:
+                        continue
+                    values = dict(stats)
+                    values.update(table_name=table_name, table_id=taxon_id)
+                    rows.append(values)
+                if rows:
+                    conn.execute(t.insert(), rows)
+            trans.commit()
+        except Exception, e:
+            warning('rebuild_taxon_stats(): %s' % utils.utf8(e))
+            trans.rollback()
+            raise
+    finally:
+        conn.close()
+
+
+def check_taxon_stats():
+    """
+    Create the taxon_stats table if it doesn't exist, e.g. for a
+    database created before the table was added.  A table without the
+    version column is recreated, the rows are counted again when
+    they're needed.
+    """
+    from sqlalchemy.engine.reflection import Inspector
+    try:
+        if taxon_stats_table.exists(bind=db.engine):
+            inspector = Inspector.from_engine(db.engine)
+            columns = [c['name'] for c in \
+                           inspector.get_columns(taxon_stats_table.name)]
+            if 'version' not in columns:
+                taxon_stats_table.drop(bind=db.engine)
+        taxon_stats_table.create(bind=db.engine, checkfirst=True)
+    except Exception, e:
+        warning('check_taxon_stats(): %s' % utils.utf8(e))
+
+
+
+class TaxonStatsWriter(SessionExtension):
+    """
+    Collect the rows that :class:`TaxonStatsExtension` invalidates
+    during a flush and mark their stats as stale all at once at the
+    end of the flush, like :class:`bauble.db.HistoryWriter` does for
+    the history rows.
+    """
+
+    def __init__(self):
+        # session -> (connection, {table name: ids},
+        #             {table name: deleted taxon ids}) for the current flush
+        self._flushing = weakref.WeakKeyDictionary()
+
+
+    def add(self, session, connection, table_name, ids, deleted=False):
+        """
+        Buffer the ids of the rows in table_name for session.  If
+        deleted is True then ids are the ids of deleted taxa whose
+        rows are removed.
+
+        Return False if the ids couldn't be buffered because session
+        doesn't use this extension.
+        """
+        if session is None or self not in session.extensions:
+            return False
+        if session not in self._flushing:
+            self._flushing[session] = (connection, {}, {})
+        if deleted:
+            pending = self._flushing[session][2]
+        else:
+            pending = self._flushing[session][1]
+        pending.setdefault(table_name, set()).update(ids)
+        return True
+
+
+    def before_flush(self, session, flush_context, instances):
+        # drop anything left over from a flush that failed
+        self._flushing.pop(session, None)
+
+
+    def after_flush(self, session, flush_context):
+        connection, ids, deleted = self._flushing.pop(session,
+                                                      (None, {}, {}))
+        if ids:
+            invalidate_all_taxon_stats(connection, ids)
+        for table_name, taxon_ids in deleted.iteritems():
+            delete_taxon_stats(connection, table_name, taxon_ids)
+
+
+    def after_rollback(self, session):
+        self._flushing.pop(session, None)
+
+
+taxon_stats_writer = TaxonStatsWriter()
+"""The :class:`TaxonStatsWriter` the plants plugin adds to the sessions
+created with bauble.db.Session
+"""
+
+
+
+class TaxonStatsExtension(MapperExtension):
+    """
+    Mark the taxon_stats rows that count an instance as stale when it
+    is inserted, deleted or moved to another parent.  The rows are
+    marked at the end of the flush by :data:`taxon_stats_writer` or
+    right away if the session doesn't use it.
+
+    :param parent_table: the name of the table the instance's parent
+      is in or None if the instance doesn't have a parent that is
+      counted, e.g. for Family
+    :param key: the name of the foreign key to the parent
+    :param relation: the name of the relation to the parent
+    """
+
+    def __init__(self, parent_table=None, key=None, relation=None):
+        super(TaxonStatsExtension, self).__init__()
+        self.parent_table = parent_table
+        self.key = key
+        self.relation = relation
+
+
+    def _parent_ids(self, instance, changed=False):
+        """
+        Return the ids of the parents of instance.  If changed is True
+        then only return the ids if the parent has changed but return
+        the old and the new parent.
+        """
+        ids = set()
+        passive = attributes.PASSIVE_NO_INITIALIZE
+        for name in (self.key, self.relation):
+            history = attributes.get_history(instance, name, passive=passive)
+            for value in list(history.added or []) + \
+                    list(history.deleted or []):
+                if value is not None and name == self.relation:
+                    value = value.id
+                ids.add(value)
+        if changed and not ids:
+            return ids
+        ids.add(attributes.instance_dict(instance).get(self.key, None))
+        return ids
+
+
+    def _invalidate(self, connection, instance, ids):
+        session = object_session(instance)
+        if not taxon_stats_writer.add(session, connection, self.parent_table,
+                                      ids):
+            invalidate_taxon_stats(connection, self.parent_table, ids)
+
+
+    def after_insert(self, mapper, connection, instance):
+        if self.parent_table:
+            self._invalidate(connection, instance, self._parent_ids(instance))
+        return EXT_CONTINUE
+
+
+    def after_update(self, mapper, connection, instance):
+        if self.parent_table:
+            self._invalidate(connection, instance,
+                             self._parent_ids(instance, changed=True))
+        return EXT_CONTINUE
+
+
+    def after_delete(self, mapper, connection, instance):
+        if self.parent_table:
+            self._invalidate(connection, instance, self._parent_ids(instance))
+        table_name = mapper.local_table.name
+        if table_name in ('family', 'genus', 'species'):
+            # the row is removed after the stale rows are added so
+            # that it isn't added again if the taxon's children are
+            # deleted in the same flush
+            session = object_session(instance)
+            if not taxon_stats_writer.add(session, connection, table_name,
+                                          [instance.id], deleted=True):
+                delete_taxon_stats(connection, table_name, [instance.id])
+        return EXT_CONTINUE
+
+
+
+class TaxonStatsCommandHandler(pluginmgr.CommandHandler):
+
+    command = 'taxonstats'
+
+    def __call__(self, cmd, arg):
+        rebuild_taxon_stats()
+        utils.message_dialog(_('The taxon stats have been rebuilt.'))
@@ -319,6 +319,92 @@ class FamilyTests(PlantTestCase):
         f.qualifier = 's. lat.'
         self.assert_(str(f) == 'fam s. lat.')
 
+    def test_taxon_stats(self):
+        """
+        Test that the taxon stats are counted and updated
+        """
+        from bauble.plugins.plants.taxon_stats import get_taxon_stats, \
+            rebuild_taxon_stats
+        family = Family(family=u'fam')
+        genus = Genus(family=family, genus=u'gen')
+        genus2 = Genus(family=family, genus=u'gen2')
+        sp1 = Species(genus=genus, sp=u'sp1')
+        sp2 = Species(genus=genus, sp=u'sp2')
+        self.session.add_all([family, genus, genus2, sp1, sp2])
+        self.session.commit()
+        stats = get_taxon_stats(family)
+        self.assert_(stats['ngenera'] == 2, stats)
+        self.assert_(stats['nspecies'] == 2, stats)
+        self.assert_(stats['nspecies_genera'] == 1, stats)
+        self.assert_(get_taxon_stats(genus)['nspecies'] == 2)
+
+        # adding a species removes the stats of its genus and family
+        sp3 = Species(genus=genus2, sp=u'sp3')
+        self.session.add(sp3)
+        self.session.commit()
+        stats = get_taxon_stats(family)
+        self.assert_(stats['nspecies'] == 3, stats)
+        self.assert_(stats['nspecies_genera'] == 2, stats)
+
+        # so does moving a species to another genus
+        sp2.genus = genus2
+        self.session.commit()
+        self.assert_(get_taxon_stats(genus)['nspecies'] == 1)
+        self.assert_(get_taxon_stats(genus2)['nspecies'] == 2)
+
+        self.session.delete(sp3)
+        self.session.commit()
+        self.assert_(get_taxon_stats(family)['nspecies'] == 2)
+
+        rebuild_taxon_stats()
+        stats = get_taxon_stats(family)
+        self.assert_(stats['ngenera'] == 2, stats)
+        self.assert_(stats['nspecies'] == 2, stats)
+        self.assert_(stats['nspecies_genera'] == 2, stats)
+        self.assert_(get_taxon_stats(genus2)['nspecies'] == 1)
+
+        # the counts aren't stored if the stats are marked as stale
+        # while they are being counted
+        import bauble.plugins.plants.taxon_stats as taxon_stats
+        compute = taxon_stats.compute_taxon_stats
+        def compute_and_invalidate(conn, table_name, ids=None):
+            stats = compute(conn, table_name, ids)
+            taxon_stats.invalidate_taxon_stats(conn, 'species', [sp1.id])
+            return stats
+        self.session.add(Species(genus=genus, sp=u'sp4'))
+        self.session.commit()
+        t = taxon_stats.taxon_stats_table
+        stmt = select([t.c.stale, t.c.version],
+                      and_(t.c.table_name == 'family',
+                           t.c.table_id == family.id))
+        stale, version = self.session.execute(stmt).fetchone()
+        self.assert_(stale)
+        taxon_stats.compute_taxon_stats = compute_and_invalidate
+        try:
+            stats = get_taxon_stats(family)
+        finally:
+            taxon_stats.compute_taxon_stats = compute
+        self.assert_(stats['nspecies'] == 3, stats)
+        row = self.session.execute(stmt).fetchone()
+        self.assert_(row['stale'] and row['version'] == version + 1, row)
+        self.assert_(get_taxon_stats(family)['nspecies'] == 3)
+        self.assert_(not self.session.execute(stmt).fetchone()['stale'])
+
+        # the taxa without a row get a stale row so that counts from
+        # before the change can't be added
+        sp5 = Species(genus=genus2, sp=u'sp5')
+        self.session.add(sp5)
+        self.session.commit()
+        stmt = select([t.c.stale], and_(t.c.table_name == 'species',
+                                        t.c.table_id == sp5.id))
+        self.assert_(self.session.execute(stmt).scalar() is None)
+        conn = self.session.connection()
+        taxon_stats.invalidate_taxon_stats(conn, 'species', [sp5.id])
+        self.assert_(self.session.execute(stmt).scalar() == True)
+        self.session.commit()
+        self.assert_(get_taxon_stats(sp5)['nspecies'] == 0)
+        self.assert_(self.session.execute(stmt).scalar() == False)
+
     def itest_editor(self):
         """
         Interactively test the PlantEditor
@@ -426,6 +512,45 @@ class GenusTests(PlantTestCase):
         pass
 
 
+    def test_prefix_completions(self):
+        """
+        Test that the genus completions are limited and that longer
+        prefixes are filtered from the cached results
+        """
+        from bauble.editor import PrefixCompletions
+        family = self.session.query(Family).first()
+        for name in (u'Maa', u'Mab', u'Mba', u'Mbb'):
+            self.session.add(Genus(family=family, genus=name))
+        self.session.commit()
+        completions = PrefixCompletions(Genus, Genus.genus)
+        completions.limit = 2
+        results = completions.get(self.session, u'ma')
+        self.assert_(len(results) == 2, results)
+        self.assert_(not results.complete)
+        # the results for m were truncated so mb has to be queried
+        rows, complete = completions.get_keys(u'm')
+        self.assert_(not complete and len(rows) == 2, rows)
+        self.assert_(u'mb' not in completions.cache)
+        rows, complete = completions.get_keys(u'MAA')
+        self.assert_(complete and [r[1] for r in rows] == [u'Maa'], rows)
+
+        # prefixes of results that weren't truncated are filtered
+        # without a query
+        completions.limit = 10
+        completions.clear()
+        completions.get_keys(u'm')
+        completions.cache[u'm'][0].append((-1, u'Mbz'))
+        rows, complete = completions.get_keys(u'mbz')
+        self.assert_(complete and rows == [(-1, u'Mbz')], rows)
+
+        # excluded ids and ids that don't exist are left out
+        results = completions.get(self.session, u'mbz')
+        self.assert_(list(results) == [], results)
+        genus = self.session.query(Genus).filter_by(genus=u'Mbb').one()
+        results = completions.get(self.session, u'mb', exclude=[genus.id])
+        self.assert_([g.genus for g in results] == [u'Mba'], results)
+
+
     def itest_editor(self):
         """
         Interactively test the PlantEditor
@@ -766,6 +891,31 @@ class GeographyTests(PlantTestCase):
         self.assert_([s.id for s in species] == [sp1.id, sp2.id, sp3.id])
 
 
+    def test_geography_tree(self):
+        rows = [(1, u'b', None), (2, u'a', None), (3, u'c', 1), (4, u'd', 3),
+                (5, u'e', 1), (6, u'f', 2)]
+        tree = GeographyTree(rows)
+        self.assert_(len(tree) == 6)
+        self.assert_(tree.get_kids(None) == [(2, u'a'), (1, u'b')])
+        self.assert_(tree.get_kids(1) == [(3, u'c'), (5, u'e')])
+        self.assert_(tree.has_kids(3) and not tree.has_kids(4))
+        self.assert_(sorted(tree.descendants(1)) == [1, 3, 4, 5])
+        self.assert_(tree.descendants(4) == [4])
+        self.assert_(tree.descendants(99) == [])
+        self.assert_(tree.is_descendant(4, 1))
+        self.assert_(tree.is_descendant(1, 1))
+        self.assert_(not tree.is_descendant(1, 4))
+        self.assert_(not tree.is_descendant(6, 1))
+
+        # the tree is cached until a geography is changed
+        tree = get_geography_tree()
+        self.assert_(get_geography_tree() is tree)
+        self.session.add(Geography(name=u'geo'))
+        self.session.commit()
+        self.assert_(get_geography_tree() is not tree)
+        self.assert_(len(get_geography_tree()) == len(tree) + 1)
+
+
 # TODO: maybe the following could be in a seperate file called
 # profile.py or something that would profile everything in the plants
 # module
@@ -3,6 +3,7 @@
 #
 # Description : report plugin
 #
+import itertools
 import os
 import sys
 import traceback
@@ -11,6 +12,7 @@ import re
 import gobject
 import gtk
 from sqlalchemy import *
+from sqlalchemy.orm.session import object_session
 
 import bauble
 from bauble.error import BaubleError
@@ -54,51 +56,121 @@ formatter_settings_expanded_pref = 'report.settings.expanded'
 #         _paths[parent][descendent] = query
 
 
+# the maximum number of ids to use in an IN clause, if there are more
+# ids then they are inserted into a temporary table
+max_in_ids = 500
+
+_ids_table = Table('report_ids', MetaData(),
+                   Column('grp', Integer),
+                   Column('id', Integer))
+_ids_group = itertools.count()
+
+
+def _in_ids(column, ids, session):
+    """
+    Return a clause that matches the rows where column is in ids.
+
+    :param column: the column to match
+    :param ids: a list of ids
+    :param session: the session the clause will be used in
+    """
+    if len(ids) <= max_in_ids:
+        return column.in_(ids)
+    # semi-join against a temporary table instead of creating a huge
+    # IN clause, the temporary table only lasts as long as the connection
+    conn = session.connection()
+    conn.execute('CREATE TEMPORARY TABLE IF NOT EXISTS report_ids '
+                 '(grp INTEGER, id INTEGER);')
+    group = _ids_group.next()
+    conn.execute(_ids_table.insert(), [{'grp': group, 'id': i} for i in ids])
+    return column.in_(select([_ids_table.c.id], _ids_table.c.grp == group))
+
+
+def _group_ids(objs, groups=None, tags=None):
+    """
+    Return a dict of class -> set of ids for the objects in objs.
+    The objects tagged by any Tags in objs are included instead of
+    the tags.
+    """
+    from bauble.plugins.tag import _get_tagged_object_pairs
+    if groups is None:
+        groups = {}
+    if tags is None:
+        tags = set()
+    for obj in objs:
+        if isinstance(obj, Tag):
+            if obj.id in tags:
+                continue
+            tags.add(obj.id)
+            for cls, obj_id in _get_tagged_object_pairs(obj):
+                if cls is Tag:
+                    tag = object_session(obj).query(Tag).get(obj_id)
+                    if tag is not None:
+                        _group_ids([tag], groups, tags)
+                else:
+                    groups.setdefault(cls, set()).add(obj_id)
+        else:
+            groups.setdefault(type(obj), set()).add(obj.id)
+    return groups
+
+
 def _get_all_objects(cls, get_query_func, objs, session):
     """
-    :param cls:
-    :param get_query_func:
-    :param objs:
-    :param session:
+    Return a query for all the objects of type cls that are found in
+    objs.
+
+    The objects are grouped by type and there is one query for each
+    type of object in objs.  The queries are combined with a UNION so
+    the results are distinct.
+
+    :param cls: the type of objects to return
+    :param get_query_func: a function that takes a class, a list of ids
+      and a session and returns a query of cls.id for the objects of
+      type cls found in the objects of the class with ids
+    :param objs: the objects to search
+    :param session: the session to use for the queries
     """
     if not isinstance(objs, (tuple, list)):
         objs = [objs]
-    queries = map(lambda o: get_query_func(o, session), objs)
-    unions = union(*[q.statement for q in queries])
-    results = session.query(cls).from_statement(unions)
-    # TODO: the following should work but i must be overlooking something
-    #results = session.query(cls).order_by(None).union(*queries)
-    return results
+    groups = _group_ids(objs)
+    if not groups:
+        return session.query(cls).filter(literal(False))
+    queries = [get_query_func(src_cls, list(ids), session) \
+                   for src_cls, ids in groups.iteritems()]
+    ids = union(*[q.statement for q in queries])
+    return session.query(cls).filter(cls.id.in_(ids))
 
 
-def get_plant_query(obj, session):
+def get_plant_query(cls, ids, session):
     """
+    Return a query of the ids of the plants found in the objects of
+    type cls with ids.
     """
     # as of sqlalchemy 0.5.0 we have to have the order_by(None) here
     # so that if we want to union() the statements together later it
     # will work properly
     q = session.query(Plant).order_by(None)
-    if isinstance(obj, Family):
-        return q.join('accession', 'species', 'genus', 'family').\
-               filter_by(id=obj.id)
-    elif isinstance(obj, Genus):
-        return q.join('accession', 'species', 'genus').filter_by(id=obj.id)
-    elif isinstance(obj, Species):
-        return q.join('accession', 'species').filter_by(id=obj.id)
-    elif isinstance(obj, VernacularName):
-        return q.join('accession', 'species', 'vernacular_names').\
-               filter_by(id=obj.id)
-    elif isinstance(obj, Plant):
-        return q.filter_by(id=obj.id)
-    elif isinstance(obj, Accession):
-        return q.join('accession').filter_by(id=obj.id)
-    elif isinstance(obj, Location):
-        return q.filter_by(location_id=obj.id)
-    elif isinstance(obj, Tag):
-        plants = get_all_plants(obj.objects, session)
-        return q.filter(Plant.id.in_([p.id for p in plants]))
+    if cls is Family:
+        q = q.join('accession', 'species', 'genus').\
+            filter(_in_ids(Genus.family_id, ids, session))
+    elif cls is Genus:
+        q = q.join('accession', 'species').\
+            filter(_in_ids(Species.genus_id, ids, session))
+    elif cls is Species:
+        q = q.join('accession').\
+            filter(_in_ids(Accession.species_id, ids, session))
+    elif cls is VernacularName:
+        q = q.join('accession', 'species', 'vernacular_names').\
+            filter(_in_ids(VernacularName.id, ids, session))
+    elif cls is Plant:
+        q = q.filter(_in_ids(Plant.id, ids, session))
+    elif cls is Accession:
+        q = q.filter(_in_ids(Plant.accession_id, ids, session))
+    elif cls is Location:
+        q = q.filter(_in_ids(Plant.location_id, ids, session))
     else:
-        raise BaubleError(_("Can't get plants from a %s" % type(obj).__name__))
+        raise BaubleError(_("Can't get plants from a %s" % cls.__name__))
+    return q.with_entities(Plant.id)
 
 
 def get_all_plants(objs, session):
@@ -111,35 +183,34 @@ def get_all_plants(objs, session):
     return _get_all_objects(Plant, get_plant_query, objs, session)
 
 
-def get_accession_query(obj, session):
+def get_accession_query(cls, ids, session):
     """
+    Return a query of the ids of the accessions found in the objects
+    of type cls with ids.
     """
     # as of sqlalchemy 0.5.0 we have to have the order_by(None) here
     # so that if we want to union() the statements together later it
     # will work properly
     q = session.query(Accession).order_by(None)
-    if isinstance(obj, Family):
-        return q.join('species', 'genus', 'family').\
-               filter_by(id=obj.id)
-    elif isinstance(obj, Genus):
-        return q.join('species', 'genus').filter_by(id=obj.id)
-    elif isinstance(obj, Species):
-        return q.join('species').filter_by(id=obj.id)
-    elif isinstance(obj, VernacularName):
-        return q.join('species', 'vernacular_names').\
-               filter_by(id=obj.id)
-    elif isinstance(obj, Plant):
-        return q.join('plants').filter_by(id=obj.id)
-    elif isinstance(obj, Accession):
-        return q.filter_by(id=obj.id)
-    elif isinstance(obj, Location):
-        return q.join('plants').filter_by(location_id=obj.id)
-    elif isinstance(obj, Tag):
-        acc = get_all_accessions(obj.objects, session)
-        return q.filter(Accession.id.in_([a.id for a in acc]))
+    if cls is Family:
+        q = q.join('species', 'genus').\
+            filter(_in_ids(Genus.family_id, ids, session))
+    elif cls is Genus:
+        q = q.join('species').filter(_in_ids(Species.genus_id, ids, session))
+    elif cls is Species:
+        q = q.filter(_in_ids(Accession.species_id, ids, session))
+    elif cls is VernacularName:
+        q = q.join('species', 'vernacular_names').\
+            filter(_in_ids(VernacularName.id, ids, session))
+    elif cls is Plant:
+        q = q.join('plants').filter(_in_ids(Plant.id, ids, session))
+    elif cls is Accession:
+        q = q.filter(_in_ids(Accession.id, ids, session))
+    elif cls is Location:
+        q = q.join('plants').filter(_in_ids(Plant.location_id, ids, session))
     else:
-        raise BaubleError(_("Can't get accessions from a %s" % \
-                            type(obj).__name__))
+        raise BaubleError(_("Can't get accessions from a %s" % cls.__name__))
+    return q.with_entities(Accession.id)
 
 
 def get_all_accessions(objs, session):
@@ -152,36 +223,35 @@ def get_all_accessions(objs, session):
     return _get_all_objects(Accession, get_accession_query, objs, session)
 
 
-def get_species_query(obj, session):
+def get_species_query(cls, ids, session):
     """
+    Return a query of the ids of the species found in the objects of
+    type cls with ids.
     """
     # as of sqlalchemy 0.5.0 we have to have the order_by(None) here
     # so that if we want to union() the statements together later it
     # will work properly
     q = session.query(Species).order_by(None)
-    if isinstance(obj, Family):
-        return q.join('genus', 'family').\
-               filter_by(id=obj.id)
-    elif isinstance(obj, Genus):
-        return q.join('genus').filter_by(id=obj.id)
-    elif isinstance(obj, Species):
-        return q.filter_by(id=obj.id)
-    elif isinstance(obj, VernacularName):
-        return q.join('vernacular_names').\
-               filter_by(id=obj.id)
-    elif isinstance(obj, Plant):
-        return q.join('accessions', 'plants').filter_by(id=obj.id)
-    elif isinstance(obj, Accession):
-        return q.join('accessions').filter_by(id=obj.id)
-    elif isinstance(obj, Location):
-        return q.join('accessions', 'plants', 'location').\
-               filter_by(id=obj.id)
-    elif isinstance(obj, Tag):
-        acc = get_all_species(obj.objects, session)        
-        return q.filter(Species.id.in_([a.id for a in acc]))
+    if cls is Family:
+        q = q.join('genus').filter(_in_ids(Genus.family_id, ids, session))
+    elif cls is Genus:
+        q = q.filter(_in_ids(Species.genus_id, ids, session))
+    elif cls is Species:
+        q = q.filter(_in_ids(Species.id, ids, session))
+    elif cls is VernacularName:
+        q = q.join('vernacular_names').\
+            filter(_in_ids(VernacularName.id, ids, session))
+    elif cls is Plant:
+        q = q.join('accessions', 'plants').\
+            filter(_in_ids(Plant.id, ids, session))
+    elif cls is Accession:
+        q = q.join('accessions').filter(_in_ids(Accession.id, ids, session))
+    elif cls is Location:
+        q = q.join('accessions', 'plants').\
+            filter(_in_ids(Plant.location_id, ids, session))
     else:
-        raise BaubleError(_("Can't get species from a %s" % \
-                            type(obj).__name__))
+        raise BaubleError(_("Can't get species from a %s" % cls.__name__))
+    return q.with_entities(Species.id)
 
 
 def get_all_species(objs, session):
@@ -194,6 +264,44 @@ def get_all_species(objs, session):
     return _get_all_objects(Species, get_species_query, objs, session)
 
 
+# the number of objects loaded at a time by iter_objects()
+batch_size = 500
+
+def iter_objects(cls, query, options=None, order_by=None, size=None):
+    """
+    Iterate over the objects in query, size objects at a time.
+
+    The ids are selected first and then the objects are loaded in
+    batches with options so that the related objects for a batch are
+    loaded with a few queries instead of a few queries per object.
+
+    :param cls: the mapped class of the objects in query
+    :param query: a query of cls, e.g. from get_all_plants()
+    :param options: a list of loader options to use when loading the
+      objects, e.g. [joinedload('accession')]
+    :param order_by: the order to return the objects in
+    :param size: the number of objects in a batch, defaults to batch_size
+    """
+    if options is None:
+        options = []
+    if size is None:
+        size = batch_size
+    id_query = query.with_entities(cls.id)
+    if order_by is not None:
+        id_query = id_query.order_by(order_by)
+    ids = [row[0] for row in id_query]
+    session = query.session
+    for start in xrange(0, len(ids), size):
+        batch = ids[start:start+size]
+        objs = session.query(cls).options(*options).\
+            filter(cls.id.in_(batch)).all()
+        by_id = dict([(obj.id, obj) for obj in objs])
+        for obj_id in batch:
+            # skip anything that was deleted after the ids were selected
+            if obj_id in by_id:
+                yield by_id[obj_id]
+
+
 
 class SettingsBox(gtk.VBox):
     """
@@ -221,6 +329,7 @@ class FormatterPlugin(pluginmgr.Plugin):
     '''
 
     title = ''
+    lazy = True
 
     @staticmethod
     def get_settings_box():
@@ -493,7 +602,8 @@ class ReportToolDialogPresenter(object):
     def init_formatter_combo(self):
         plugins = []
         for p in pluginmgr.plugins.values():
-            if issubclass(p, FormatterPlugin):
+            # skip the LazyPlugins of the modules that haven't been loaded
+            if isinstance(p, type) and issubclass(p, FormatterPlugin):
                 plugins.append(p)
 
         # we should always have at least the default formatter
@@ -614,7 +724,7 @@ class ReportTool(pluginmgr.Tool):
                 formatter, settings = dialog.start()
                 if formatter is None:
                     break
-                ok = formatter.format([row[0] for row in model], **settings)
+                ok = formatter.format(view.get_values(model), **settings)
                 if ok:
                     break
         except AssertionError, e:
@@ -642,6 +752,7 @@ class ReportToolPlugin(pluginmgr.Plugin):
     '''
     '''
     tools = [ReportTool]
+    lazy = True
 
 
 
@@ -247,13 +247,51 @@ class ReportTests(ReportTestCase):
         self.assert_(ids == range(1, 17), ids)
 
 
+    def test_get_all_plants_temp_table(self):
+        """
+        Test getting the plants when there are more ids than are
+        allowed in an IN clause.
+        """
+        import bauble.plugins.report as report
+        get_ids = lambda objs: sorted([o.id for o in objs])
+        max_in_ids = report.max_in_ids
+        report.max_in_ids = 2
+        try:
+            accessions = self.session.query(Accession).all()
+            ids = get_ids(get_all_plants(accessions, self.session))
+            self.assert_(ids == range(1, 33), ids)
+            locations = self.session.query(Location).filter(Location.id < 6)
+            ids = get_ids(get_all_species(locations.all(), self.session))
+            self.assert_(ids == [1, 2], ids)
+        finally:
+            report.max_in_ids = max_in_ids
+
+
+    def test_iter_objects(self):
+        """
+        Test that iter_objects() returns all the objects in order when
+        they are loaded in batches.
+        """
+        import bauble.db as db
+        from bauble.plugins.report import iter_objects
+        from bauble.plugins.report.xsl import plant_options
+        species = self.session.query(Species).all()
+        query = get_all_plants(species, self.session)
+        expected = [p.id for p in query.order_by(db.sort_key_column(Plant))]
+        plants = list(iter_objects(Plant, query, plant_options,
+                                   db.sort_key_column(Plant), size=5))
+        self.assert_([p.id for p in plants] == expected, plants)
+        self.assert_(plants[0].accession.species.genus.family is not None)
+
+
 class ReportTestSuite(unittest.TestSuite):
 
     def __init__(self):
         super(ReportTestSuite, self).__init__()
         self.addTests(map(ReportTests, ('test_get_all_species',
                                         'test_get_all_accessions',
-                                        'test_get_all_plants')))
+                                        'test_get_all_plants',
+                                        'test_get_all_plants_temp_table')))
 
 
 testsuite = ReportTestSuite
@@ -26,9 +26,9 @@ import bauble.paths as paths
 from bauble.plugins.plants.species import Species
 from bauble.plugins.garden.plant import Plant
 from bauble.plugins.garden.accession import Accession
-from bauble.plugins.abcd import create_abcd, ABCDAdapter, ABCDElement
+from bauble.plugins.abcd import write_abcd, ABCDAdapter, ABCDElement
 from bauble.plugins.report import get_all_plants, get_all_species, \
-     get_all_accessions, FormatterPlugin, SettingsBox
+     get_all_accessions, iter_objects, FormatterPlugin, SettingsBox
 import bauble.prefs as prefs
 from bauble.utils.log import debug
 import bauble.utils as utils
@@ -54,9 +54,13 @@ else:
 #    return ([os.path.join(p, e) for p in os.environ['PATH'].split(os.pathsep) if os.path.exists(os.path.join(p, e))] + [None])[0]
 
 # TODO: support FOray, see http://www.foray.org/
+# the renderers apply the stylesheet to the ABCD file themselves so
+# the ABCD data doesn't have to be parsed into a tree in Bauble
 renderers_map = {'Apache FOP': fop_cmd + \
-                               ' -fo %(fo_filename)s -pdf %(out_filename)s',
-                 'XEP': 'xep -fo %(fo_filename)s -pdf %(out_filename)s',
+                     ' -xml "%(xml_filename)s" -xsl "%(xsl_filename)s" ' \
+                     '-pdf "%(out_filename)s"',
+                 'XEP': 'xep -xml "%(xml_filename)s" ' \
+                     '-xsl "%(xsl_filename)s" -pdf "%(out_filename)s"',
 #                 'xmlroff': 'xmlroff -o %(out_filename)s %(fo_filename)s',
 #                 'Ibex for Java': 'java -cp /home/brett/bin/ibex-3.9.7.jar \
 #         ibex.Run -xml %(fo_filename)s -pdf %(out_filename)s'
@@ -315,6 +319,32 @@ class PlantABCDAdapter(AccessionABCDAdapter):
 
 
 
+# the loader options for the objects passed to the adapters, these
+# should include everything the adapters use so that a batch of
+# objects can be adapted without any more queries
+species_options = [joinedload_all('genus.family'),
+                   joinedload_all('_default_vernacular_name.vernacular_name'),
+                   subqueryload_all('distribution.geography'),
+                   subqueryload('notes')]
+
+accession_options = [joinedload_all('species.genus.family'),
+                     joinedload_all('species._default_vernacular_name.'\
+                                        'vernacular_name'),
+                     subqueryload_all('species.distribution.geography'),
+                     joinedload_all('source.collection'),
+                     subqueryload('notes')]
+
+plant_options = [joinedload_all('accession.species.genus.family'),
+                 joinedload_all('accession.species._default_vernacular_name.'\
+                                    'vernacular_name'),
+                 subqueryload_all('accession.species.distribution.'\
+                                      'geography'),
+                 joinedload_all('accession.source.collection'),
+                 subqueryload_all('accession.notes'),
+                 joinedload('location'),
+                 subqueryload('notes')]
+
+
 class SettingsBoxPresenter(object):
 
     def __init__(self, widgets):
@@ -495,78 +525,77 @@ class XSLFormatterPlugin(FormatterPlugin):
         session = db.Session()
 
         # convert objects to ABCDAdapters depending on source type for
-        # passing to create_abcd
-        adapted = []
+        # passing to write_abcd, the objects are loaded in batches
+        # along with everything the adapters use
         if source_type == plant_source_type:
-            plants = sorted(get_all_plants(objs, session=session),
-                            key=utils.natsort_key)
-            if len(plants) == 0:
+            query = get_all_plants(objs, session=session)
+            if query.count() == 0:
                 utils.message_dialog(_('There are no plants in the search '
                                        'results.  Please try another search.'))
                 return False
-            for p in plants:
-                if use_private:
-                    adapted.append(PlantABCDAdapter(p, for_labels=True))
-                elif not p.accession.private:
-                    adapted.append(PlantABCDAdapter(p, for_labels=True))
+            adapted = (PlantABCDAdapter(p, for_labels=True) \
+                           for p in iter_objects(Plant, query, plant_options,
+                                                 db.sort_key_column(Plant)) \
+                           if use_private or not p.accession.private)
         elif source_type == species_source_type:
-            species = sorted(get_all_species(objs, session=session),
-                             key=utils.natsort_key)
-            if len(species) == 0:
+            query = get_all_species(objs, session=session)
+            if query.count() == 0:
                 utils.message_dialog(_('There are no species in the search '
                                        'results.  Please try another search.'))
                 return False
-            for s in species:
-                adapted.append(SpeciesABCDAdapter(s, for_labels=True))
+            adapted = (SpeciesABCDAdapter(s, for_labels=True) \
+                           for s in iter_objects(Species, query,
+                                                 species_options,
+                                                 db.sort_key_column(Species)))
         elif source_type == accession_source_type:
-            accessions = sorted(get_all_accessions(objs, session=session),
-                                key=utils.natsort_key)
-            if len(accessions) == 0:
+            query = get_all_accessions(objs, session=session)
+            if query.count() == 0:
                 utils.message_dialog(_('There are no accessions in the search '
                                        'results.  Please try another search.'))
                 return False
-            for a in accessions:
-                if use_private:
-                    adapted.append(AccessionABCDAdapter(a, for_labels=True))
-                elif not a.private:
-                    adapted.append(AccessionABCDAdapter(a, for_labels=True))
+            adapted = (AccessionABCDAdapter(a, for_labels=True) \
+                           for a in iter_objects(Accession, query,
+                                                 accession_options,
+                                                 db.sort_key_column(Accession))\
+                           if use_private or not a.private)
         else:
             raise NotImplementedError('unknown source type')
 
+        # write the ABCD data a unit at a time instead of building the
+        # whole tree in memory
+        fd, abcd_filename = tempfile.mkstemp(suffix='.xml')
+        abcd_outfile = os.fdopen(fd, 'w')
+        try:
+            nunits = write_abcd(adapted, abcd_outfile, authors=authors)
+        finally:
+            abcd_outfile.close()
+            session.close()
 
-        if len(adapted) == 0:
+        if nunits == 0:
             # nothing adapted....possibly everything was private
             # TODO: if everything was private and that is really why we got
             # here then it is probably better to show a dialog with a message
             # and raise and exception which appears as an error
+            os.remove(abcd_filename)
             raise Exception('No objects could be adapted to ABCD units.')
-        abcd_data = create_abcd(adapted, authors=authors, validate=False)
-
-        session.close()
 
-#        debug(etree.dump(abcd_data.getroot()))
-
-        # create xsl fo file
-        dummy, fo_filename = tempfile.mkstemp()
-        style_etree = etree.parse(stylesheet)
-        transform = etree.XSLT(style_etree)
-        result = transform(abcd_data)
-        fo_outfile = open(fo_filename, 'w')
-        fo_outfile.write(str(result))
-        fo_outfile.close()
-        dummy, filename = tempfile.mkstemp()
-        filename = '%s.pdf' % filename
+        # the pdf is written to a new directory so we can tell if the
+        # renderer created it
+        filename = os.path.join(tempfile.mkdtemp(), 'report.pdf')
 
         # TODO: checkout pyexpect for spawning processes
 
         # run the report to produce the pdf file, the command has to be
         # on the path for this to work
-        fo_cmd = fo_cmd % ({'fo_filename': fo_filename,
+        fo_cmd = fo_cmd % ({'xml_filename': abcd_filename,
+                            'xsl_filename': stylesheet,
                             'out_filename': filename})
-#        print fo_cmd
 #        debug(fo_cmd)
         # TODO: use popen to get output
-        os.system(fo_cmd)
+        try:
+            os.system(fo_cmd)
+        finally:
+            os.remove(abcd_filename)
 
 #        print filename
         if not os.path.exists(filename):
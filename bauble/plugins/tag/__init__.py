@@ -271,49 +271,134 @@ class TaggedObj(db.Base):
         return '%s: %s' % (self.obj_class, self.obj_id)
 
 
-# TODO: maybe we shouldn't remove the obj from the tag if we can't
-# find it, it doesn't really hurt to have it there and in case the
-# table isn't available at the moment doesn't mean it won't be there
-# later, e.g. if some object is tagged but then that plugin gets
-# disabled by a user then the tag could still exist for that object to
-# other users who have that plugin enabled.
-
-# TODO: provide another function that returns (table, id) pairs that
-# this function can use so that we can expose that functionality
-def _get_tagged_object_pairs(tag):
+# an object can only be tagged once with the same tag
+tagged_obj_index = Index('ix_tagged_obj_tag_obj', TaggedObj.__table__.c.tag_id,
+                         TaggedObj.__table__.c.obj_class,
+                         TaggedObj.__table__.c.obj_id, unique=True)
+
+
+# the classes of the tagged objects keyed by the class name stored in
+# TaggedObj.obj_class, the value is None if the class couldn't be found
+_tagged_classes = {}
+
+# the maximum number of ids in an IN clause
+_chunk_size = 500
+
+
+def _get_tagged_class(name):
+    """
+    Return the class for the class name stored in TaggedObj.obj_class
+    or None if the class can't be imported.
+
+    :param name: the full name of the class, e.g. bauble.plugins.plants.Family
     """
+    try:
+        return _tagged_classes[name]
+    except KeyError:
+        pass
+    cls = None
+    module_name, cls_name = name, ''
+    try:
+        # __import__ "from_list" parameters has to be a list of strings
+        module_name, part, cls_name = name.rpartition('.')
+        module = __import__(module_name, globals(), locals(),
+                            module_name.split('.')[1:])
+        cls = getattr(module, cls_name)
+    except (ImportError, ValueError, AttributeError), e:
+        # the plugin for the class might not be loaded, don't purge the
+        # tagged objects since the class might be available later
+        warning('tag: could not get the class %s: %s' % (name, e))
+    _tagged_classes[name] = cls
+    return cls
+
+
+def _get_tagged_object_groups(tag, session=None):
+    """
+    Return a dict of class name -> (class, list of object ids) for the
+    objects tagged with tag.
+
     :param tag: a Tag instance
+    :param session:
     """
-    from bauble.view import SearchView
-    kids = []
-    for obj in tag._objects:
+    if not session:
+        session = object_session(tag)
+    groups = {}
+    q = session.query(TaggedObj.obj_class, TaggedObj.obj_id).\
+        filter_by(tag_id=tag.id).order_by(TaggedObj.id)
+    for obj_class, obj_id in q:
+        name = str(obj_class)
         try:
-            # __import__ "from_list" parameters has to be a list of strings
-            module_name, part, cls_name = str(obj.obj_class).rpartition('.')
-            module = __import__(module_name, globals(), locals(),
-                                module_name.split('.')[1:])
-            cls = getattr(module, cls_name)
-            kids.append((cls, obj.obj_id))
-        except KeyError, e:
-            warning('KeyError -- tag.get_tagged_objects(%s): %s' % (tag, e))
-            continue
-        except DBAPIError, e:
-            warning('DBAPIError -- tag.get_tagged_objects(%s): %s' % (tag, e))
-            continue
-        except AttributeError, e:
-            warning('AttributeError -- tag.get_tagged_objects(%s): %s' \
-                    % (tag, e))
-            warning('Could not get the object for %s.%s(%s)' % \
-                    (module_name, cls_name, obj.obj_id))
-            continue
+            groups[name][1].append(obj_id)
+        except KeyError:
+            groups[name] = (_get_tagged_class(name), [obj_id])
+    return groups
+
 
+def _get_tagged_object_pairs(tag):
+    """
+    Return a list of (class, object id) pairs for the objects tagged
+    with tag.  Tagged objects whose class can't be found are skipped.
+
+    :param tag: a Tag instance
+    """
+    kids = []
+    for cls, ids in _get_tagged_object_groups(tag).values():
+        if cls is not None:
+            kids.extend([(cls, obj_id) for obj_id in ids])
     return kids
 
 
+def _purge_tagged_objects(session, tag, name, obj_ids):
+    """
+    Remove the TaggedObj rows for objects that no longer exist.
+
+    The rows are removed and committed on their own connection so that
+    the purge doesn't wait for the caller to commit session, which is
+    often only used for reading, e.g. in the SearchView.
+
+    :param session: the session tag was loaded in
+    :param tag: a Tag instance
+    :param name: the class name of the objects
+    :param obj_ids: the ids of the objects to untag
+    """
+    table = TaggedObj.__table__
+    obj_ids = list(obj_ids)
+    engine = db.get_separate_engine()
+    def purge(conn):
+        for chunk in _chunks(obj_ids):
+            db.delete_rows(conn, table, and_(table.c.tag_id == tag.id,
+                                             table.c.obj_class == name,
+                                             table.c.obj_id.in_(chunk)))
+    if engine is db.engine and engine.name == 'sqlite':
+        # an in memory SQLite database shares the DBAPI connection
+        # with the session, committing would commit the session
+        purge(session.connection())
+    else:
+        conn = engine.connect()
+        trans = conn.begin()
+        try:
+            try:
+                purge(conn)
+                trans.commit()
+            except Exception, e:
+                # the rows are purged the next time
+                warning('tag: could not remove the missing objects: %s' \
+                            % utils.utf8(e))
+                trans.rollback()
+                return
+        finally:
+            conn.close()
+    session.expire(tag, ['_objects'])
+
+
 def get_tagged_objects(tag, session=None):
     """
     Return all object tagged with tag.
 
+    The tagged objects are loaded with one query for each class of
+    tagged objects.  If a tagged object doesn't exist anymore, e.g. it
+    was deleted after it was tagged, then it is removed from the tag.
+
     :param tag: A string or :class:`Tag`
     :param session:
     """
@@ -321,23 +406,54 @@ def get_tagged_objects(tag, session=None):
     if not isinstance(tag, Tag):
         if not session:
             session = db.Session()
+            close_session = True
         tag = session.query(Tag).filter_by(tag=utils.utf8(tag)).first()
     elif not session:
         session = object_session(tag)
 
-    # filter out any None values from the query which can happen if
-    # you tag something and then delete it from the datebase
+    r = []
+    for name, (cls, ids) in _get_tagged_object_groups(tag, session).items():
+        if cls is None:
+            continue
+        missing = set(ids)
+        for i in xrange(0, len(ids), _chunk_size):
+            chunk = ids[i:i+_chunk_size]
+            for obj in session.query(cls).filter(cls.id.in_(chunk)):
+                missing.discard(obj.id)
+                r.append(obj)
+        if missing:
+            warning('tag: removing %s missing %s objects from %s' \
+                        % (len(missing), name, tag))
+            _purge_tagged_objects(session, tag, name, missing)
 
-    # TODO: the missing tagged objects should probably be removed from
-    # the database
-    r = [session.query(mapper).filter_by(id=obj_id).first() \
-            for mapper, obj_id in _get_tagged_object_pairs(tag)]
-    r = filter(lambda x: x != None, r)
     if close_session:
         session.close()
     return r
 
 
+def _group_objects(objs):
+    """
+    Return a dict of class name -> sorted list of ids for objs where
+    the class name is how the class is stored in TaggedObj.obj_class.
+
+    :param objs: a list of mapped objects
+    """
+    groups = {}
+    for obj in objs:
+        groups.setdefault(_classname(obj), set()).add(obj.id)
+    for name, ids in groups.items():
+        groups[name] = sorted(ids)
+    return groups
+
+
+def _chunks(ids):
+    """
+    Yield ids in lists of at most _chunk_size items.
+    """
+    for i in xrange(0, len(ids), _chunk_size):
+        yield ids[i:i+_chunk_size]
+
+
 def untag_objects(name, objs):
     """
     Remove the tag name from objs.
@@ -347,24 +463,20 @@ def untag_objects(name, objs):
     :param objs: The list of objects to untag.
     :type objs: list
     """
-    # TODO: should we loop through objects in a tag to delete
-    # the TaggedObject or should we delete tags is they match
-    # the tag in TaggedObj.selectBy(obj_class=classname, obj_id=obj.id)
     session = db.Session()
     try:
         tag = session.query(Tag).filter_by(tag=utils.utf8(name)).one()
     except Exception, e:
         debug(traceback.format_exc())
+        session.close()
         return
-    same = lambda x, y: x.obj_class==_classname(y) and x.obj_id==y.id
-    for obj in objs:
-        for kid in tag._objects:
-            # x = kid
-            # y = obj
-            if same(kid, obj):
-                #o = session.load(type(kid), kid.id)
-                o = session.query(type(kid)).filter_by(id=kid.id).one()
-                session.delete(o)
+    table = TaggedObj.__table__
+    for cls_name, ids in _group_objects(objs).iteritems():
+        for chunk in _chunks(ids):
+            db.delete_rows(session.connection(), table,
+                           and_(table.c.tag_id == tag.id,
+                                table.c.obj_class == cls_name,
+                                table.c.obj_id.in_(chunk)))
     session.commit()
     session.close()
 
@@ -390,15 +502,20 @@ def tag_objects(name, objs):
     except InvalidRequestError, e:
         tag = Tag(tag=name)
         session.add(tag)
-    for obj in objs:
-        cls = and_(TaggedObj.obj_class==_classname(obj),
-                   TaggedObj.obj_id==obj.id,
-                   TaggedObj.tag_id==tag.id)
-        ntagged = session.query(TaggedObj).filter(cls).count()
-        if ntagged == 0:
-            tagged_obj = TaggedObj(obj_class=_classname(obj), obj_id=obj.id,
-                                   tag=tag)
-            session.add(tagged_obj)
+        session.flush()
+    table = TaggedObj.__table__
+    for cls_name, ids in _group_objects(objs).iteritems():
+        for chunk in _chunks(ids):
+            # only insert the objects that aren't already tagged
+            stmt = select([table.c.obj_id],
+                          and_(table.c.tag_id == tag.id,
+                               table.c.obj_class == cls_name,
+                               table.c.obj_id.in_(chunk)))
+            tagged = set([r[0] for r in session.execute(stmt)])
+            rows = [{'obj_id': obj_id, 'obj_class': cls_name,
+                     'tag_id': tag.id} for obj_id in chunk \
+                        if obj_id not in tagged]
+            db.insert_rows(session.connection(), table, rows)
     # if a new tag is created with the name parameter it is always saved
     # regardless of whether the objects are tagged
     session.commit()
@@ -412,24 +529,26 @@ def get_tag_ids(objs):
     Return a list of tag id's for tags associated with obj, only returns those
     tag ids that are common between all the objs
     """
-    # TODO: this function does intersection in the most
-    # straightforward way and could probably do with some optimization
-    #clause = lambda x: and_(TaggedObj.obj_class==_classname(x),
-    #                        TaggedObj.obj_id==x.id)
-    #ors = or_(*map(clause, objs))
+    groups = _group_objects(objs)
+    nobjs = sum([len(ids) for ids in groups.values()])
+    if nobjs == 0:
+        return []
     session = db.Session()
-    s = set()
-    tag_id_query = session.query(Tag.id).join('_objects')
-    for obj in objs:
-        clause = and_(TaggedObj.obj_class==_classname(obj),
-                      TaggedObj.obj_id==obj.id)
-        tags = [r[0] for r in tag_id_query.filter(clause)]
-        if len(s) == 0:
-            s.update(tags)
-        else:
-            s.intersection_update(tags)
+    table = TaggedObj.__table__
+    # count the number of objs tagged with each tag, the tags that
+    # tag all the objs are the ones in common
+    counts = {}
+    for cls_name, ids in groups.iteritems():
+        for chunk in _chunks(ids):
+            stmt = select([table.c.tag_id,
+                           func.count(distinct(table.c.obj_id))],
+                          and_(table.c.obj_class == cls_name,
+                               table.c.obj_id.in_(chunk))).\
+                               group_by(table.c.tag_id)
+            for tag_id, count in session.execute(stmt):
+                counts[tag_id] = counts.get(tag_id, 0) + count
     session.close()
-    return list(s)
+    return [tag_id for tag_id, count in counts.iteritems() if count == nobjs]
 
 
 def _on_add_tag_activated(*args):
@@ -515,6 +634,55 @@ def natsort_kids(kids):
 
 
 
+def check_tagged_obj_index():
+    """
+    Create the unique index on the tagged_obj table if it doesn't
+    exist, e.g. for a database created before the index was added.
+    The rows that tag an object more than once with the same tag are
+    removed first.
+    """
+    from sqlalchemy.engine.reflection import Inspector
+    table = TaggedObj.__table__
+    try:
+        if not table.exists(bind=db.engine):
+            return
+        inspector = Inspector.from_engine(db.engine)
+        existing = set([ix['name'] for ix in \
+                            inspector.get_indexes(table.name)])
+        if tagged_obj_index.name in existing:
+            return
+        conn = db.engine.connect()
+        trans = conn.begin()
+        try:
+            try:
+                # keep the first row of each duplicate
+                other = table.alias()
+                dups = select([table.c.id],
+                              exists([other.c.id],
+                                     and_(other.c.tag_id == table.c.tag_id,
+                                          other.c.obj_class == \
+                                              table.c.obj_class,
+                                          other.c.obj_id == table.c.obj_id,
+                                          other.c.id < table.c.id)))
+                dup_ids = [r[0] for r in conn.execute(dups)]
+                if dup_ids:
+                    warning('tag: removing %s duplicate tagged objects' \
+                                % len(dup_ids))
+                for chunk in _chunks(dup_ids):
+                    db.delete_rows(conn, table, table.c.id.in_(chunk))
+                debug('creating index %s' % tagged_obj_index.name)
+                tagged_obj_index.create(bind=conn)
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+        finally:
+            conn.close()
+    except Exception, e:
+        warning('check_tagged_obj_index(): %s' % utils.utf8(e))
+
+
+
 class TagPlugin(pluginmgr.Plugin):
 
     @classmethod
@@ -523,7 +691,9 @@ class TagPlugin(pluginmgr.Plugin):
         mapper_search = search.get_strategy('MapperSearch')
         mapper_search.add_meta(('tag', 'tags'), Tag, ['tag'])
         SearchView.view_meta[Tag].set(children=natsort_kids('objects'),
-                                      context_menu=tag_context_menu)
+                                      context_menu=tag_context_menu,
+                                      sort_key=Tag.tag)
+        check_tagged_obj_index()
         if bauble.gui is not None:
             _reset_tags_menu()
 
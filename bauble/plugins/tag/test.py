@@ -3,9 +3,10 @@ import os
 from sqlalchemy import *
 from sqlalchemy.exc import *
 
+import bauble.db as db
 import bauble.plugins.tag as tag_plugin
 from bauble.plugins.plants import Family
-from bauble.plugins.tag import Tag
+from bauble.plugins.tag import Tag, TaggedObj
 from bauble.test import BaubleTestCase, check_dupids
 
 
@@ -67,6 +68,9 @@ class TagTests(BaubleTestCase):
                              cmp=lambda x, y: cmp(x[0], y[0]))
         self.assert_(sorted_pairs == [(Family,family1_id), (Family,family2_id)],
                      sorted_pairs)
+        # the session created by get_tagged_objects() is closed
+        from sqlalchemy.orm.session import object_session
+        self.assert_(object_session(tagged_objs[0]) is None)
 
         # get object by tag
         tag = self.session.query(Tag).filter_by(tag=u'test').one()
@@ -92,6 +96,49 @@ class TagTests(BaubleTestCase):
         tagged_objs = tag_plugin.get_tagged_objects(tag)
 
 
+    def test_get_tagged_objects(self):
+        families = [Family(family=u'family%s' % i) for i in range(5)]
+        self.session.add_all(families)
+        self.session.commit()
+        tag_plugin.tag_objects('test', families + [self.family])
+        tag = self.session.query(Tag).filter_by(tag=u'test').one()
+        ids = sorted([f.id for f in families + [self.family]])
+
+        # load the objects in more than one chunk
+        chunk_size = tag_plugin._chunk_size
+        tag_plugin._chunk_size = 2
+        try:
+            objs = tag_plugin.get_tagged_objects(tag)
+            self.assert_(sorted([o.id for o in objs]) == ids)
+
+            # missing objects are removed from the tag
+            deleted = families[0].id
+            self.session.execute(Family.__table__.delete().\
+                                     where(Family.id == deleted))
+            self.session.commit()
+            objs = tag_plugin.get_tagged_objects(tag)
+            ids.remove(deleted)
+            self.assert_(sorted([o.id for o in objs]) == ids)
+            self.assert_(deleted not in [o.obj_id for o in tag._objects])
+            # the purge is committed without committing self.session
+            session = db.Session()
+            try:
+                self.assert_(session.query(TaggedObj).\
+                                 filter_by(obj_id=deleted).count() == 0)
+            finally:
+                session.close()
+        finally:
+            tag_plugin._chunk_size = chunk_size
+
+        # classes that can't be imported are skipped
+        tag_plugin.tag_objects('test2', [self.family])
+        tag = self.session.query(Tag).filter_by(tag=u'test2').one()
+        tag._objects[0].obj_class = 'bauble.plugins.nothere.Nothing'
+        self.session.commit()
+        self.assert_(tag_plugin.get_tagged_objects(tag) == [])
+        self.assert_(len(tag._objects) == 1)
+
+
     def test_get_tag_ids(self):
         family2 = Family(family=u'family2')
         self.session.add(family2)
@@ -118,3 +165,53 @@ class TagTests(BaubleTestCase):
         ids = sorted(tag_plugin.get_tag_ids([self.family, family2]))
         self.assert_(ids==test_id, '%s == %s' % (ids, test_id))
 
+        # the counts are summed over more than one chunk of ids
+        chunk_size = tag_plugin._chunk_size
+        tag_plugin._chunk_size = 1
+        try:
+            ids = sorted(tag_plugin.get_tag_ids([self.family, family2,
+                                                 self.family]))
+            self.assert_(ids==test_id, '%s == %s' % (ids, test_id))
+            tag_plugin.untag_objects('test2', [self.family, family2])
+            ids = tag_plugin.get_tag_ids([self.family, family2])
+            self.assert_(ids==test_id[:1], '%s == %s' % (ids, test_id[:1]))
+        finally:
+            tag_plugin._chunk_size = chunk_size
+
+
+
+    def test_tag_history(self):
+        """
+        Test that tagging and untagging objects is recorded in the
+        history table
+        """
+        tag_plugin.tag_objects('test', [self.family])
+        obj = self.session.query(TaggedObj).one()
+        query = self.session.query(db.History).\
+            filter_by(table_name=u'tagged_obj', table_id=obj.id)
+        self.assert_([h.operation for h in query] == ['insert'])
+        tag_plugin.untag_objects('test', [self.family])
+        self.assert_(sorted([h.operation for h in query]) == \
+                         ['delete', 'insert'])
+
+
+    def test_check_tagged_obj_index(self):
+        """
+        Test that the unique index on tagged_obj is created after the
+        duplicates are removed
+        """
+        tag_plugin.tag_objects('test', [self.family])
+        tag = self.session.query(Tag).one()
+        tag_plugin.tagged_obj_index.drop(bind=db.engine)
+        table = TaggedObj.__table__
+        db.engine.execute(table.insert(), obj_id=self.family.id,
+                          obj_class=tag_plugin._classname(self.family),
+                          tag_id=tag.id)
+        query = self.session.query(TaggedObj)
+        self.assert_(query.count() == 2)
+        tag_plugin.check_tagged_obj_index()
+        self.assert_(query.count() == 1)
+        self.assertRaises(Exception, db.engine.execute, table.insert(),
+                          obj_id=self.family.id,
+                          obj_class=tag_plugin._classname(self.family),
+                          tag_id=tag.id)
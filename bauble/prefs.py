@@ -94,6 +94,41 @@ The preferences key for the default units for Bauble.
 Values: metric, imperial
 """
 
+pool_size_pref = 'bauble.pool_size'
+"""
+The preferences key for the number of connections to keep open to a
+PostgreSQL database.
+"""
+
+pool_max_overflow_pref = 'bauble.pool_max_overflow'
+"""
+The preferences key for the number of connections that can be opened
+to a PostgreSQL database above pool_size when they are all in use.
+"""
+
+pool_recycle_pref = 'bauble.pool_recycle'
+"""
+The preferences key for the number of seconds after which a
+connection to a PostgreSQL database is closed and reopened.
+"""
+
+pool_pre_ping_pref = 'bauble.pool_pre_ping'
+"""
+The preferences key for whether connections to a PostgreSQL database
+are tested before they are used.
+
+Values: True, False
+"""
+
+history_queue_pref = 'bauble.history_queue'
+"""
+The preferences key for whether the history table is written from a
+background thread, see :class:`bauble.db.HistoryQueue`.  This is
+ignored for SQLite databases.
+
+Values: True, False
+"""
+
 ## class PreferencesMgr(gtk.Dialog):
 
 ##     def __init__(self):
@@ -347,7 +382,18 @@ class PrefsView(pluginmgr.View):
         frame.set_label_widget(label)
         view = self.create_registry_view()
         frame.add(view)
-        pane.pack2(frame)
+        box = gtk.VBox(spacing=5)
+        box.pack_start(frame)
+
+        label = gtk.Label()
+        label.set_markup(_('<b>Connection pool</b>'))
+        label.set_padding(5, 0)
+        frame = gtk.Frame()
+        frame.set_label_widget(label)
+        view = self.create_pool_view()
+        frame.add(view)
+        box.pack_start(frame, expand=False)
+        pane.pack2(box)
 
 
     def create_tree(self, columns, itemsiter):
@@ -391,6 +437,21 @@ class PrefsView(pluginmgr.View):
         return tree
 
 
+    def create_pool_view(self):
+        tree = self.create_tree([_('Name'), _('Value')], [])
+        self.pool_model = tree.get_child().get_model()
+        self.update_pool_view()
+        return tree
+
+
+    def update_pool_view(self):
+        """
+        Show the current state of the database connection pool.
+        """
+        self.pool_model.clear()
+        for name, value in db.pool_status():
+            self.pool_model.append([name, str(value)])
+
 
 
 class PrefsCommandHandler(pluginmgr.CommandHandler):
@@ -399,7 +460,7 @@ class PrefsCommandHandler(pluginmgr.CommandHandler):
     view = None
 
     def __call__(self, cmd, arg):
-        pass
+        self.view.update_pool_view()
 
 
     def get_view(self):
@@ -10,6 +10,7 @@ import bauble
 from bauble.error import check, CheckConditionError, BaubleError
 import bauble.db as db
 import bauble.pluginmgr as pluginmgr
+import bauble.textindex as textindex
 from bauble.utils.log import debug
 import bauble.utils as utils
 
@@ -25,6 +26,18 @@ def search(text, session):
     return list(results)
 
 
+def search_keys(text, session):
+    """
+    Return a list of (class, id) tuples for the objects that match
+    text.  Unlike search() this doesn't load the matching objects for
+    the strategies that support it.
+    """
+    results = set()
+    for strategy in _search_strategies:
+        results.update(strategy.search_keys(text, session))
+    return list(results)
+
+
 
 class SearchParser(object):
     """
@@ -80,6 +93,19 @@ class SearchStrategy(object):
         pass
 
 
+    def search_keys(self, text, session):
+        '''
+        :param text: the search string
+        :param session: the session to use for the search
+
+        Return an iterator over (class, id) tuples of the objects
+        retrieved from the search.  Strategies that can get the ids
+        without loading the objects should override this method.
+        '''
+        results = self.search(text, session) or []
+        return [(type(obj), obj.id) for obj in results]
+
+
 
 class MapperSearch(SearchStrategy):
 
@@ -97,9 +123,22 @@ class MapperSearch(SearchStrategy):
     _shorthand = {}
     _properties = {}
 
+    union_value_list = True
+    """
+    If True then value list searches are run as a single UNION ALL
+    query across all the registered classes, if False then each class
+    is searched with a separate query.
+    """
+
+    in_chunk_size = 500
+    """
+    The maximum number of ids passed to a single IN clause.
+    """
+
     def __init__(self):
         super(MapperSearch, self).__init__()
         self._results = set()
+        self._keys_only = False
         self.parser = SearchParser()
 
 
@@ -133,6 +172,18 @@ class MapperSearch(SearchStrategy):
             d.setdefault(domain, item[0])
         return d
 
+    def _add_results(self, cls, query):
+        """
+        Add the results of query to the search results. If we are
+        only searching for keys then only the ids are selected.
+        """
+        if self._keys_only:
+            ids = query.with_entities(cls.id)
+            self._results.update((cls, row[0]) for row in ids)
+        else:
+            self._results.update(query.all())
+
+
     def on_query(self, s, loc, tokens):
         """
         Called when the parser hits a query token.
@@ -216,7 +267,7 @@ class MapperSearch(SearchStrategy):
             except StopIteration:
                 pass
 
-        self._results.update(main_query.order_by(None).all())
+        self._add_results(cls, main_query.order_by(None))
 
 
     def on_domain_expression(self, s, loc, tokens):
@@ -241,14 +292,14 @@ class MapperSearch(SearchStrategy):
 
 	# select all objects from the domain
         if values == '*':
-            self._results.update(query.all())
+            self._add_results(cls, query)
             return
 
         mapper = class_mapper(cls)
 
         if cond in ('like', 'ilike', 'contains', 'icontains', 'has', 'ihas'):
             condition = lambda col: \
-                lambda val: utils.ilike(mapper.c[col], '%%%s%%' % val)
+                lambda val: textindex.contains(mapper.c[col], val)
         elif cond == '=':
             condition = lambda col: \
                 lambda val: utils.ilike(mapper.c[col], utils.utf8(val))
@@ -258,7 +309,7 @@ class MapperSearch(SearchStrategy):
 
         for col in properties:
             ors = or_(*map(condition(col), values))
-            self._results.update(query.filter(ors).all())
+            self._add_results(cls, query.filter(ors))
         return tokens
 
 
@@ -275,26 +326,82 @@ class MapperSearch(SearchStrategy):
         # debug('  loc: %s' % loc)
         # debug('  toks: %s' % tokens)
 
+        if self.union_value_list:
+            self._value_list_union(tokens)
+        else:
+            self._value_list_per_class(tokens)
+
+
+    def _value_list_clause(self, cls, values):
+        """
+        Return the or'ed like clause that matches any of values in
+        any of the properties registered for cls with add_meta()
+        """
         # make searches case-insensitive, in postgres use ilike,
-        # in other use upper()
-        like = lambda table, col, val: \
-            utils.ilike(table.c[col], ('%%%s%%' % val))
+        # in other use upper(), if there is a text index then
+        # textindex.contains() will use it
+        mapper = class_mapper(cls)
+        # as of SQLAlchemy>=0.4.2 we convert the value to a unicode
+        # object if the col is a Unicode or UnicodeText column in order
+        # to avoid the "Unicode type received non-unicode bind param"
+        def unicol(col, v):
+            if isinstance(mapper.c[col].type, (Unicode,UnicodeText)):
+                return unicode(v)
+            else:
+                return v
+        return or_(*[textindex.contains(mapper.c[c], unicol(c, v)) \
+                         for c in self._properties[cls] for v in values])
 
-        for cls, columns in self._properties.iteritems():
+
+    def _value_list_per_class(self, values):
+        """
+        Search each of the registered classes with a separate query.
+        """
+        for cls in self._properties.keys():
             q = self._session.query(cls)
-            cv = [(c,v) for c in columns for v in tokens]
-            # as of SQLAlchemy>=0.4.2 we convert the value to a unicode
-            # object if the col is a Unicode or UnicodeText column in order
-            # to avoid the "Unicode type received non-unicode bind param"
-            def unicol(col, v):
-                mapper = class_mapper(cls)
-                if isinstance(mapper.c[col].type, (Unicode,UnicodeText)):
-                    return unicode(v)
-                else:
-                    return v
+            q = q.filter(self._value_list_clause(cls, values))
+            self._add_results(cls, q)
+
+
+    def _value_list_union(self, values):
+        """
+        Search all the registered classes with a single UNION ALL of
+        (class index, id) selects and then load the matched objects
+        with one IN query per class.
+        """
+        classes = self._properties.keys()
+        if not classes:
+            return
+        selects = []
+        for index, cls in enumerate(classes):
             mapper = class_mapper(cls)
-            q = q.filter(or_(*[like(mapper, c, unicol(c, v)) for c,v in cv]))
-            self._results.update(q.all())
+            selects.append(select([literal_column(str(index)).label('cls'),
+                                   mapper.c['id'].label('id')],
+                                  self._value_list_clause(cls, values)))
+        if len(selects) == 1:
+            stmt = selects[0]
+        else:
+            stmt = union_all(*selects)
+
+        ids = {}
+        for index, obj_id in self._session.execute(stmt):
+            ids.setdefault(int(index), set()).add(obj_id)
+
+        if self._keys_only:
+            for index, cls_ids in ids.iteritems():
+                self._results.update((classes[index], i) for i in cls_ids)
+            return
+
+        for index, cls_ids in ids.iteritems():
+            cls = classes[index]
+            cls_ids = list(cls_ids)
+            # chunk the ids so we don't go over the limit on the
+            # number of bind parameters in a query, e.g. sqlite's
+            # SQLITE_MAX_VARIABLE_NUMBER
+            for start in xrange(0, len(cls_ids), self.in_chunk_size):
+                chunk = cls_ids[start:start+self.in_chunk_size]
+                q = self._session.query(cls).filter(cls.id.in_(chunk))
+                self._results.update(q.all())
 
 
     def search(self, text, session):
@@ -326,6 +433,18 @@ class MapperSearch(SearchStrategy):
         return self._results
 
 
+    def search_keys(self, text, session):
+        """
+        Returns a set() of (class, id) tuples for the database hits
+        for the text search string.
+        """
+        self._keys_only = True
+        try:
+            return self.search(text, session)
+        finally:
+            self._keys_only = False
+
+
 """
 the search strategy is keyed by domain and each value will be a list of
 SearchStrategy instances
@@ -12,6 +12,7 @@ from sqlalchemy import *
 
 import bauble
 import bauble.db as db
+from bauble.error import BaubleError
 from bauble.btypes import Enum
 from bauble.utils.log import debug
 from bauble.search import SearchParser
@@ -166,6 +167,141 @@ class BaubleTests(BaubleTestCase):
             self.assert_(ids == [], "%s has duplicate ids: %s" % (f, str(ids)))
 
 
+    def test_pool_args(self):
+        """
+        Test that PostgreSQL databases get a QueuePool
+        """
+        import sqlalchemy.pool as pool
+        args = db._pool_args('postgresql://user@localhost/bauble')
+        self.assert_(args['poolclass'] is pool.QueuePool, args)
+        self.assert_('pool_size' in args and 'pool_recycle' in args, args)
+        args = db._pool_args('sqlite:///:memory:')
+        self.assert_(args == {'poolclass': pool.SingletonThreadPool}, args)
+        self.assert_(db.pool_status()[0][1] == \
+                         db.engine.pool.__class__.__name__)
+
+
+    def test_counter_engine(self):
+        """
+        Test that the code counters of a SQLite file don't share the
+        connection of the sessions
+        """
+        import tempfile
+        import sqlalchemy.pool as pool
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        engine = db.engine
+        db.engine = create_engine('sqlite:///%s' % filename,
+                                  poolclass=pool.SingletonThreadPool)
+        try:
+            counter_engine = db.get_separate_engine()
+            self.assert_(counter_engine is not db.engine)
+            self.assert_(isinstance(counter_engine.pool, pool.NullPool))
+            self.assert_(db.get_separate_engine() is counter_engine)
+        finally:
+            db.engine = engine
+            os.remove(filename)
+
+
+    def test_with_session(self):
+        """
+        Test that db.with_session reuses the caller's session
+        """
+        sessions = []
+        def func(session=None):
+            sessions.append(session)
+        func = db.with_session(func)
+        func(session=self.session)
+        self.assert_(sessions[-1] is self.session)
+        func()
+        self.assert_(sessions[-1] is not None)
+        self.assert_(sessions[-1] is not self.session)
+
+
+    def test_lazy_results(self):
+        """
+        Test that LazyResults doesn't lose objects when more keys are
+        loaded than fit in its cache
+        """
+        from bauble.plugins.plants import Family
+        from bauble.view import LazyResults, ResultKey
+        families = [Family(family=u'Family%s' % i) for i in range(30)]
+        self.session.add_all(families)
+        self.session.commit()
+        class SmallResults(LazyResults):
+            batch_size = 4
+            max_size = 10
+        results = SmallResults(self.session)
+        keys = [ResultKey(Family, f.id) for f in families]
+        keys.append(ResultKey(Family, -1))
+        results.load(keys)
+        self.assert_(len(results.cache) <= 10, len(results.cache))
+        self.assert_(results.get(keys[-2]) is families[-1])
+        self.assert_(results.get(keys[-1]) is None)
+
+        # get_objects() returns all the objects without the cache
+        objs = results.get_objects(keys)
+        self.assert_(objs[:-1] == families, objs)
+        self.assert_(objs[-1] is None)
+
+
+    def test_infobox_prefetcher(self):
+        """
+        Test that the prefetched infobox values are cached by the
+        (type, id, _last_updated) of the row
+        """
+        from bauble.plugins.plants import Family
+        from bauble.view import InfoBoxPrefetcher, prefetch_key
+        family = Family(family=u'Orchidaceae')
+        self.session.add(family)
+        self.session.commit()
+        key = prefetch_key(family)
+        self.assert_(key == (Family, family.id, family._last_updated), key)
+
+        prefetcher = InfoBoxPrefetcher()
+        prefetcher.cache[key] = {}
+        results = []
+        prefetcher.request(None, family, lambda k, v: results.append((k, v)))
+        # cached values are passed to the callback without a thread
+        self.assert_(results == [(key, {})], results)
+        self.assert_(prefetcher.thread is None)
+        prefetcher.clear()
+        self.assert_(key not in prefetcher.cache)
+
+        # the values are prefetched in the thread with the expanders
+        # collected in the main thread and delivered in the main loop
+        import threading
+        from bauble.test import update_gui
+        from bauble.view import InfoBox, InfoExpander
+        main_thread = threading.currentThread()
+        class TestExpander(InfoExpander):
+            def prefetch(self, row):
+                return (threading.currentThread(), row.family)
+        class TestInfoBox(InfoBox):
+            def get_expanders(self):
+                self.expanders_thread = threading.currentThread()
+                return super(TestInfoBox, self).get_expanders()
+        infobox = TestInfoBox()
+        expander = TestExpander(u'test')
+        infobox.add_expander(expander)
+        results = []
+        prefetcher.request(infobox, family, lambda k, v: results.append((k, v)),
+                           infobox.get_expanders())
+        start = time.time()
+        while not results and time.time() - start < 10:
+            update_gui()
+            time.sleep(.01)
+        self.assert_(len(results) == 1, results)
+        self.assert_(infobox.expanders_thread is main_thread)
+        result_key, values = results[0]
+        self.assert_(result_key == key, result_key)
+        thread, name = values[expander][1]
+        self.assert_(thread is prefetcher.thread, thread)
+        self.assert_(thread is not main_thread)
+        self.assert_(name == u'Orchidaceae', name)
+        self.assert_(prefetcher.cache[key] is values)
+
+
 class HistoryTests(BaubleTestCase):
 
     def test(self):
@@ -193,3 +329,153 @@ class HistoryTests(BaubleTestCase):
         assert history.table_name == 'family' and history.operation == 'delete'
 
 
+
+
+    def test_batch(self):
+        """
+        Test that the history rows for a flush are written with the
+        flush and discarded on rollback
+        """
+        from bauble.plugins.plants import Family
+        count = lambda: self.session.query(db.History).count()
+        start = count()
+        families = [Family(family=u'Family%s' % i) for i in range(10)]
+        self.session.add_all(families)
+        self.session.flush()
+        self.assert_(count() == start + 10, count())
+        self.session.rollback()
+        self.assert_(count() == start, count())
+
+        self.session.add_all([Family(family=u'Family%s' % i) \
+                                  for i in range(10)])
+        self.session.commit()
+        self.assert_(count() == start + 10, count())
+        history = self.session.query(db.History).\
+            order_by(db.History.id.desc()).limit(10).all()
+        self.assert_(len(set([h.user for h in history])) == 1)
+
+
+    def test_history_queue_stopped(self):
+        """
+        Test that HistoryQueue.put() writes the rows itself when the
+        thread isn't running instead of blocking
+        """
+        queue = db.HistoryQueue(db.engine, max_size=1)
+        queue.stop()
+        count = lambda: self.session.query(db.History).count()
+        start = count()
+        row = dict(table_name='family', table_id=1, values='{}',
+                   operation='insert', user=u'user',
+                   timestamp=datetime.datetime.today())
+        queue.put([row])
+        queue.put([row])
+        self.assert_(count() == start + 2, count())
+
+
+    def test_current_user(self):
+        """
+        Test that the current user is cached per connection
+        """
+        connection = db.engine.connect()
+        try:
+            user = db._current_user(connection)
+            self.assert_(connection.info['bauble.user'] == user)
+        finally:
+            connection.close()
+
+
+    def test_history_query(self):
+        """
+        Test filtering and paging through the history
+        """
+        from bauble.view import get_history_query, parse_history_args
+        from bauble.plugins.plants import Family
+        families = [Family(family=u'Family%s' % i) for i in range(5)]
+        self.session.add_all(families)
+        self.session.commit()
+        filters = parse_history_args('table=family id=%s' % families[0].id)
+        self.assert_(filters == {'table': 'family', 'id': families[0].id})
+        self.assertRaises(BaubleError, parse_history_args, 'table')
+        self.assertRaises(BaubleError, parse_history_args, 'id=abc')
+
+        query = get_history_query(self.session, filters)
+        self.assert_([h.table_id for h in query] == [families[0].id])
+
+        # page through the history two items at a time
+        filters = parse_history_args('table=family')
+        expected = [h.id for h in get_history_query(self.session, filters)]
+        ids = []
+        last = None
+        while True:
+            page = get_history_query(self.session, filters, last).\
+                limit(2).all()
+            if not page:
+                break
+            ids.extend([h.id for h in page])
+            last = (page[-1].timestamp, page[-1].id)
+        self.assert_(ids == expected, ids)
+
+
+    def test_history_values(self):
+        """
+        Test that only the changed columns are recorded and that the
+        state of a row can be rebuilt from its history
+        """
+        from bauble.plugins.plants import Family
+        f = Family(family=u'Family', qualifier=u's. lat.')
+        self.session.add(f)
+        self.session.commit()
+        f.family = u'Family2'
+        self.session.commit()
+        history = self.session.query(db.History).\
+            order_by(db.History.id.desc()).first()
+        values = db.decode_history_values(history.values)
+        self.assert_(values == {'family': u'Family2'}, values)
+
+        state = db.get_history_state(self.session, 'family', f.id)
+        self.assert_(state['family'] == u'Family2', state)
+        self.assert_(state['qualifier'] == u's. lat.', state)
+
+        # the state before the update
+        inserted = self.session.query(db.History).\
+            filter_by(table_name='family', table_id=f.id,
+                      operation='insert').one()
+        state = db.get_history_state(self.session, 'family', f.id,
+                                     inserted.timestamp)
+        self.assert_(state['family'] == u'Family', state)
+
+        # history written by older versions
+        legacy = str({'id': '1', 'family': 'Family'})
+        self.assert_(db.decode_history_values(legacy)['family'] == 'Family')
+
+        family_id = f.id
+        self.session.delete(f)
+        self.session.commit()
+        state = db.get_history_state(self.session, 'family', family_id)
+        self.assert_(state is None, state)
+
+
+    def test_compact_history(self):
+        """
+        Test that compact_history() folds the old history into snapshots
+        """
+        from bauble.plugins.plants import Family
+        f = Family(family=u'Family')
+        self.session.add(f)
+        self.session.commit()
+        for i in range(3):
+            f.family = u'Family%s' % i
+            self.session.commit()
+        family_id = f.id
+        query = self.session.query(db.History).\
+            filter_by(table_name='family', table_id=family_id)
+        self.assert_(query.count() == 4, query.count())
+        before = db.get_history_state(self.session, 'family', family_id)
+
+        tomorrow = datetime.datetime.today() + datetime.timedelta(days=1)
+        db.compact_history(tomorrow)
+        self.session.expire_all()
+        self.assert_(query.count() == 1, query.count())
+        self.assert_(query.one().operation == 'snapshot')
+        after = db.get_history_state(self.session, 'family', family_id)
+        self.assert_(after == before, after)
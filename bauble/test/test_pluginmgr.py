@@ -131,6 +131,37 @@ class StandalonePluginMgrTests(unittest.TestCase):
         bauble.pluginmgr.init(force=True)
         self.assert_(A.initialized and B.initialized and C.initialized)
 
+
+    def test_lazy_plugin(self):
+        """
+        Test that a LazyPlugin imports its module when a command is used
+        """
+        from bauble.plugins.imex import ImexPlugin
+        name = 'bauble.plugins.imex'
+        info = pluginmgr._plugin_info(ImexPlugin())
+        self.assert_(info['name'] == 'ImexPlugin')
+        self.assert_(['excsv'] in info['commands'])
+
+        lazy = pluginmgr.LazyPlugin(name, info)
+        pluginmgr._lazy_modules[name] = [lazy]
+        pluginmgr.plugins[lazy.__name__] = lazy
+        for cmd in lazy.commands:
+            pluginmgr.register_command(cmd)
+        try:
+            self.assert_(issubclass(pluginmgr.commands['excsv'],
+                                    pluginmgr.LazyCommandHandler))
+            handler = pluginmgr.commands['excsv']()
+            self.assert_(not isinstance(handler, pluginmgr.LazyCommandHandler))
+            self.assert_(name not in pluginmgr._lazy_modules)
+            self.assert_(not isinstance(pluginmgr.plugins['ImexPlugin'],
+                                        pluginmgr.LazyPlugin))
+            self.assert_(not issubclass(pluginmgr.commands['excsv'],
+                                        pluginmgr.LazyCommandHandler))
+        finally:
+            pluginmgr.plugins.clear()
+            pluginmgr.commands.clear()
+            pluginmgr._lazy_modules.clear()
+
 #     def test_install(self):
 #         """
 #         Test bauble.pluginmgr.install()
@@ -225,6 +225,95 @@ class SearchTests(BaubleTestCase):
         self.assert_(isinstance(g, Genus) and g.id==genus.id)
 
 
+    def test_search_by_values_union(self):
+        """
+        Test that the UNION and per class value list searches return
+        the same results
+        """
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        family = Family(family=u'family')
+        family2 = Family(family=u'other')
+        genus = Genus(family=family, genus=u'genus')
+        genus2 = Genus(family=family2, genus=u'otherfamily')
+        self.session.add_all([family, family2, genus, genus2])
+        self.session.commit()
+        mapper_search = search._search_strategies[0]
+        self.assert_(isinstance(mapper_search, search.MapperSearch))
+
+        try:
+            for s in ('family', 'family genus', 'other', 'nothing'):
+                mapper_search.union_value_list = True
+                union_results = set(mapper_search.search(s, self.session))
+                mapper_search.union_value_list = False
+                results = set(mapper_search.search(s, self.session))
+                self.assert_(union_results == results,
+                             '%s: %s != %s' % (s, union_results, results))
+        finally:
+            del mapper_search.union_value_list
+
+        results = mapper_search.search('family', self.session)
+        self.assert_(set(results) == set([family, genus2]))
+
+
+    def test_search_keys(self):
+        """
+        Test that search_keys() returns the (class, id) of the results
+        """
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        family = Family(family=u'family')
+        genus = Genus(family=family, genus=u'genus')
+        self.session.add_all([family, genus])
+        self.session.commit()
+        mapper_search = search._search_strategies[0]
+
+        for s in ('family', 'fam=family', 'genus where family.family=family'):
+            results = mapper_search.search(s, self.session)
+            expected = set((type(o), o.id) for o in results)
+            keys = set(mapper_search.search_keys(s, self.session))
+            self.assert_(keys == expected, '%s: %s' % (s, keys))
+
+        keys = search.search_keys('genus', self.session)
+        self.assert_(keys == [(Genus, genus.id)], keys)
+
+
+    def test_search_textindex(self):
+        """
+        Test that searches return the same results with a text index
+        """
+        import bauble.textindex as textindex
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        family = Family(family=u'family')
+        genus = Genus(family=family, genus=u'genus')
+        self.session.add_all([family, genus])
+        self.session.commit()
+        mapper_search = search._search_strategies[0]
+        textindex.build()
+        try:
+            self.assert_(textindex.get_index() is not None)
+
+            # make sure new objects are added to the index
+            genus2 = Genus(family=family, genus=u'newgenus')
+            self.session.add(genus2)
+            self.session.commit()
+
+            results = mapper_search.search('genus', self.session)
+            self.assert_(set(results) == set([genus, genus2]), results)
+            # substrings are matched through the index
+            results = mapper_search.search('enus', self.session)
+            self.assert_(set(results) == set([genus, genus2]), results)
+            results = mapper_search.search('fam contains fami',
+                                           self.session)
+            self.assert_(set(results) == set([family]), results)
+            results = mapper_search.search('gen like ewgen', self.session)
+            self.assert_(set(results) == set([genus2]), results)
+        finally:
+            textindex.drop()
+        self.assert_(textindex.get_index() is None)
+
+
     def test_search_by_expression(self):
         """
         Test searching by expression with MapperSearch
@@ -0,0 +1,403 @@
+#
+# textindex.py
+#
+"""
+Optional substring search indexes for the properties registered with
+:meth:`bauble.search.MapperSearch.add_meta`.
+
+Most of the default searches do a ``LIKE '%value%'`` which can't use
+a normal btree index.  On PostgreSQL the text index is a pg_trgm GIN
+index on each of the search properties.  On SQLite the text index is
+an FTS5 table using the trigram tokenizer that shadows the search
+properties and is kept in sync by the
+:class:`bauble.db.HistoryExtension`.
+
+The index is only used if it has been built with the ``textindex``
+command, e.g.  ``:textindex build``.
+"""
+import sqlalchemy as sa
+from sqlalchemy.orm import class_mapper
+
+import bauble
+import bauble.db as db
+from bauble.error import BaubleError
+import bauble.pluginmgr as pluginmgr
+import bauble.utils as utils
+from bauble.utils.log import debug, warning
+
+
+def _get_properties():
+    """
+    Return a dict of table -> list of column names for all the
+    properties registered with MapperSearch.add_meta()
+    """
+    import bauble.search as search
+    properties = {}
+    for cls, columns in search.MapperSearch._properties.iteritems():
+        table = class_mapper(cls).local_table
+        properties[table] = [c for c in columns if c in table.c]
+    return properties
+
+
+
+class TextIndex(object):
+    """
+    Interface for the database specific text indexes.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+
+
+    def exists(self):
+        """
+        Return True if the index has been built in the database.
+        """
+        raise NotImplementedError
+
+
+    def build(self, properties):
+        """
+        Build or rebuild the index.
+
+        :param properties: a dict of table -> list of column names
+        """
+        raise NotImplementedError
+
+
+    def drop(self):
+        """
+        Remove the index from the database.
+        """
+        raise NotImplementedError
+
+
+    def contains(self, column, value):
+        """
+        Return a clause that matches rows where column contains value
+        or None if the default ilike clause should be used.
+        """
+        return None
+
+
+    def update(self, connection, operation, table, instance):
+        """
+        Update the index after a change to instance.  This is called
+        from the HistoryExtension on the connection of the flush.
+        """
+        pass
+
+
+    def insert(self, connection, table, rows):
+        """
+        Add new rows that were inserted without the mappers, see
+        :func:`bauble.db.insert_rows`.
+
+        :param rows: a list of dicts of the column values of the rows
+        """
+        pass
+
+
+    def delete(self, connection, table, ids):
+        """
+        Remove rows that were deleted without the mappers, see
+        :func:`bauble.db.delete_rows`.
+
+        :param ids: the ids of the deleted rows
+        """
+        pass
+
+
+
+class PostgresTrigramIndex(TextIndex):
+    """
+    Create a pg_trgm GIN index on each of the search properties.  The
+    ILIKE clauses created by utils.ilike() use the index without any
+    changes to the queries and PostgreSQL keeps the index up to date
+    itself.
+    """
+
+    prefix = 'ix_trgm'
+
+    def _index_name(self, table, column):
+        return '%s_%s_%s' % (self.prefix, table.name, column)
+
+
+    def exists(self):
+        stmt = sa.text("SELECT count(*) FROM pg_indexes "
+                       "WHERE indexname LIKE :prefix")
+        result = self.engine.execute(stmt, prefix='%s%%' % self.prefix)
+        count = result.scalar()
+        result.close()
+        return count > 0
+
+
+    def build(self, properties):
+        conn = self.engine.connect()
+        trans = conn.begin()
+        try:
+            conn.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm;')
+            for table, columns in properties.iteritems():
+                for column in columns:
+                    name = self._index_name(table, column)
+                    conn.execute('DROP INDEX IF EXISTS %s;' % name)
+                    conn.execute('CREATE INDEX %s ON %s USING gin '
+                                 '(%s gin_trgm_ops);' \
+                                     % (name, table.name, column))
+        except Exception, e:
+            warning('PostgresTrigramIndex.build(): %s' % utils.utf8(e))
+            trans.rollback()
+            raise
+        else:
+            trans.commit()
+        finally:
+            conn.close()
+
+
+    def drop(self):
+        stmt = sa.text("SELECT indexname FROM pg_indexes "
+                       "WHERE indexname LIKE :prefix")
+        conn = self.engine.connect()
+        trans = conn.begin()
+        try:
+            names = [r[0] for r in conn.execute(stmt, prefix='%s%%' \
+                                                    % self.prefix)]
+            for name in names:
+                conn.execute('DROP INDEX IF EXISTS %s;' % name)
+        except Exception, e:
+            trans.rollback()
+            raise
+        else:
+            trans.commit()
+        finally:
+            conn.close()
+
+
+
+class SQLiteFTSIndex(TextIndex):
+    """
+    Shadow the search properties in an FTS5 table using the trigram
+    tokenizer.  The FTS5 trigram tokenizer can answer LIKE '%value%'
+    queries from the index.
+
+    Requires SQLite 3.34 or greater.
+    """
+
+    table_name = 'textindex'
+
+    def __init__(self, engine):
+        super(SQLiteFTSIndex, self).__init__(engine)
+        self.table = sa.Table(self.table_name, sa.MetaData(),
+                              sa.Column('tbl', sa.String),
+                              sa.Column('obj_id', sa.Integer),
+                              sa.Column('col', sa.String),
+                              sa.Column('value', sa.Unicode))
+
+
+    def exists(self):
+        return self.engine.has_table(self.table_name)
+
+
+    def build(self, properties):
+        conn = self.engine.connect()
+        trans = conn.begin()
+        try:
+            conn.execute('DROP TABLE IF EXISTS %s;' % self.table_name)
+            conn.execute("CREATE VIRTUAL TABLE %s USING fts5"
+                         "(tbl UNINDEXED, obj_id UNINDEXED, col UNINDEXED, "
+                         "value, tokenize='trigram');" % self.table_name)
+            for table, columns in properties.iteritems():
+                for column in columns:
+                    conn.execute("INSERT INTO %(index)s "
+                                 "(tbl, obj_id, col, value) "
+                                 "SELECT '%(table)s', id, '%(col)s', %(col)s "
+                                 "FROM %(table)s WHERE %(col)s IS NOT NULL;" \
+                                     % dict(index=self.table_name,
+                                            table=table.name, col=column))
+        except Exception, e:
+            warning('SQLiteFTSIndex.build(): %s' % utils.utf8(e))
+            trans.rollback()
+            raise
+        else:
+            trans.commit()
+        finally:
+            conn.close()
+
+
+    def drop(self):
+        self.engine.execute('DROP TABLE IF EXISTS %s;' % self.table_name)
+
+
+    def contains(self, column, value):
+        t = self.table
+        stmt = sa.select([t.c.obj_id],
+                         sa.and_(t.c.tbl == column.table.name,
+                                 t.c.col == column.name,
+                                 t.c.value.like(utils.utf8('%%%s%%' % value))))
+        return column.table.c.id.in_(stmt)
+
+
+    def update(self, connection, operation, table, instance):
+        columns = _get_properties().get(table)
+        if not columns:
+            return
+        t = self.table
+        if operation in ('update', 'delete'):
+            connection.execute(t.delete().where(\
+                    sa.and_(t.c.tbl == table.name,
+                            t.c.obj_id == instance.id)))
+        if operation in ('insert', 'update'):
+            row = dict([(column, getattr(instance, column)) \
+                            for column in columns])
+            row['id'] = instance.id
+            self.insert(connection, table, [row])
+
+
+    def insert(self, connection, table, rows):
+        columns = _get_properties().get(table)
+        if not columns:
+            return
+        values = []
+        for row in rows:
+            for column in columns:
+                value = row.get(column, None)
+                if value is not None:
+                    values.append(dict(tbl=table.name, obj_id=row['id'],
+                                       col=column, value=utils.utf8(value)))
+        if values:
+            connection.execute(self.table.insert(), values)
+
+
+    def delete(self, connection, table, ids):
+        if not _get_properties().get(table) or not ids:
+            return
+        t = self.table
+        connection.execute(t.delete().where(\
+                sa.and_(t.c.tbl == table.name, t.c.obj_id.in_(list(ids)))))
+
+
+
+_index_classes = {'postgresql': PostgresTrigramIndex,
+                  'sqlite': SQLiteFTSIndex}
+
+# cache of (engine, index) so we only check if the index exists once
+# per connection
+_index = (None, None)
+
+def get_index(engine=None):
+    """
+    Return the text index for engine if it has been built in the
+    database else return None.
+
+    :param engine: the engine to use, if None then use bauble.db.engine
+    """
+    global _index
+    if engine is None:
+        engine = db.engine
+    if engine is None or engine.name not in _index_classes:
+        return None
+    cached_engine, index = _index
+    if cached_engine is engine:
+        return index
+    index = _index_classes[engine.name](engine)
+    try:
+        if not index.exists():
+            index = None
+    except Exception, e:
+        debug(e)
+        index = None
+    _index = (engine, index)
+    return index
+
+
+def build(engine=None):
+    """
+    Build or rebuild the text index for all the properties registered
+    with MapperSearch.add_meta().
+    """
+    global _index
+    if engine is None:
+        engine = db.engine
+    if engine.name not in _index_classes:
+        raise BaubleError(_('Text indexes are not supported on %s '
+                            'databases') % engine.name)
+    index = _index_classes[engine.name](engine)
+    index.build(_get_properties())
+    _index = (engine, index)
+
+
+def drop(engine=None):
+    """
+    Remove the text index from the database.
+    """
+    global _index
+    if engine is None:
+        engine = db.engine
+    if engine.name in _index_classes:
+        _index_classes[engine.name](engine).drop()
+    _index = (engine, None)
+
+
+def contains(column, value):
+    """
+    Return a clause for a case-insensitive match of value anywhere in
+    column.  Uses the text index if there is one.
+    """
+    index = get_index()
+    if index is not None:
+        clause = index.contains(column, value)
+        if clause is not None:
+            return clause
+    return utils.ilike(column, '%%%s%%' % value)
+
+
+def update(connection, operation, mapper, instance):
+    """
+    Keep the text index in sync with a change made to instance.
+    """
+    index = get_index()
+    if index is None:
+        return
+    index.update(connection, operation, mapper.local_table, instance)
+
+
+def insert(connection, table, rows):
+    """
+    Add rows that were inserted into table without the mappers to the
+    text index, this does nothing if the text index hasn't been built.
+    """
+    index = get_index()
+    if index is None:
+        return
+    index.insert(connection, table, rows)
+
+
+
+def delete(connection, table, ids):
+    """
+    Remove the rows of table with ids that were deleted without the
+    mappers from the text index, this does nothing if the text index
+    hasn't been built.
+    """
+    index = get_index()
+    if index is None:
+        return
+    index.delete(connection, table, ids)
+
+
+
+class TextIndexCommandHandler(pluginmgr.CommandHandler):
+
+    command = 'textindex'
+
+    def __call__(self, cmd, arg):
+        if arg in ('drop', 'remove'):
+            drop()
+            msg = _('The text index has been removed.')
+        else:
+            build()
+            msg = _('The text index has been built.')
+        utils.message_dialog(msg)
+
+
+pluginmgr.register_command(TextIndexCommandHandler)
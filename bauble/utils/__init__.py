@@ -707,6 +707,20 @@ def natsort_key(obj):
     return (chunks, item)
 
 
+__natsort_digits_rx = re.compile('\d+')
+
+def natsort_str(obj, width=10):
+    """
+    Return a unicode string that sorts naturally when compared as a
+    plain string, e.g. by ORDER BY in the database.  The numbers in
+    the string are zero padded to width.
+
+    natsort_str('2009.39.1') == u'0000002009.0000000039.0000000001'
+    """
+    pad = lambda m: m.group(0).zfill(width)
+    return __natsort_digits_rx.sub(pad, utf8(obj))
+
+
 
 def delete_or_expunge(obj):
     """
@@ -1244,3 +1258,72 @@ def get_urls(text):
         #print match.groups()
         matches.append(match.groups())
     return matches
+
+
+class LRUCache(object):
+    """
+    A dict like cache that holds at most max_size items.  When the
+    cache is full the least recently used items are discarded.
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._data = {}
+        self._tick = 0
+
+
+    def _touch(self, key, value):
+        self._tick += 1
+        self._data[key] = (self._tick, value)
+
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+    def __len__(self):
+        return len(self._data)
+
+
+    def __getitem__(self, key):
+        tick, value = self._data[key]
+        self._touch(key, value)
+        return value
+
+
+    def __setitem__(self, key, value):
+        self._touch(key, value)
+        if len(self._data) > self.max_size:
+            self._evict()
+
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+    def pop(self, key, default=None):
+        try:
+            return self._data.pop(key)[1]
+        except KeyError:
+            return default
+
+
+    def clear(self):
+        self._data.clear()
+
+
+    def _evict(self):
+        """
+        Remove the least recently used quarter of the items.
+        """
+        nremove = max(1, len(self._data) - (self.max_size * 3 / 4))
+        oldest = sorted(self._data.iteritems(), key=lambda i: i[1][0])
+        for key, item in oldest[:nremove]:
+            del self._data[key]
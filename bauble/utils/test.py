@@ -109,6 +109,37 @@ class UtilsTests(unittest.TestCase):
         #self.assertRaises(ParseException, utils.range_builder, 'a-b')
 
 
+    def test_lru_cache(self):
+        """
+        Test bauble.utils.LRUCache
+        """
+        cache = utils.LRUCache(max_size=4)
+        for i in range(4):
+            cache[i] = str(i)
+        self.assert_(len(cache) == 4)
+        # touch 0 so that it's not the least recently used
+        self.assert_(cache[0] == '0')
+        cache[4] = '4'
+        self.assert_(len(cache) <= 4)
+        self.assert_(0 in cache and 4 in cache)
+        self.assert_(1 not in cache)
+        self.assert_(cache.get(1) is None)
+        self.assert_(cache.pop(4) == '4' and 4 not in cache)
+        cache.clear()
+        self.assert_(len(cache) == 0)
+
+
+    def test_natsort_str(self):
+        """
+        Test that strings from utils.natsort_str() sort naturally
+        """
+        values = ['2009.10', 'a10', '010', '2009.9', 'a9', '2009.9.2', '1']
+        expected = ['1', '010', '2009.9', '2009.9.2', '2009.10', 'a9', 'a10']
+        result = sorted(values, key=utils.natsort_str)
+        self.assert_(result == expected, result)
+        self.assert_(utils.natsort_str('a2') == u'a0000000002')
+
+
     def test_get_urls(self):
         text = 'There a link in here: http://bauble.belizebotanic.org'
         urls = utils.get_urls(text)
@@ -5,9 +5,12 @@
 #
 import itertools
 import os
+import Queue
 import re
 import sys
+import threading
 import traceback
+import types
 
 import gtk
 import gobject
@@ -130,6 +133,30 @@ class InfoExpander(gtk.Expander):
         raise NotImplementedError("InfoExpander.update(): not implemented")
 
 
+    def prefetch(self, row):
+        '''
+        Return the values that update() needs to query the database
+        for, e.g. counts.  This is called from the
+        :class:`InfoBoxPrefetcher` thread with row loaded in the
+        thread's own session so it shouldn't touch any widgets.
+
+        The default returns None, i.e. there is nothing to prefetch.
+        '''
+        return None
+
+
+    def get_prefetched(self, row):
+        '''
+        Return the value prefetch() returned for row.  If the value
+        wasn't prefetched, e.g. the infobox was updated directly, then
+        call prefetch() now.
+        '''
+        prefetched = getattr(self, '_prefetched', None)
+        if prefetched is not None and prefetched[0] == prefetch_key(row):
+            return prefetched[1]
+        return self.prefetch(row)
+
+
 
 class PropertiesExpander(InfoExpander):
 
@@ -191,6 +218,15 @@ class PropertiesExpander(InfoExpander):
 
 
 
+def prefetch_key(row):
+    """
+    Return the (type, id, _last_updated) of row.  This is the key the
+    prefetched infobox values of row are cached by.
+    """
+    return (type(row), row.id, row._last_updated)
+
+
+
 class InfoBoxPage(gtk.ScrolledWindow):
     """
     A :class:`gtk.ScrolledWindow` that contains
@@ -316,6 +352,139 @@ class InfoBox(gtk.Notebook):
         self.get_nth_page(page_num).update(row)
 
 
+    def get_expanders(self):
+        """
+        Return the expanders on all the pages of the InfoBox.
+        """
+        expanders = []
+        for page_num in xrange(self.get_n_pages()):
+            expanders.extend(self.get_nth_page(page_num).expanders.values())
+        return expanders
+
+
+    def prefetch(self, row, expanders=None):
+        """
+        Return a dict of expander -> (key, value) for the values
+        returned by the prefetch() method of the expanders.  This is
+        called from the :class:`InfoBoxPrefetcher` thread.
+
+        Override this method if the expanders are updated with
+        something other than row.
+
+        :param row: the mapped object
+        :param expanders: the expanders to prefetch the values for, the
+          thread has to pass the list that get_expanders() returned in
+          the main loop since it can't touch the notebook itself
+        """
+        values = {}
+        key = prefetch_key(row)
+        if expanders is None:
+            expanders = self.get_expanders()
+        for expander in expanders:
+            try:
+                value = expander.prefetch(row)
+            except Exception, e:
+                debug('%s.prefetch(): %s' % (type(expander).__name__,
+                                             utils.utf8(e)))
+                continue
+            if value is not None:
+                values[expander] = (key, value)
+        return values
+
+
+    def set_prefetched(self, values):
+        """
+        Set the values returned by prefetch() on the expanders so that
+        the next update() uses them instead of querying the database.
+        """
+        for expander in self.get_expanders():
+            expander._prefetched = values.get(expander, None)
+
+
+
+class InfoBoxPrefetcher(object):
+    """
+    Call :meth:`InfoBox.prefetch` from a background thread so that
+    the database work of updating an infobox doesn't block the main
+    loop.
+
+    The thread loads the rows in its own session and only works on
+    the most recent request, older requests are dropped.  The results
+    are passed to the callback in the main loop with gobject.idle_add
+    and kept in an LRU cache by the (type, id, _last_updated) of the
+    row.
+    """
+
+    def __init__(self, max_size=200):
+        self.cache = utils.LRUCache(max_size)
+        self.queue = Queue.Queue()
+        self.thread = None
+
+
+    def clear(self):
+        """
+        Clear the cached values, e.g. after the database has changed.
+        """
+        self.cache.clear()
+
+
+    def request(self, infobox, row, callback, expanders=None):
+        """
+        Prefetch the values for row and call callback(key, values) in
+        the main loop when they're ready.  If the values are already
+        cached then the callback is called immediately.  This has to
+        be called in the main loop.
+
+        :param infobox: the InfoBox to prefetch the values for
+        :param row: the mapped object
+        :param callback: the callable to pass the results to
+        :param expanders: the expanders of infobox to prefetch the
+          values for, if None then infobox.get_expanders() is used
+        """
+        key = prefetch_key(row)
+        if key in self.cache:
+            callback(key, self.cache[key])
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.setDaemon(True)
+            self.thread.start()
+        if expanders is None:
+            expanders = infobox.get_expanders()
+        self.queue.put((key, infobox, expanders, callback))
+
+
+    def _deliver(self, key, values, callback):
+        # called in the main loop, the cache is only changed here
+        self.cache[key] = values
+        callback(key, values)
+        return False
+
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            # skip to the most recent request
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+            key, infobox, expanders, callback = item
+            values = {}
+            session = db.Session()
+            try:
+                try:
+                    row = session.query(key[0]).get(key[1])
+                    if row is not None:
+                        values = infobox.prefetch(row, expanders)
+                except Exception, e:
+                    debug('InfoBoxPrefetcher: %s' % utils.utf8(e))
+            finally:
+                session.close()
+            gobject.idle_add(self._deliver, key, values, callback)
+
+
 
 class LinksExpander(InfoExpander):
 
@@ -348,6 +517,146 @@ class LinksExpander(InfoExpander):
 
 
 
+class ResultKey(tuple):
+    """
+    A (type, id, sort_key) tuple that stands in for a search result in
+    the SearchView until the object is needed.
+    """
+    __slots__ = ()
+
+    def __new__(cls, type_, id_, sort_key=None):
+        return tuple.__new__(cls, (type_, id_, sort_key))
+
+    type = property(lambda self: self[0])
+    id = property(lambda self: self[1])
+    sort_key = property(lambda self: self[2])
+
+    def matches(self, obj):
+        """
+        Return True if this key refers to obj.
+        """
+        return type(obj) is self[0] and getattr(obj, 'id', None) == self[1]
+
+
+
+class LazyResults(object):
+    """
+    Load the mapped objects for ResultKeys on demand in batches and
+    keep at most max_size of them alive.
+    """
+
+    batch_size = 100
+    """The number of objects to load at a time."""
+
+    max_size = 2000
+    """The maximum number of loaded objects to keep."""
+
+    def __init__(self, session):
+        self.session = session
+        self.cache = utils.LRUCache(self.max_size)
+
+
+    def clear(self):
+        self.cache.clear()
+
+
+    def _query(self, cls, ids):
+        """
+        Yield the objects of type cls for ids, batch_size at a time.
+        """
+        for start in xrange(0, len(ids), self.batch_size):
+            chunk = ids[start:start+self.batch_size]
+            for obj in self.session.query(cls).filter(cls.id.in_(chunk)):
+                yield obj
+
+
+    def load(self, keys):
+        """
+        Load the objects for all the keys that aren't already loaded.
+
+        The keys are loaded in windows that fit in the cache so the
+        objects of a window aren't evicted while it is being loaded.
+        Use get_objects() to get the objects for more keys than the
+        cache can hold.
+        """
+        keys = [key[:2] for key in keys if key[:2] not in self.cache]
+        window = self.max_size / 2
+        for start in xrange(0, len(keys), window):
+            by_type = {}
+            for cls, obj_id in keys[start:start+window]:
+                by_type.setdefault(cls, []).append(obj_id)
+            for cls, ids in by_type.iteritems():
+                found = set()
+                for obj in self._query(cls, ids):
+                    self.cache[(cls, obj.id)] = obj
+                    found.add(obj.id)
+                # remember keys for objects that were deleted so we don't
+                # keep querying for them
+                for obj_id in ids:
+                    if obj_id not in found:
+                        self.cache[(cls, obj_id)] = None
+
+
+    def get_objects(self, keys):
+        """
+        Return a list of the objects for keys, with None for the
+        objects that don't exist.  The objects that aren't already
+        loaded are queried directly and not added to the cache.
+        """
+        objs = {}
+        missing = {}
+        for key in keys:
+            k = key[:2]
+            if k in self.cache:
+                objs[k] = self.cache[k]
+            else:
+                missing.setdefault(k[0], []).append(k[1])
+        for cls, ids in missing.iteritems():
+            for obj in self._query(cls, ids):
+                objs[(cls, obj.id)] = obj
+        return [objs.get(key[:2]) for key in keys]
+
+
+    def get(self, key):
+        """
+        Return the object for key or None if it doesn't exist.
+        """
+        k = key[:2]
+        if k not in self.cache:
+            self.load([key])
+        return self.cache.get(k)
+
+
+    def sort_keys(self, keys, view_meta):
+        """
+        Return a list of ResultKey from a list of (type, id) tuples.
+
+        The sort keys are retrieved with a column only query using the
+        sort_key of the type's view meta.  If the type doesn't have a
+        sort_key then the id is used.
+        """
+        by_type = {}
+        for cls, obj_id in keys:
+            by_type.setdefault(cls, []).append(obj_id)
+        results = []
+        for cls, ids in by_type.iteritems():
+            sort_key = view_meta[cls].get_sort_key()
+            if sort_key is None:
+                results.extend(ResultKey(cls, i, i) for i in ids)
+                continue
+            values = {}
+            for start in xrange(0, len(ids), search.MapperSearch.in_chunk_size):
+                chunk = ids[start:start+search.MapperSearch.in_chunk_size]
+                q = self.session.query(cls.id, sort_key).\
+                    filter(cls.id.in_(chunk))
+                values.update(q)
+            for i in ids:
+                value = utils.utf8(values.get(i, '')).encode('utf-8')
+                results.append(ResultKey(cls, i, utils.natsort_key(value)))
+        return results
+
+
+
 class SearchView(pluginmgr.View):
     """
     The SearchView is the main view for Bauble.  It manages the search
@@ -366,11 +675,12 @@ class SearchView(pluginmgr.View):
                 self.children = None
                 self.infobox = None
                 self.markup_func = None
+                self.sort_key = None
                 self.actions = []
 
 
             def set(self, children=None, infobox=None, context_menu=None,
-                    markup_func=None):
+                    markup_func=None, sort_key=None):
                 '''
                 :param children: where to find the children for this type,
                     can be a callable of the form C{children(row)}
@@ -385,10 +695,16 @@ class SearchView(pluginmgr.View):
                 the instances __str__() function is called...the
                 strings returned by this function should escape any
                 non markup characters
+
+                :param sort_key: a column expression used to sort the
+                search results of this type without loading them, can
+                be a callable that returns the column expression, if
+                sort_key is None then the results are sorted by id
                 '''
                 self.children = children
                 self.infobox = infobox
                 self.markup_func = markup_func
+                self.sort_key = sort_key
                 self.context_menu = context_menu
                 self.actions = []
                 if self.context_menu:
@@ -410,6 +726,16 @@ class SearchView(pluginmgr.View):
                 return getattr(obj, self.children)
 
 
+            def get_sort_key(self):
+                '''
+                Return the column expression to sort this type by or
+                None.
+                '''
+                if isinstance(self.sort_key, types.FunctionType):
+                    return self.sort_key()
+                return self.sort_key
+
+
         def __getitem__(self, item):
             if item not in self: # create on demand
                 self[item] = self.Meta()
@@ -437,9 +763,27 @@ class SearchView(pluginmgr.View):
         self.infobox_cache = {}
         self.infobox = None
 
+        # the infobox is updated infobox_delay milliseconds after the
+        # cursor stops moving and the values are prefetched in a thread
+        self.infobox_timeout_id = None
+        self.prefetcher = InfoBoxPrefetcher()
+
         # keep all the search results in the same session, this should
         # be cleared when we do a new search
         self.session = db.Session()
+        self.results = LazyResults(self.session)
+
+
+    def get_value(self, model, treeiter):
+        """
+        Return the value in the first column of the row at treeiter.
+        If the value is a ResultKey then return the object it refers
+        to or None if the object doesn't exist anymore.
+        """
+        value = model.get_value(treeiter, 0)
+        if isinstance(value, ResultKey):
+            return self.results.get(value)
+        return value
 
 
     def update_notes(self):
@@ -476,43 +820,70 @@ class SearchView(pluginmgr.View):
     def update_infobox(self):
         '''
         Sets the infobox according to the currently selected row
-        or remove the infobox is nothing is selected
+        or remove the infobox is nothing is selected.
+
+        The values for the infobox are prefetched in a thread and the
+        infobox is set when they're ready.
         '''
-        self.set_infobox_from_row(None)
         values = self.get_selected_values()
-        if len(values) == 0:
+        if not values:
+            self.set_infobox_from_row(None)
             return
+        row = values[0]
+        infobox = None
         try:
-            self.set_infobox_from_row(values[0])
+            infobox = self.get_infobox(type(row))
         except Exception, e:
             debug('SearchView.update_infobox: %s' % e)
             debug(traceback.format_exc())
-            debug(values)
+        if infobox is None:
             self.set_infobox_from_row(None)
+            return
+        try:
+            # the expanders are collected here since the prefetcher's
+            # thread can't touch the infobox's widgets
+            expanders = infobox.get_expanders()
+            self.prefetcher.request(infobox, row, self.on_infobox_prefetched,
+                                    expanders)
+        except Exception, e:
+            debug('SearchView.update_infobox: %s' % e)
+            self.set_infobox_from_row(row)
 
 
-    def set_infobox_from_row(self, row):
+    def on_infobox_prefetched(self, key, values):
         '''
-        Get the infobox from the view meta for the type of row and
-        set the infobox values from row
-
-        :param row: the row to use to update the infobox
+        Set the infobox from the selected row if it's the row the
+        values were prefetched for.
         '''
-        # remove the current infobox if there is one and stop
-#        debug('set_infobox_from_row: %s --  %s' % (row, repr(row)))
-        if row is None:
-            if self.infobox is not None and self.infobox.parent == self.pane:
-                self.pane.remove(self.infobox)
+        selected = self.get_selected_values()
+        if not selected:
             return
+        row = selected[0]
+        try:
+            if prefetch_key(row) != key:
+                # the selection changed since the request was made
+                return
+            infobox = self.get_infobox(type(row))
+            if infobox is not None:
+                infobox.set_prefetched(values)
+            self.set_infobox_from_row(row)
+        except Exception, e:
+            debug('SearchView.on_infobox_prefetched: %s' % e)
+            debug(traceback.format_exc())
+            self.set_infobox_from_row(None)
 
-        new_infobox = None
-        selected_type = type(row)
 
+    def get_infobox(self, selected_type):
+        '''
+        Return the infobox for selected_type or None if the type
+        doesn't have one.  The infoboxes are created on demand.
+        '''
         # check if we've already created an infobox of this type,
         # if not create one and put it in self.infobox_cache
         if selected_type in self.infobox_cache.keys():
-            new_infobox = self.infobox_cache[selected_type]
-        elif selected_type in self.view_meta and \
+            return self.infobox_cache[selected_type]
+        new_infobox = None
+        if selected_type in self.view_meta and \
           self.view_meta[selected_type].infobox is not None:
             # reuse an instance of an existing infobox if it's of the
             # same type
@@ -522,6 +893,24 @@ class SearchView(pluginmgr.View):
             if not new_infobox:
                 new_infobox = self.view_meta[selected_type].infobox()
             self.infobox_cache[selected_type] = new_infobox
+        return new_infobox
+
+
+    def set_infobox_from_row(self, row):
+        '''
+        Get the infobox from the view meta for the type of row and
+        set the infobox values from row
+
+        :param row: the row to use to update the infobox
+        '''
+        # remove the current infobox if there is one and stop
+#        debug('set_infobox_from_row: %s --  %s' % (row, repr(row)))
+        if row is None:
+            if self.infobox is not None and self.infobox.parent == self.pane:
+                self.pane.remove(self.infobox)
+            return
+
+        new_infobox = self.get_infobox(type(row))
 
         # remove any old infoboxes connected to the pane
         if self.infobox is not None and \
@@ -544,7 +933,28 @@ class SearchView(pluginmgr.View):
         model, rows = self.results_view.get_selection().get_selected_rows()
         if model is None:
             return None
-        return [model[row][0] for row in rows]
+        return self.get_values(model, rows)
+
+
+    def get_values(self, model, paths=None):
+        '''
+        Return the values at paths in model.  If paths is None then
+        return the values for all the top level rows.
+
+        Any rows that are ResultKeys are loaded in batches.
+        '''
+        if paths is None:
+            paths = [(i,) for i in xrange(model.iter_n_children(None))]
+        values = [model[path][0] for path in paths]
+        keys = [v for v in values if isinstance(v, ResultKey)]
+        objs = iter(self.results.get_objects(keys))
+        results = []
+        for value in values:
+            if isinstance(value, ResultKey):
+                value = objs.next()
+            if value is not None:
+                results.append(value)
+        return results
 
 
     def on_cursor_changed(self, view):
@@ -552,8 +962,17 @@ class SearchView(pluginmgr.View):
         Update the infobox and switch the accelerators depending on the
         type of the row that the cursor points to.
         '''
-        self.update_infobox()
-        self.update_notes()
+        # only update the infobox and notes once the cursor has
+        # stopped moving for infobox_delay milliseconds
+        if self.infobox_timeout_id is not None:
+            gobject.source_remove(self.infobox_timeout_id)
+        def on_timeout():
+            self.infobox_timeout_id = None
+            self.update_infobox()
+            self.update_notes()
+            return False
+        self.infobox_timeout_id = gobject.timeout_add(self.infobox_delay,
+                                                      on_timeout)
 
         for accel, cb in self.installed_accels:
             # disconnect previously installed accelerators by the key
@@ -598,6 +1017,10 @@ class SearchView(pluginmgr.View):
 
     nresults_statusbar_context = 'searchview.nresults'
 
+    infobox_delay = 100
+    """The milliseconds to wait after the cursor moves before updating
+    the infobox."""
+
 
     def search(self, text):
         """
@@ -613,10 +1036,14 @@ class SearchView(pluginmgr.View):
         # create a new session for each search...maybe we shouldn't
         # even have session as a class attribute
         self.session = db.Session()
+        self.results = LazyResults(self.session)
+        self.prefetcher.clear()
         bold = '<b>%s</b>'
         results = []
         try:
-            results = search.search(text, self.session)
+            # only get the (type, id) of the results, the objects are
+            # loaded as the rows become visible
+            results = search.search_keys(text, self.session)
         except ParseException, err:
             error_msg = _('Error in search string at column %s') % err.column
         except (BaubleError, AttributeError, Exception, SyntaxError), e:
@@ -641,12 +1068,6 @@ class SearchView(pluginmgr.View):
             model.append([msg])
             self.results_view.set_model(model)
         else:
-            if len(results) > 5000:
-                msg = _('This query returned %s results.  It may take a '\
-                        'long time to get all the data. Are you sure you '\
-                        'want to continue?') % len(results)
-                if not utils.yes_no_dialog(msg):
-                    return
             statusbar.push(sbcontext_id, _("Retrieving %s search " \
                                            "results...") % len(results))
             try:
@@ -695,7 +1116,11 @@ class SearchView(pluginmgr.View):
         '''
         expand = False
         model = view.get_model()
-        row = model.get_value(treeiter, 0)
+        row = self.get_value(model, treeiter)
+        if row is None:
+            # the object was deleted
+            model.remove(treeiter)
+            return True
         view.collapse_row(path)
         self.remove_children(model, treeiter)
         try:
@@ -721,7 +1146,8 @@ class SearchView(pluginmgr.View):
         """
         Adds results to the search view in a task.
 
-        :param results: a list or list-like object
+        :param results: a list or list-like object of mapped objects or
+          (type, id) tuples
         :param check_for_kids: only used for testing
         """
         bauble.task.queue(self._populate_worker(results, check_for_kids))
@@ -732,49 +1158,38 @@ class SearchView(pluginmgr.View):
         Generator function for adding the search results to the
         model. This method is usually called by self.populate_results()
         """
-        nresults = len(results)
+        # only keep the (type, id) of the results in the model, the
+        # objects are loaded by self.results when they're needed
+        keys = set()
+        for obj in results:
+            if isinstance(obj, tuple):
+                keys.add(tuple(obj[:2]))
+            else:
+                keys.add((type(obj), obj.id))
+        nresults = len(keys)
         model = gtk.TreeStore(object)
         model.set_default_sort_func(lambda *args: -1)
         model.set_sort_column_id(-1, gtk.SORT_ASCENDING)
         utils.clear_model(self.results_view)
 
-        groups = []
-
-        # sort by type so that groupby works properly
-        results = sorted(results, key=lambda x: type(x))
-
-        for key, group in itertools.groupby(results, key=lambda x: type(x)):
-            # return groups by type and natural sort each of the
-            # groups by their strings
-            groups.append(sorted(group, key=utils.natsort_key, reverse=True))
-
-        # sort the groups by type so we more or less always get the
-        # results by type in the same order
-        groups = sorted(groups, key=lambda x: type(x[0]), reverse=True)
+        # sort the results by type so we more or less always get the
+        # results by type in the same order and then natural sort each
+        # type by its sort key
+        keys = sorted(self.results.sort_keys(keys, self.view_meta),
+                      key=lambda k: (k.type.__name__, k.sort_key))
 
-        chunk_size = 100
         update_every = 200
         steps_so_far = 0
 
-        # iterate over slice of size "steps", yield after adding each
-        # slice to the model
-        #for obj in itertools.islice(itertools.chain(*groups), 0,None, steps):
-        #for obj in itertools.islice(itertools.chain(results), 0,None, steps):
-
-        added = set()
-        for obj in itertools.chain(*groups):
-            if obj in added:  # only add unique object
-                continue
-            else:
-                added.add(obj)
-            parent = model.prepend(None, [obj])
-            obj_type = type(obj)
+        for key in keys:
+            parent = model.append(None, [key])
             if check_for_kids:
-                kids = self.view_meta[obj_type].get_children(obj)
+                obj = self.results.get(key)
+                kids = self.view_meta[key.type].get_children(obj)
                 if len(kids) > 0:
-                    model.prepend(parent, ['-'])
-            elif self.view_meta[obj_type].children is not None:
-                model.prepend(parent, ['-'])
+                    model.append(parent, ['-'])
+            elif self.view_meta[key.type].children is not None:
+                model.append(parent, ['-'])
             #steps_so_far += chunk_size
             steps_so_far += 1
             if steps_so_far % update_every == 0:
@@ -813,7 +1228,21 @@ class SearchView(pluginmgr.View):
             # drastically speeds up populating the view with large
             # datasets
             return
-        value = model[treeiter][0]
+        # the value that's actually stored in the model
+        key = value = model[treeiter][0]
+        if isinstance(value, ResultKey):
+            if value[:2] not in self.results.cache:
+                self._load_visible(model)
+            value = self.results.get(key)
+            if value is None:
+                # the object was deleted
+                cell.set_property('markup', '')
+                def remove_key():
+                    model = self.results_view.get_model()
+                    for found in utils.search_tree_model(model, key):
+                        model.remove(found)
+                gobject.idle_add(remove_key)
+                return
         if isinstance(value, basestring):
             cell.set_property('markup', value)
         else:
@@ -850,12 +1279,31 @@ class SearchView(pluginmgr.View):
                 def remove():
                     model = self.results_view.get_model()
                     self.results_view.set_model(None) # detach model
-                    for found in utils.search_tree_model(model, value):
+                    for found in utils.search_tree_model(model, key):
                         model.remove(found)
                     self.results_view.set_model(model)
                 gobject.idle_add(remove)
 
 
+    def _load_visible(self, model):
+        """
+        Load the objects for the top level rows that are visible in
+        the results view.
+        """
+        visible = self.results_view.get_visible_range()
+        if not visible:
+            return
+        start, end = visible[0][0], visible[1][0]
+        end = min(max(end + 1, start + self.results.batch_size),
+                  model.iter_n_children(None))
+        keys = []
+        for index in xrange(start, end):
+            value = model[(index,)][0]
+            if isinstance(value, ResultKey):
+                keys.append(value)
+        self.results.load(keys)
+
+
     def get_expanded_rows(self):
         '''
         return all the rows in the model that are expanded
@@ -976,6 +1424,8 @@ class SearchView(pluginmgr.View):
             pass
 
         self.session.expire_all()
+        self.results.clear()
+        self.prefetcher.clear()
 
         # the invalidate_str_cache() method are specific to Species
         # and Accession right now....its a bit of a hack since there's
@@ -983,7 +1433,8 @@ class SearchView(pluginmgr.View):
         # fix our string caching issues
         def invalidate_cache(model, path, treeiter, data=None):
             obj = model[path][0]
-            if hasattr(obj, 'invalidate_str_cache'):
+            if not isinstance(obj, ResultKey) and \
+                    hasattr(obj, 'invalidate_str_cache'):
                 obj.invalidate_str_cache()
         model.foreach(invalidate_cache)
         expanded_rows = self.get_expanded_rows()
@@ -1151,11 +1602,86 @@ class StringColumn(gtk.TreeViewColumn):
 
 
 
+def parse_history_args(arg):
+    """
+    Parse the arguments to the history command into a dict of filters.
+
+    The arguments are a list of name=value pairs where name is one of
+    table, user, id, from or to, e.g. ::
+
+      history table=plant id=12 from=2010-01-01
+
+    :param arg: the argument string
+    """
+    names = ('table', 'user', 'id', 'from', 'to')
+    filters = {}
+    if not arg:
+        return filters
+    for token in arg.split():
+        if '=' not in token:
+            name = value = None
+        else:
+            name, value = token.split('=', 1)
+        if name not in names or not value:
+            raise BaubleError(_('Invalid history argument: %(arg)s\n\n'
+                                'The arguments must be one of %(names)s '
+                                'followed by =value') % \
+                                  {'arg': token, 'names': ', '.join(names)})
+        if name == 'id':
+            try:
+                value = int(value)
+            except ValueError:
+                raise BaubleError(_('The history id must be a number: %s') \
+                                      % value)
+        filters[name] = value
+    return filters
+
+
+def get_history_query(session, filters=None, after=None):
+    """
+    Return a query of the history items that match filters, most
+    recent first.
+
+    :param session: the session to use for the query
+    :param filters: a dict from parse_history_args()
+    :param after: a (timestamp, id) tuple of the last item that has
+      already been returned, only the items after it are returned
+    """
+    History = db.History
+    query = session.query(History)
+    if filters is None:
+        filters = {}
+    if 'table' in filters:
+        query = query.filter(History.table_name == filters['table'])
+    if 'user' in filters:
+        query = query.filter(History.user == filters['user'])
+    if 'id' in filters:
+        query = query.filter(History.table_id == filters['id'])
+    if 'from' in filters:
+        query = query.filter(History.timestamp >= filters['from'])
+    if 'to' in filters:
+        query = query.filter(History.timestamp <= filters['to'])
+    if after is not None:
+        # keyset paging so we don't have to OFFSET through the table
+        timestamp, history_id = after
+        query = query.filter(or_(History.timestamp < timestamp,
+                                 and_(History.timestamp == timestamp,
+                                      History.id < history_id)))
+    return query.order_by(History.timestamp.desc(), History.id.desc())
+
+
 class HistoryView(pluginmgr.View):
     """Show the tables row in the order they were last updated
     """
+
+    # the number of history items to load at a time
+    page_size = 200
+
     def __init__(self):
         super(HistoryView, self).__init__()
+        self.filters = {}
+        self.last = None
+        self.more = False
         self.init_gui()
 
 
@@ -1166,7 +1692,6 @@ class HistoryView(pluginmgr.View):
                   (_('User'), 2), (_('Table'), 3), (_('Values'), 4)]
         for name, index in columns:
             column = StringColumn(name, text=index)
-            column.set_sort_column_id(index)
             column.set_expand(False)
             column.props.sizing = gtk.TREE_VIEW_COLUMN_AUTOSIZE
             column.set_resizable(True)
@@ -1174,22 +1699,56 @@ class HistoryView(pluginmgr.View):
             self.treeview.append_column(column)
         sw = gtk.ScrolledWindow()
         sw.add(self.treeview)
+        sw.get_vadjustment().connect('value-changed', self.on_scrolled)
         self.pack_start(sw)
 
 
+    def on_scrolled(self, adjustment):
+        """
+        Load the next page of history items when the view is scrolled
+        near the bottom.
+        """
+        bottom = adjustment.value + adjustment.page_size
+        if self.more and bottom >= adjustment.upper - adjustment.page_size:
+            self.add_page()
+
+
+    def add_page(self):
+        """
+        Add the next page of history items to the view.
+        """
+        session = db.Session()
+        try:
+            query = get_history_query(session, self.filters, self.last)
+            items = query.limit(self.page_size).all()
+        finally:
+            session.close()
+        model = self.treeview.get_model()
+        for item in items:
+            model.append([item.timestamp, item.operation, item.user,
+                          item.table_name, item.values])
+        if items:
+            self.last = (items[-1].timestamp, items[-1].id)
+        self.more = len(items) == self.page_size
+
+
     def populate_history(self, arg):
         """
         Add the history items to the view.
+
+        :param arg: the arguments to the history command, see
+          parse_history_args()
         """
-        session = db.Session()
+        try:
+            filters = parse_history_args(arg)
+        except BaubleError, e:
+            utils.message_dialog(utils.xml_safe_utf8(e), gtk.MESSAGE_ERROR)
+            return
         utils.clear_model(self.treeview)
-        model = gtk.ListStore(str, str, str, str, str)
-        for item in session.query(db.History).\
-                order_by(db.History.timestamp.desc()).all():
-            model.append([item.timestamp, item.operation, item.user,
-                          item.tablename, item.values])
-        self.treeview.set_model(model)
-        session.close()
+        self.treeview.set_model(gtk.ListStore(str, str, str, str, str))
+        self.filters = filters
+        self.last = None
+        self.add_page()
 
 
 
@@ -1229,7 +1788,11 @@ def select_in_search_results(obj):
     if not isinstance(view, SearchView):
         return None
     model = view.results_view.get_model()
-    found = utils.search_tree_model(model, obj)
+    def _cmp(row, data):
+        if isinstance(row[0], ResultKey):
+            return row[0].matches(data)
+        return row[0] == data
+    found = utils.search_tree_model(model, obj, _cmp)
     row_iter = None
     if len(found) > 0:
         row_iter = found[0]
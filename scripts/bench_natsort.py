@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#
+# bench_natsort.py
+#
+# compare sorting plants in python with utils.natsort_key against
+# sorting them in the database with ORDER BY on the sort_key table
+#
+
+import sys
+import time
+from optparse import OptionParser
+
+usage = 'usage: %prog [options]'
+parser = OptionParser(usage)
+parser.add_option('-n', '--nplants', dest='nplants', type='int',
+                  default=100000, metavar='N',
+                  help='the number of plants to create')
+parser.add_option('-a', '--per-accession', dest='per_acc', type='int',
+                  default=5, metavar='N',
+                  help='the number of plants per accession')
+parser.add_option('-u', '--uri', dest='uri', default='sqlite:///:memory:',
+                  metavar='URI', help='the database URI, the database is '\
+                      'recreated')
+options, args = parser.parse_args()
+
+import bauble
+from bauble.test import init_bauble
+import bauble.db as db
+import bauble.utils as utils
+from bauble.plugins.plants import Family, Genus, Species
+from bauble.plugins.garden import Accession, Location, Plant, \
+    accession_sort_key_ext, plant_sort_key_ext
+
+
+def timed(msg, func):
+    start = time.time()
+    result = func()
+    print '%s: %.3fs' % (msg, time.time() - start)
+    return result
+
+
+def populate():
+    session = db.Session()
+    family = Family(family=u'Family')
+    genus = Genus(family=family, genus=u'Genus')
+    species = Species(genus=genus, sp=u'sp')
+    location = Location(code=u'LOC', name=u'Location')
+    session.add_all([family, genus, species, location])
+    session.commit()
+
+    # insert directly into the tables, the sort keys are rebuilt below
+    conn = session.connection()
+    nacc = options.nplants / options.per_acc
+    acc_rows = [dict(id=i+1, code=u'A%s' % (nacc-i),
+                     species_id=species.id) for i in xrange(nacc)]
+    conn.execute(Accession.__table__.insert(), acc_rows)
+    plant_rows = []
+    for i in xrange(options.nplants):
+        plant_rows.append(dict(id=i+1, accession_id=(i % nacc)+1,
+                               location_id=location.id, quantity=1,
+                               code=u'%s' % (options.per_acc-(i / nacc))))
+    conn.execute(Plant.__table__.insert(), plant_rows)
+    session.commit()
+
+    timed('build sort keys', lambda: db.check_sort_keys(\
+            [(Accession, accession_sort_key_ext), (Plant, plant_sort_key_ext)]))
+    session.close()
+
+
+def python_sort(session):
+    q = session.query(Plant.id, Accession.code, Plant.code).join(Accession)
+    delimiter = Plant.get_delimiter()
+    rows = [(r[0], '%s%s%s' % (r[1], delimiter, r[2])) for r in q]
+    return [r[0] for r in sorted(rows, key=lambda r: utils.natsort_key(r[1]))]
+
+
+def database_sort(session):
+    q = session.query(Plant.id).order_by(db.sort_key_column(Plant))
+    return [r[0] for r in q]
+
+
+def main():
+    init_bauble(options.uri, create=True)
+    timed('populate %s plants' % options.nplants, populate)
+
+    session = db.Session()
+    ids1 = timed('python natsort_key', lambda: python_sort(session))
+    ids2 = timed('ORDER BY sort key', lambda: database_sort(session))
+    if ids1 != ids2:
+        # natsort_key() treats 1.10 as a decimal number so the
+        # order can differ when the plant codes have more than one digit
+        print >>sys.stderr, '** the results are not in the same order'
+    session.close()
+
+
+if __name__ == '__main__':
+    main()
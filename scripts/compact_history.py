@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+#
+# compact_history.py
+#
+# fold the history items older than a number of days into one
+# snapshot per row, see bauble.db.compact_history()
+#
+
+import datetime
+import sys
+from optparse import OptionParser
+
+usage = 'usage: %prog [options] uri'
+parser = OptionParser(usage)
+parser.add_option('-d', '--days', dest='days', type='int', default=365,
+                  metavar='N', help='compact the history older than N days')
+options, args = parser.parse_args()
+if len(args) != 1:
+    parser.error('expected a database uri')
+
+import bauble
+import bauble.db as db
+
+
+def main():
+    if not db.open(args[0]):
+        print >>sys.stderr, 'could not open %s' % args[0]
+        sys.exit(1)
+    before = datetime.datetime.today() - datetime.timedelta(days=options.days)
+    nitems = db.compact_history(before)
+    print 'removed %s history items older than %s' % (nitems, before)
+
+
+if __name__ == '__main__':
+    main()